@@ -17,7 +17,7 @@ from pathlib import Path
 
 from icwavessdk.enums import *
 from icwavessdk.icwaves import *
-from trsfile import *
+from trsfile import Header, SampleCoding, TracePadding, TraceSet
 from trsfile import traceparameter
 from trsfile.parametermap import TraceSetParameterMap, TraceParameterDefinitionMap
 
@@ -30,6 +30,9 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from spidersdk.chronology import Chronology
 from spidersdk.spider import Spider
+
+from common.traces import open_trace_writer
+
 PARAMETERS = Parameters(
     ('attempts', # {'attempts': 5}
         AttemptsParameter('Attempts')),
@@ -138,6 +141,8 @@ def execute_script(util):
             mode='w',
             padding_mode=TracePadding.AUTO)
         util.add_to_cleanup(traceset.close)
+        # Write the traces on a background thread, so a slow disk does not delay the next arm
+        writer = open_trace_writer(util, traceset)
 
         counter = 0
         
@@ -198,11 +203,9 @@ def execute_script(util):
             if timeout:
                 result = ResultColor.YELLOW
             else:
-                # Create and add a new Trace. Note that the result trace does not contain any TraceParameters.
-                trace = Trace(SampleCoding.BYTE,
-                              samples,
-                              title=f'Channel {ICWavesInputChannel.ANALOG1}')
-                traceset.append(trace)
+                # Add a new Trace. Note that the result trace does not contain any TraceParameters.
+                # The samples are copied, in case the icWaves reuses its buffer.
+                writer.add(samples, title=f'Channel {ICWavesInputChannel.ANALOG1}', copy=True)
 
             result = Parameters(
                 ("id", counter),
@@ -220,4 +223,7 @@ def execute_script(util):
             util.monitor(result)
             db.add(result)
 
-            counter += 1
\ No newline at end of file
+            counter += 1
+
+        writer.flush()
+        writer.report()
\ No newline at end of file
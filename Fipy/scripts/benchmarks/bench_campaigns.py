@@ -0,0 +1,362 @@
+'''Throughput benchmark of the campaign scripts against simulated devices.
+
+Runs the ``execute_script`` of each campaign script for a number of attempts with the devices of
+``common.simulation``, and reports the attempts per second, the p50 and p99 iteration latency and the peak memory
+allocated by Python. Nothing waits for hardware, except the idle time of the ``FramedReader`` reads, so the
+numbers are the cost of the host code of every attempt: the baseline for performance work on the scripts.
+
+=========  ==========================================================================================
+scenario   script
+=========  ==========================================================================================
+single     ``TrainingSingleGlitch.py``: one glitch, ``Campaign`` writing to the database
+double     ``second_script.py``: two glitches, ``Campaign`` writing to the database
+triple     ``fifth_script.py``: three glitches, glitch 2 from the region, idle reads, batched results, timing
+firm       ``demo_setup_spider_pinata_vccfi_FIRM.py``: 136 byte responses and the trailing bytes check
+tc6        ``demo_setup_vcglitcher_tc6_vccfi.py``: VCGlitcher program, T=1 command and response
+tvla       ``demo_tvla.py`` in dual state: mapped inputs, schedule, segment arrays, trace writer, t-test
+=========  ==========================================================================================
+
+The fipy, spidersdk, trsfile and firm modules the scripts import are replaced by the stand-ins of
+``benchmarks.stubs``, and the device openers of the scripts return simulated devices. The options of a scenario,
+e.g. ``IDLE_BYTES`` of the triple scenario, are set on the script module before it runs, and the sleeps that wait
+for the target after a failed attempt are left out. The scripts run in a temporary directory, so their
+``logs`` go there. The tvla scenario needs the ``cryptography`` package.
+
+Every run is appended to ``~/.cache/fipy/bench_campaigns.jsonl``, with the git revision, and compared with the
+previous run on the same machine with the same number of attempts. Run from the scripts directory:
+
+    python -m benchmarks.bench_campaigns --attempts 5000
+    python -m benchmarks.bench_campaigns --scenarios single triple --no-save
+'''
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter_ns
+from types import SimpleNamespace
+
+from benchmarks import stubs
+from common.simulation import (FAULT, MUTE, NORMAL, PARTIAL, FaultModel, SimulatedChronology, SimulatedScope,
+                               SimulatedTarget, SimulatedUtil, SimulatedVCGlitcher)
+
+stubs.install()
+
+HISTORY = os.path.join(os.path.expanduser('~'), '.cache', 'fipy', 'bench_campaigns.jsonl')
+
+BAUDRATE = 115200
+# The read timeout of the target port. Muted targets cost this every attempt, on hardware it is often longer.
+READ_TIMEOUT = 0.01
+SERIAL = {'spider_com_port': 'spider', 'serial_com_port': 'target', 'serial_baudrate': BAUDRATE,
+          'serial_timeout': READ_TIMEOUT}
+TC6_ATR = '3bd518ff8191fe1fc38073c821100a'
+TVLA_IN_BYTES = 16
+TVLA_KEY_BYTES = 16
+TVLA_BLOCKS = 10000
+TVLA_SAMPLES = 10000
+TVLA_SEGMENTS = 10
+
+# A scenario: the module of the script, its fixed settings, the (min, max) of its random parameters, the options
+# set on the module, and a function of the working directory that creates the simulated devices and returns the
+# names of the module to replace, e.g. its device openers
+Scenario = namedtuple('Scenario', ['script', 'settings', 'ranges', 'options', 'open_devices'])
+
+
+class NullDatabase:
+    """
+    Result database that only counts the rows.
+    """
+
+    def __init__(self):
+        self.rows = 0
+
+    def add(self, row, commit_frequency=None):
+        self.rows += 1
+
+
+class BenchUtil(SimulatedUtil):
+    """
+    The fipy script util of a benchmark run: the settings and parameters of the scenario, a database that only
+    counts the rows, the working directory as project directory and an XYZ table that does not move.
+    """
+
+    def __init__(self, settings, parameters, workdir):
+        super().__init__()
+        self.settings = settings
+        self.parameters = parameters
+        self.fipy_args = {'project_dir': Path(workdir)}
+        self.db = NullDatabase()
+
+    def set_termination_timeout(self, timeout):
+        pass
+
+    def parameter_init(self, parameters):
+        parameters.settings = self.settings
+        parameters.source = self.parameters
+
+    def create_database_table(self, path, table):
+        return self.db
+
+    def close_database(self):
+        pass
+
+    def get_xyz(self):
+        return stubs.XYZTable()
+
+
+def random_parameters(attempts, seed, settings, ranges):
+    """
+    :param settings: the fixed settings, included in every set of parameters like fipy does
+    :param ranges: (min, max) per parameter, ints give ints and floats give floats
+    :return: an iterator over ``attempts`` dicts of parameters
+    """
+    rng = random.Random(seed)
+    for _ in range(attempts):
+        p = dict(settings)
+        p.update((name, rng.randint(low, high) if isinstance(low, int) else rng.uniform(low, high))
+                 for name, (low, high) in ranges.items())
+        yield p
+
+
+def glitch_ranges(glitches):
+    """Parameter ranges of a sweep with this many glitches, around the fault window of ``FaultModel``."""
+    ranges = {}
+    for i in range(1, glitches + 1):
+        suffix = '' if i == 1 else str(i)
+        ranges['glitch_delay' + suffix] = (1000, 2000)
+        ranges['glitch_length' + suffix] = (20, 520)
+        ranges['glitch_voltage' + suffix] = (-0.1, 0.2)
+    return ranges
+
+
+def nothing(*args, **kwargs):
+    pass
+
+
+def campaign_devices(glitcher, target):
+    """
+    :return: the device openers of ``common.campaign`` imported by the scripts, returning the simulated devices
+    """
+    return {
+        'open_spider_port': lambda util, port: SimpleNamespace(bytes_written=0, bytes_read=0),
+        'open_spider': lambda spider_com_port: glitcher,
+        'open_target': lambda util, port, baudrate, timeout: target,
+    }
+
+
+def single_devices(workdir):
+    return campaign_devices(*SimulatedChronology.with_target(FaultModel(seed=1)))
+
+
+def triple_devices(workdir):
+    # The target waits for reads like a serial port, so the reader thread blocks instead of spinning. Glitch 2 is
+    # drawn from the region, which reaches 1000 ns, so only the longest glitches mute the target.
+    target = SimulatedTarget(timeout=READ_TIMEOUT, realtime=True)
+    return campaign_devices(SimulatedChronology(target, FaultModel(mute_length=900, seed=1), triggers=3), target)
+
+
+def firm_devices(workdir):
+    # One expected response for all test types, faults flip a byte or cut the response short
+    faulted = bytearray(stubs.FIRM_EXPECTED)
+    faulted[64] ^= 0xff
+    responses = {NORMAL: stubs.FIRM_EXPECTED, FAULT: bytes(faulted), PARTIAL: stubs.FIRM_EXPECTED[:60], MUTE: b''}
+    target = SimulatedTarget(timeout=READ_TIMEOUT, realtime=True)
+    stubs.devices.glitcher = SimulatedChronology(target, FaultModel(responses=responses, seed=1))
+    # The Spider port is not used by the stand-in Chronology, so both ports are the target
+    return {'serial': SimpleNamespace(Serial=lambda: target), 'sleep': nothing}
+
+
+def tc6_devices(workdir):
+    # The armed glitch pattern is in steps of 2 ns
+    stubs.devices.vcg = SimulatedVCGlitcher(FaultModel(length=(20, 30), voltage=(0.5, 1.0), seed=1),
+                                            atr=bytes.fromhex(TC6_ATR))
+    return {'sleep': nothing}
+
+
+def tvla_devices(workdir):
+    metadata = os.path.join(workdir, 'metadata')
+    os.makedirs(metadata, exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'traces'), exist_ok=True)
+    with open(os.path.join(metadata, '10k_aes_dec_hw_r5_0-7_dual_state'), 'wb') as f:
+        f.write(random.Random(1).randbytes(TVLA_BLOCKS * (TVLA_IN_BYTES + TVLA_KEY_BYTES)))
+    stubs.devices.scope = SimulatedScope(TVLA_SAMPLES, TVLA_SEGMENTS, seed=1)
+    return {}
+
+
+SCENARIOS = {
+    'single': Scenario('TrainingSingleGlitch', dict(SERIAL, normal_voltage=1.8), glitch_ranges(1), {},
+                       single_devices),
+    'double': Scenario('second_script', dict(SERIAL, normal_voltage=0.9), glitch_ranges(2), {}, single_devices),
+    'triple': Scenario('fifth_script', dict(SERIAL, normal_voltage=0.9, glitches=3), glitch_ranges(3),
+                       {'BATCHED_RESULTS': True, 'IDLE_BYTES': 32, 'STAGE_TIMING': True, 'SAMPLE_FROM_REGION': True},
+                       triple_devices),
+    'firm': Scenario('demo_setup_spider_pinata_vccfi_FIRM', dict(SERIAL, normal_voltage=0.9),
+                     {'test_type': (1, 3), 'glitch_delay_1': (1000, 2000), 'glitch_delay_2': (1000, 2000),
+                      'glitch_delay_3': (1000, 2000), 'glitch_length': (20, 520), 'glitch_voltage': (-0.1, 0.2)},
+                     {'IDLE_BYTES': 32}, firm_devices),
+    'tc6': Scenario('demo_setup_vcglitcher_tc6_vccfi',
+                    {'atr': TC6_ATR, 'normal_voltage': 3.0, 'cmd_logging': False},
+                    {'glitch_delay': (1000, 2000), 'glitch_length': (20, 80), 'glitch_voltage': (0.0, 1.5)},
+                    {}, tc6_devices),
+    'tvla': Scenario('demo_tvla',
+                     {'tvla_dual_state': True, 'scope_enabled': True, 'move_table': False, 'lecroy_ip': '',
+                      'xyz_scanner': None, 'attempts': 1},
+                     {'scans': (0, 0)}, {}, tvla_devices),
+}
+
+
+def run_script(module, scenario, parameters, workdir):
+    """
+    Run ``execute_script`` of the script once, on new simulated devices, and run its cleanup.
+    """
+    for name, value in dict(scenario.options, **scenario.open_devices(workdir)).items():
+        setattr(module, name, value)
+    util = BenchUtil(scenario.settings, parameters, workdir)
+    try:
+        module.execute_script(util)
+    finally:
+        util.close()
+
+
+def laps(parameters, times):
+    """
+    Pass on the parameters and append the time between two requests for parameters, the iteration latency, to
+    ``times``, in nanoseconds.
+    """
+    last = None
+    for p in parameters:
+        now = perf_counter_ns()
+        if last is not None:
+            times.append(now - last)
+        last = now
+        yield p
+    if last is not None:
+        times.append(perf_counter_ns() - last)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(scenario, attempts, seed, repeat, memory):
+    """
+    Run the script of a scenario ``repeat`` times and keep the fastest run, then run it once more with
+    ``tracemalloc`` for its peak memory.
+
+    :return: dict of the measurements
+    """
+    scenario = SCENARIOS[scenario]
+    module = importlib.import_module(scenario.script)
+    best = None
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        os.makedirs(os.path.join(workdir, 'logs'))
+        os.chdir(workdir)
+        try:
+            # The scripts print their responses and reports
+            with contextlib.redirect_stdout(devnull):
+                for _ in range(repeat):
+                    times = []
+                    start = perf_counter_ns()
+                    run_script(module, scenario,
+                               laps(random_parameters(attempts, seed, scenario.settings, scenario.ranges), times),
+                               workdir)
+                    elapsed = perf_counter_ns() - start
+                    if best is None or elapsed < best[0]:
+                        best = elapsed, times
+                peak = None
+                if memory:
+                    tracemalloc.start()
+                    run_script(module, scenario, random_parameters(attempts, seed, scenario.settings,
+                                                                   scenario.ranges), workdir)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    elapsed, times = best
+    times.sort()
+    return {
+        'attempts': len(times),
+        'attempts_per_s': len(times) / (elapsed / 1e9),
+        'p50_us': percentile(times, 0.5) / 1e3,
+        'p99_us': percentile(times, 0.99) / 1e3,
+        'peak_kib': None if peak is None else peak / 1024,
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_run(path, machine, attempts):
+    """
+    :return: the results of the last run in the history on the same machine with the same attempts, or {}
+    """
+    if not os.path.exists(path):
+        return {}
+    results = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['machine'] == machine and entry['attempts'] == attempts:
+                results = entry['results']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attempts', type=int, default=5000, help='attempts per scenario')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the fastest one is reported')
+    parser.add_argument('--no-memory', action='store_true', help='skip the second run that measures the memory')
+    parser.add_argument('--history', default=HISTORY, help='the JSON lines file the results are appended to')
+    parser.add_argument('--no-save', action='store_true', help='do not append the results to the history')
+    args = parser.parse_args()
+    args.history = os.path.abspath(args.history)
+
+    machine = '{} {} Python {}'.format(platform.node(), platform.machine(), platform.python_version())
+    previous = previous_run(args.history, machine, args.attempts)
+    results = {}
+    print('{:<8} {:>8} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'scenario', 'attempts', 'attempts/s', 'p50 us', 'p99 us', 'peak KiB', 'vs last'))
+    for scenario in args.scenarios:
+        try:
+            result = run(scenario, args.attempts, args.seed, args.repeat, not args.no_memory)
+        except ImportError as e:
+            print('{:<8} skipped: {}'.format(scenario, e))
+            continue
+        results[scenario] = result
+        change = ''
+        if scenario in previous:
+            change = '{:+.1f}%'.format(100 * (result['attempts_per_s'] / previous[scenario]['attempts_per_s'] - 1))
+        print('{:<8} {:>8} {:>12.0f} {:>10.1f} {:>10.1f} {:>10} {:>10}'.format(
+            scenario, result['attempts'], result['attempts_per_s'], result['p50_us'], result['p99_us'],
+            '-' if result['peak_kib'] is None else '{:.0f}'.format(result['peak_kib']), change))
+        sys.stdout.flush()
+
+    if results and not args.no_save:
+        entry = {'time': datetime.now().isoformat(timespec='seconds'), 'revision': revision(), 'machine': machine,
+                 'attempts': args.attempts, 'repeat': args.repeat, 'results': results}
+        os.makedirs(os.path.dirname(args.history), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        print('Results appended to {}'.format(args.history))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''Benchmark of the response classifiers.
+
+Compares the hand-written if/elif chain of ``fifth_script.py`` with the same rules as a compiled ``Classifier``
+and as one combined regular expression, on a mix of typical Pinata responses. The colors are plain strings, so
+the benchmark runs without fipy. Run from the scripts directory:
+
+    python -m benchmarks.bench_classifier
+'''
+
+import argparse
+import re
+from timeit import Timer
+from types import SimpleNamespace
+
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+
+RESPONSES = [
+    (b'', True),
+    (b'\x00', True),
+    (b'0,aaaa,aaaa,String: ' + b'x' * 24 + b'\r\n', False),
+    (b'0,aaaa,aaaa,String: ' + b'x' * 24 + b'\r\n', True),
+    (b'\x000,aaa6,aaa5,String: ' + b'x' * 23 + b'\r\n', True),
+    (b'1,aaa6,aaa5,String: ' + b'x' * 24 + b'\r\n', True),
+    (b'\xff\xfe garbage after a glitch \x13\x37' + b'y' * 18, True),
+    (b'\xff\xfe garbage after a glitch \x13\x37' + b'y' * 18, False),
+]
+
+
+def chain(attempt):
+    pin_response = attempt.response
+    if attempt.spider_timeout:
+        if len(pin_response)==0 or pin_response==b'\x00':
+            return 'YELLOW'
+        elif b'0,aaa6,aaa5,' in pin_response:
+            return 'ORANGE'
+        elif b'1,aaa6,aaa5,' in pin_response:
+            return 'GREEN'
+        elif b'0,aaaa,aaaa,' in pin_response:
+            return 'CYAN'
+        else:
+            return 'MAGENTA'
+    elif b'0,aaaa,aaaa' in pin_response:
+        return 'RED'
+    else:
+        return 'WHITE'
+
+
+CLASSIFIER = Classifier([
+    Rule('YELLOW', Timeout(), Exact(b'', b'\x00')),
+    Rule('ORANGE', Timeout(), Contains(b'0,aaa6,aaa5,')),
+    Rule('GREEN', Timeout(), Contains(b'1,aaa6,aaa5,')),
+    Rule('CYAN', Timeout(), Contains(b'0,aaaa,aaaa,')),
+    Rule('MAGENTA', Timeout()),
+    Rule('RED', Contains(b'0,aaaa,aaaa')),
+    Rule('WHITE'),
+])
+
+# One pass over the response with one regex, the priority of the rules is in the order of the alternatives
+_TIMEOUT_REGEX = re.compile(rb'\A\x00?\Z|(?=[\s\S]*(0,aaa6,aaa5,))|(?=[\s\S]*(1,aaa6,aaa5,))|(?=[\s\S]*(0,aaaa,aaaa,))')
+_TIMEOUT_COLORS = ['YELLOW', 'ORANGE', 'GREEN', 'CYAN']
+
+
+def combined_regex(attempt):
+    if attempt.spider_timeout:
+        match = _TIMEOUT_REGEX.match(attempt.response)
+        if match is None:
+            return 'MAGENTA'
+        return _TIMEOUT_COLORS[match.lastindex or 0]
+    return 'RED' if b'0,aaaa,aaaa' in attempt.response else 'WHITE'
+
+
+def measure(function, repeat):
+    """Return the best time per call in seconds."""
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions, the best one is reported')
+    args = parser.parse_args()
+
+    attempts = [SimpleNamespace(response=response, spider_timeout=timeout) for response, timeout in RESPONSES]
+    for name, classify in (('regex', combined_regex), ('compiled', CLASSIFIER)):
+        mismatches = [a for a in attempts if classify(a) != chain(a)]
+        if mismatches:
+            raise AssertionError('{} classifies {} differently'.format(name, mismatches[0].response))
+
+    print('{:<10} {:>14}'.format('classifier', 'ns per response'))
+    for name, classify in (('if/elif', chain), ('compiled', CLASSIFIER.classify), ('regex', combined_regex)):
+        seconds = measure(lambda: [classify(a) for a in attempts], args.repeat)
+        print('{:<10} {:>14.1f}'.format(name, seconds / len(attempts) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''Acceptance rate of the adaptive search of ``fifth_script.py`` with its region.
+
+Runs the sample, accept and observe stages of the campaign of ``fifth_script.py`` with ``ADAPTIVE_SEARCH``: the
+search over the ranges of ``fifth_script.py.json``, and the region of the second glitch as accept stage. Attempts
+fault with a fixed rate and are otherwise red, so the values inside the region lose reward on almost every attempt.
+For every block of attempts the campaign asks for, it prints how many were attempted and how many proposals that
+took, both for a sampler that knows the accept stage and for one that does not, which only proposes once and
+leaves the rejected values at their prior. Exits with status 1 when the acceptance rate of the sampler with the
+accept stage drops clearly below the rate of its first block. Run from the scripts directory:
+
+    python -m benchmarks.bench_search
+    python -m benchmarks.bench_search --blocks 20 --fault-rate 0
+'''
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy
+
+from benchmarks import stubs
+
+stubs.install()
+
+import fifth_script  # noqa: E402
+from common.search import ThompsonSearch  # noqa: E402
+
+REGION_KEYS = ['glitch_length2', 'glitch_voltage2']
+# Fraction of the acceptance rate of the first block the later blocks need, for the noise of the random search
+TOLERANCE = 0.9
+REWARDS = {fifth_script.ResultColor.GREEN: 1.0, fifth_script.ResultColor.ORANGE: 0.5}
+
+
+def run(with_accept, blocks, block_size, fault_rate, seed):
+    """
+    :return: list of (attempts, proposals) per block of ``block_size`` samples
+    """
+    search = ThompsonSearch.from_settings(Path(fifth_script.__file__).with_suffix('.py.json'),
+                                          fifth_script.SEARCH_KEYS, REWARDS, seed=seed)
+    accept = fifth_script.region.accepts(*REGION_KEYS)
+    sample = search.sampler(accept=accept, keys=REGION_KEYS) if with_accept else search.sampler()
+    rng = numpy.random.default_rng(seed)
+    result = []
+    for _ in range(blocks):
+        attempts = 0
+        rejections = search.rejections
+        for _ in range(block_size):
+            p = sample({})
+            if not accept(p):
+                continue
+            attempts += 1
+            color = fifth_script.ResultColor.GREEN if rng.random() < fault_rate else fifth_script.ResultColor.RED
+            search.observe(p, color)
+        proposals = block_size + search.rejections - rejections
+        result.append((attempts, proposals))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocks', type=int, default=8)
+    parser.add_argument('--block-size', type=int, default=2000, help='samples per block')
+    parser.add_argument('--fault-rate', type=float, default=0.01, help='fraction of the attempts that fault')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    runs = {name: run(with_accept, args.blocks, args.block_size, args.fault_rate, args.seed)
+            for name, with_accept in [('accept', True), ('no accept', False)]}
+    print('{:<6} {:^32} {:^32}'.format('', 'sampler with accept', 'sampler without accept'))
+    print('{:<6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'block', 'attempts', 'proposals', 'acceptance', 'attempts', 'proposals', 'acceptance'))
+    for block, rows in enumerate(zip(*runs.values())):
+        print('{:<6} {}'.format(block, ' '.join('{:>10} {:>10} {:>10.1%}'.format(a, p, a / p) for a, p in rows)))
+
+    rates = [a / p for a, p in runs['accept']]
+    if min(rates) < TOLERANCE * rates[0]:
+        print('The acceptance rate dropped from {:.1%} to {:.1%}'.format(rates[0], min(rates)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''Benchmark of the glitch pattern templates in ``templates.py``.
+
+Measures the generation time of every template for durations from 1 us up to the duration that fills the
+full ``PATTERN_STATE_LIMIT``, in both the list and the array output format. The pattern cache is disabled unless
+``--cached`` is given. Run from the scripts directory:
+
+    python -m benchmarks.bench_templates
+'''
+
+import argparse
+from timeit import Timer
+
+import numpy
+
+import templates
+from spidersdk import Spider
+from spidersdk.glitchpattern import PATTERN_STATE_LIMIT
+
+TEMPLATES = ('block', 'sine', 'ramp', 'randomized')
+
+
+def durations(steps):
+    """Log-spaced durations from 1 us to 'PATTERN_STATE_LIMIT' slots of 'Spider.MIN_SEC'."""
+    longest = PATTERN_STATE_LIMIT * Spider.MIN_SEC
+    return numpy.geomspace(1e-6, max(longest, 1e-6), steps)
+
+
+def measure(function, repeat):
+    """Return the best time per call in seconds."""
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=8, help='number of durations to measure')
+    parser.add_argument('--repeat', type=int, default=5, help='timing repetitions, the best one is reported')
+    parser.add_argument('--cached', action='store_true', help='keep the template pattern cache enabled')
+    args = parser.parse_args()
+    if not args.cached:
+        templates.cache.max_bytes = 0
+
+    print('{:<11} {:>12} {:>8} {:>12} {:>12}'.format('template', 'duration', 'slots', 'list (us)', 'array (us)'))
+    for name in TEMPLATES:
+        template = getattr(templates, name)
+        for duration in durations(args.steps):
+            slots = len(template(0.0, 1.0, duration, output=templates.ARRAY))
+            as_list = measure(lambda: template(0.0, 1.0, duration), args.repeat)
+            as_array = measure(lambda: template(0.0, 1.0, duration, output=templates.ARRAY), args.repeat)
+            print('{:<11} {:>10.3g} s {:>8} {:>12.2f} {:>12.2f}'.format(
+                name, duration, slots, as_list * 1e6, as_array * 1e6))
+    if args.cached:
+        print('cache: {}'.format(templates.cache.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+'''Stand-ins for the fipy, spidersdk, trsfile and firm modules the campaign scripts import.
+
+``install`` puts these modules in ``sys.modules``, replacing the real ones when they are installed, so the
+benchmark imports the scripts and runs their own ``execute_script`` on the devices of ``common.simulation``. The
+stand-ins only do what the scripts need:
+
+* ``Parameters`` is both the parameter definition of a script and a result row. ``util.parameter_init`` of the
+  benchmark gives it the settings and the parameters it iterates over.
+* ``ResultColor`` is an ``IntEnum``, ``fipy_script`` and ``firm_run`` return the script unchanged.
+* ``Chronology``, ``VCGlitcher`` and ``DummyScope`` return the simulated device in ``devices``, which the benchmark
+  sets before every run. The setup methods of the VCGlitcher that ``SimulatedVCGlitcher`` does not have do
+  nothing.
+* ``trs_open`` returns a trace set that only counts the traces, ``TEQ1`` builds and parses T=1 blocks.
+'''
+
+import sys
+from collections import namedtuple
+from enum import Enum, IntEnum
+from types import ModuleType, SimpleNamespace
+
+from common.simulation import t1_block
+
+# The simulated devices the stand-ins of the device classes return: glitcher, vcg and scope
+devices = SimpleNamespace(glitcher=None, vcg=None, scope=None)
+
+
+def _nothing(*args, **kwargs):
+    return None
+
+
+class Parameters:
+    """
+    The parameters of a script, or a result row.
+    """
+
+    def __init__(self, *items):
+        self.items = items
+        self.settings = {}
+        self.source = ()
+
+    def __getitem__(self, name):
+        return self.settings[name]
+
+    def __iter__(self):
+        return iter(self.source)
+
+
+class Parameter:
+    def __init__(self, name, **kwargs):
+        self.name = name
+
+
+class ResultColor(IntEnum):
+    GREEN = 1
+    YELLOW = 2
+    RED = 3
+    ORANGE = 4
+    MAGENTA = 5
+    CYAN = 6
+    PINK = 7
+    WHITE = 8
+
+
+class Spider:
+    CORE1 = 1
+    GLITCH_OUT1 = 1
+    RISING_EDGE = 1
+
+    def __init__(self, core, port):
+        self.port = port
+
+    def reset_settings(self):
+        pass
+
+
+def Chronology(spider):
+    return devices.glitcher
+
+
+class VCGlitcher:
+    """
+    The simulated VCGlitcher, with the setup methods of the real one.
+    """
+
+    def device_list(self):
+        return 1
+
+    def get_version(self):
+        return 'simulated'
+
+    def __getattr__(self, name):
+        return getattr(devices.vcg, name, _nothing)
+
+
+class VCGlitcherProgram:
+    def __getattr__(self, name):
+        return _nothing
+
+
+class Constants:
+    """
+    Named constants, e.g. the registers of a VCGlitcher program: every name is its own value.
+    """
+
+    def __getattr__(self, name):
+        return name
+
+
+Protocol = namedtuple('Protocol', ['name', 'ifsc'])
+Response = namedtuple('Response', ['data', 'status'])
+
+
+class ATR:
+    def __init__(self, atr):
+        self.atr = bytes(atr)
+        self.protocols = [Protocol('T=1', 254)]
+
+    def dump(self):
+        return [self.atr.hex()]
+
+
+class TEQ1:
+    """
+    T=1 I-blocks with alternating sequence numbers, and the data and status word of a response block.
+    """
+
+    def __init__(self, ifsc):
+        self.ifsc = ifsc
+        self.sequence = 0
+
+    def reset(self):
+        self.sequence = 0
+
+    def build_command(self, cls, ins, data=b'', p1=0, p2=0):
+        block = t1_block(bytes([cls, ins, p1, p2, len(data)]) + data, pcb=self.sequence << 6)
+        self.sequence ^= 1
+        return block
+
+    @staticmethod
+    def response(block):
+        if not block:
+            return Response(b'', b'')
+        if len(block) < 6:
+            raise ValueError('T=1 block too short: {}'.format(bytes(block).hex()))
+        inf = bytes(block[3:3 + block[2]])
+        return Response(inf[:-2], inf[-2:])
+
+
+# The FIRM test applications: the command of every test type and the response of the Pinata without a fault
+FIRM_RESPONSE_LENGTH = 136
+FIRM_EXPECTED = bytes(range(FIRM_RESPONSE_LENGTH))
+FIRMTest = namedtuple('FIRMTest', ['cmd', 'expected'])
+
+
+class TestType(Enum):
+    REGISTER = 1
+    MEMORY = 2
+    BRANCH = 3
+
+    @classmethod
+    def from_int(cls, value):
+        return cls(value)
+
+
+class Condition(Enum):
+    NO_FAULT = 0
+    CORRUPTED = 1
+    TRUNCATED = 2
+
+
+def get_condition(test_type, received, expected):
+    return Condition.TRUNCATED if len(received) < len(expected) else Condition.CORRUPTED
+
+
+class TestProperties:
+    @staticmethod
+    def get_test_properties(port):
+        return {test_type: FIRMTest(bytes([0x40 + test_type.value]), FIRM_EXPECTED) for test_type in TestType}
+
+
+class TraceSet:
+    """
+    Trace set that only counts the traces.
+    """
+
+    def __init__(self):
+        self.traces = 0
+
+    def append(self, trace):
+        self.traces += 1
+
+    def extend(self, traces):
+        self.traces += len(traces)
+
+    def close(self):
+        pass
+
+
+class Trace:
+    def __init__(self, sample_coding, samples, parameters=None, title=''):
+        self.samples = samples
+        self.parameters = parameters
+        self.title = title
+
+
+class TraceParameterMap(dict):
+    def add_standard_parameter(self, name, value):
+        self[name] = value
+
+
+XYZPosition = namedtuple('XYZPosition', ['x', 'y', 'z'])
+
+
+class XYZTable:
+    """
+    XYZ table that stays at the origin, returned by ``util.get_xyz`` of the benchmark.
+    """
+
+    def get_reference_points(self):
+        return []
+
+    def get_current_position(self):
+        return 0.0, 0.0, 0.0
+
+    def move_abs(self, x, y, z, hop_height=None):
+        pass
+
+
+class TransformUtil:
+    """
+    Chip and table coordinates are the same.
+    """
+
+    def add_system(self, name, reference_points):
+        pass
+
+    def to_chip(self, system, position):
+        return position
+
+    def from_chip(self, system, position):
+        return position
+
+
+def _identity(function):
+    return function
+
+
+MODULES = {
+    'fipy': {},
+    'fipy.parameters': dict(
+        Parameters=Parameters, AttemptsParameter=Parameter, IntParameter=Parameter, FloatParameter=Parameter,
+        SerialPortParameter=Parameter, StringParameter=Parameter, SelectionParameter=Parameter,
+        MaskedXYZScanParameter=Parameter),
+    'fipy.scriptutils': dict(ResultColor=ResultColor, fipy_script=_identity, Util=object),
+    'fipy.plugins': {},
+    'fipy.plugins.firm': {},
+    'fipy.plugins.firm.scriptutils': dict(firm_run=_identity),
+    'fipy.device': {},
+    'fipy.device.vcglitcher': dict(
+        VCGlitcher=VCGlitcher, VCGlitcherProgram=VCGlitcherProgram, REG=Constants(), BAUD=Constants(),
+        SET=Constants(), CLK=Constants(), GLITCH_MODE=Constants(), EVCG_TRIGGER_SRC=Constants(),
+        EVCG_TRIGGER_EDGE=Constants()),
+    'fipy.device.dummy': {},
+    'fipy.device.dummy.scope': dict(DummyScope=lambda *args, **kwargs: devices.scope),
+    'fipy.device.lecroyscope': dict(LecroyScope=lambda *args, **kwargs: devices.scope),
+    'fipy.device.xyz_table': dict(XYZPosition=XYZPosition),
+    'fipy.protocols': {},
+    'fipy.protocols.smartcard': dict(ATR=ATR, TEQ1=TEQ1),
+    'fipy.sabuild': {},
+    'fipy.sabuild.tools': {},
+    'fipy.sabuild.tools.trace': dict(
+        parameters_add_xyz=_nothing, trace_params_add_tvla=_nothing,
+        trace_params_from_scope=lambda scope: TraceParameterMap()),
+    'fipy.transformutil': dict(TransformUtil=TransformUtil),
+    'spidersdk': {},
+    'spidersdk.spider': dict(Spider=Spider),
+    'spidersdk.chronology': dict(Chronology=Chronology),
+    'firm': dict(Condition=Condition, TestType=TestType, get_condition=get_condition,
+                 TestProperties=TestProperties),
+    'trsfile': dict(
+        Header=Constants(), SampleCoding=Constants(), TracePadding=Constants(), Trace=Trace,
+        trs_open=lambda **kwargs: TraceSet()),
+    'trsfile.standardparameters': dict(
+        StandardTraceParameters=Constants(), StandardTraceSetParameters=Constants()),
+    'trsfile.parametermap': dict(TraceParameterMap=TraceParameterMap),
+}
+
+
+def install():
+    """
+    Put the stand-in modules in ``sys.modules``.
+    """
+    for name, attributes in MODULES.items():
+        module = ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
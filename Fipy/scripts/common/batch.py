@@ -0,0 +1,351 @@
+'''Run many attempts per Chronology program.
+
+Every attempt of a ``Campaign`` is a round trip of the host: upload the events, start, read the response and wait
+for the Spider, which limits a campaign to a few hundred attempts per second over USB serial. ``BatchCampaign``
+puts the events of ``batch_size`` attempts, each with its own reset and glitch parameters, one after the other in
+one program, which the Spider runs without the host. The host uploads and starts once per batch.
+
+The target sends the response of every attempt during the batch. ``ResponseDemultiplexer`` reads them on a thread
+with ``FramedReader.read_bursts``, as frames that end when the target is silent for ``idle`` seconds, and gives
+every frame to the attempt it belongs to:
+
+* by its arrival time, after ``calibrate`` measured the period and the response time of an attempt in a batch with
+  parameters that do not fault the target. An attempt without a response then gets an empty one.
+* in order, without calibration. This is only right when every attempt responds.
+
+The arrival time does not always tell: a frame can end between the slots of two attempts, two frames can end in the
+slot of one attempt, or a frame can hold the responses of two attempts because the host read the port too late to
+see the pause between them. The response of such an attempt may belong to a neighbour, so the attempt is marked
+``ambiguous``; the record stage can log that, and the observe stage does not see it. A response that the host
+reads a whole period late still looks like the response of the next attempt, so ``gap`` should be well above the
+scheduling latency of the host, e.g. 10 ms.
+
+When a trigger does not come, the Spider stops in the middle of the batch. ``get_current_state`` tells in which
+attempt; that attempt is logged with ``spider_timeout`` set and the attempts after it go to the next batch. This
+relies on the state of the Spider being the index of its current event, which ``calibrate`` checks against the end
+state of the calibration batch, and every stop against the events of the program.
+
+The stages are those of ``Campaign``, but ``read`` is done by the demultiplexer, ``arm`` must reset the target at
+the start of every attempt, and ``finish_timeout`` must cover a whole batch. ``gap`` seconds are waited after every
+attempt, so the target can send its response before the next reset:
+
+>>> campaign = BatchCampaign(util, glitcher, reader, arm, classify, record, batch_size=100, idle=idle, gap=gap)
+>>> campaign.calibrate({'glitches': 0})
+>>> campaign.run(PARAMETERS, db)
+'''
+
+import itertools
+from bisect import bisect_right
+from collections import deque
+from threading import Thread
+from time import perf_counter, perf_counter_ns, time
+
+from common.campaign import Attempt, Campaign, ChronologyProgram
+
+
+class BatchProgram(ChronologyProgram):
+    """
+    The Chronology events of several attempts, with the index of the first event of every attempt.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.starts = []
+
+    def add_attempt(self, arm, p, gap=0.0):
+        """
+        Add the events of an attempt.
+
+        :param arm: the arm stage of the campaign
+        :param gap: seconds to wait after the attempt
+        """
+        self.starts.append(len(self.events))
+        arm(self, p)
+        if gap:
+            self.wait_time(gap)
+
+    def attempt_at(self, state):
+        """
+        :param state: the state the Spider stopped in, the index of the ``wait_trigger`` event it waits for
+        :return: the index of the attempt of the event
+        :raises RuntimeError: when the state is not a ``wait_trigger`` event of the program
+        """
+        if not 0 <= state < len(self.events) or self.events[state][0] != 'wait_trigger':
+            raise RuntimeError('The Spider stopped in state {}, which is not a trigger of the {} events of the batch, '
+                               'so the attempt that missed its trigger is unknown'.format(state, len(self.events)))
+        return bisect_right(self.starts, state) - 1
+
+    def attempt_events(self, index):
+        """
+        :return: the number of events of an attempt
+        """
+        end = self.starts[index + 1] if index + 1 < len(self.starts) else len(self.events)
+        return end - self.starts[index]
+
+
+class ResponseDemultiplexer:
+    """
+    Reads the responses of a batch from a ``FramedReader`` on a thread, and splits them over the attempts.
+    """
+
+    def __init__(self, reader, idle, period=None, offset=0.0, length=None, tolerance=0.25, poll_interval=0.01):
+        """
+        :param reader: the ``FramedReader`` of the target
+        :param idle: a response ends when the target is silent for this many seconds. Must be shorter than the
+            time between the responses of two attempts.
+        :param period: seconds between the starts of two attempts, see ``fit``
+        :param offset: seconds from the start of the batch until the end of the first response
+        :param length: the number of bytes of a normal response, a frame of more than 1.5 times as many bytes is
+            ambiguous. See ``fit``, None to not check.
+        :param tolerance: fraction of the period a frame may end from where a response is expected, beyond it the
+            attempts on both sides are ambiguous
+        :param poll_interval: how long the thread waits for a response before it checks whether it should stop
+        """
+        self.reader = reader
+        self.idle = idle
+        self.period = period
+        self.offset = offset
+        self.length = length
+        self.tolerance = tolerance
+        self.poll_interval = poll_interval
+        self.frames = []
+        self.started = 0.0
+        self._tail = 0.0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start reading responses, just before the program is started.
+        """
+        self.frames = []
+        self._running = True
+        self.started = perf_counter()
+        self._thread = Thread(target=self._read, name='demultiplexer', daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        while True:
+            running = self._running
+            bursts = self.reader.read_bursts(self.idle, timeout=self.poll_interval if running else self._tail)
+            self.frames.extend(bursts)
+            if not bursts and not running:
+                return
+
+    def stop(self, tail=0.0):
+        """
+        Stop reading when no response arrives for ``tail`` seconds, after the program finished.
+        """
+        self._tail = tail
+        self._running = False
+        self._thread.join()
+
+    def responses(self, count):
+        """
+        :param count: the number of attempts that ran
+        :return: a (responses, ambiguous) tuple: the response of every attempt, and the set of the indices of the
+            attempts whose response may belong to another attempt
+        """
+        responses = [b''] * count
+        frames = [0] * count
+        ambiguous = set()
+        if len(self.frames) > count:
+            # More responses than attempts: the calibration does not hold for this batch
+            ambiguous.update(range(count))
+        elif self.period is None and len(self.frames) != count:
+            # In order is only right when every attempt responded
+            ambiguous.update(range(count))
+        for index, (frame, end) in enumerate(self.frames):
+            if self.period is not None:
+                position = (end - self.started - self.offset) / self.period
+                index = int(round(position))
+                if not 0 <= index < count:
+                    ambiguous.add(min(max(index, 0), count - 1))
+                elif abs(position - index) > self.tolerance:
+                    # Between two slots: a late response of one attempt or an early one of the next
+                    ambiguous.update(i for i in (index, index + (1 if position > index else -1)) if 0 <= i < count)
+            index = min(max(index, 0), count - 1)
+            responses[index] += frame
+            frames[index] += 1
+            if self.length and len(frame) > 1.5 * self.length:
+                # Likely the responses of this attempt and of the attempts without one before it, read together
+                ambiguous.add(index)
+                before = index - 1
+                while before >= 0 and not frames[before]:
+                    ambiguous.add(before)
+                    before -= 1
+        for index, received in enumerate(frames):
+            if received > 1:
+                # The response of a neighbour, or a response split at a pause of the target
+                ambiguous.update(i for i in (index - 1, index, index + 1) if 0 <= i < count)
+        return responses, ambiguous
+
+    def fit(self, count):
+        """
+        Set the period, offset and length from the responses of a batch in which every attempt responded.
+
+        :param count: the number of attempts of the batch
+        :return: the (period, offset) in seconds
+        :raises ValueError: when the number of responses differs from the number of attempts
+        """
+        if len(self.frames) != count or count < 2:
+            raise ValueError('Got {} responses for {} attempts, calibration needs one response for each of at least '
+                             'two attempts'.format(len(self.frames), count))
+        ends = [end - self.started for _, end in self.frames]
+        mean_index = (count - 1) / 2.0
+        mean_end = sum(ends) / count
+        self.period = (sum((i - mean_index) * (end - mean_end) for i, end in enumerate(ends)) /
+                       sum((i - mean_index) ** 2 for i in range(count)))
+        self.offset = mean_end - self.period * mean_index
+        self.length = max(len(frame) for frame, _ in self.frames)
+        return self.period, self.offset
+
+
+class BatchCampaign(Campaign):
+    """
+    Runs the attempts of a campaign in batches, with one Chronology program per batch.
+    """
+
+    def __init__(self, util, glitcher, target, arm, classify, record, batch_size=64, idle=0.003, gap=0.0, tail=0.05,
+                 **kwargs):
+        """
+        :param target: the ``FramedReader`` of the target
+        :param batch_size: number of attempts per program
+        :param idle: a response ends when the target is silent for this many seconds
+        :param gap: seconds waited after every attempt, for its response
+        :param tail: seconds to wait for the response of the last attempt after the Spider finished
+        :param kwargs: the optional stages and settings of ``Campaign``
+        """
+        super().__init__(util, glitcher, target, arm, None, classify, record, **kwargs)
+        self.batch_size = batch_size
+        self.gap = gap
+        self.tail = tail
+        self.demultiplexer = ResponseDemultiplexer(target, idle)
+        self.batches = 0
+        self.ambiguous = 0
+
+    def calibrate(self, p, count=None, tries=3):
+        """
+        Measure the period and response time of an attempt, with parameters that do not fault the target.
+
+        :param p: the parameters of every attempt of the calibration batch
+        :param count: number of attempts, defaults to ``batch_size``
+        :param tries: number of calibration batches to try, e.g. when the host missed the pause between two
+            responses
+        :return: the (period, offset) in seconds
+        :raises RuntimeError: when the Spider does not finish the batch, or its end state is not the number of events
+            of the batch, so the state does not tell which attempt missed its trigger
+        """
+        program = BatchProgram()
+        for _ in range(count or self.batch_size):
+            program.add_attempt(self.arm, p, self.gap)
+        for attempt in range(tries):
+            if self._run_program(program, {}, perf_counter_ns()):
+                raise RuntimeError('The Spider did not finish the calibration batch, check the trigger')
+            state = self.glitcher.get_current_state()
+            if state != len(program.events):
+                raise RuntimeError('The Spider ended the calibration batch in state {} instead of {}, its states are '
+                                   'not the events of the program'.format(state, len(program.events)))
+            try:
+                period, offset = self.demultiplexer.fit(len(program.starts))
+                break
+            except ValueError:
+                if attempt == tries - 1:
+                    raise
+        print('Calibrated: an attempt every {:.3f} ms, first response after {:.3f} ms'.format(
+            period * 1000, offset * 1000))
+        return period, offset
+
+    def _run_program(self, program, times, t):
+        self.target.reset_input_buffer()
+        self.target.reset_output_buffer()
+        t = self._lap(times, 'reset', t)
+        program.load(self.glitcher)
+        self.uploads += 1
+        t = self._lap(times, 'upload', t)
+        self.demultiplexer.start()
+        self.glitcher.start()
+        t = self._lap(times, 'start', t)
+        spider_timeout = self.glitcher.wait_until_finish(self.finish_timeout)
+        t = self._lap(times, 'finish', t)
+        self.demultiplexer.stop(self.tail)
+        self._lap(times, 'read', t)
+        return spider_timeout
+
+    @staticmethod
+    def _lap(times, stage, start):
+        now = perf_counter_ns()
+        times[stage] = now - start
+        return now
+
+    def _accepted(self, parameters):
+        for p in parameters:
+            if self.sample is not None:
+                p = self.sample(p)
+            if self.accept is None or self.accept(p):
+                yield p
+
+    def _loop(self, parameters, submit):
+        source = self._accepted(parameters)
+        pending = deque()
+        while True:
+            batch = [pending.popleft() for _ in range(min(len(pending), self.batch_size))]
+            batch += itertools.islice(source, self.batch_size - len(batch))
+            if not batch or not self.util.process_commands():
+                break
+            for attempt in self.execute_batch(batch, pending):
+                self.counter += 1
+                submit(attempt)
+
+    def execute_batch(self, parameters, pending):
+        """
+        Run a batch of attempts.
+
+        :param parameters: the parameters of the attempts
+        :param pending: the parameters of the attempts after a missing trigger are put in front of this deque
+        :return: the attempts that ran
+        """
+        start = time()
+        times = {}
+        t = perf_counter_ns()
+        program = BatchProgram()
+        for p in parameters:
+            program.add_attempt(self.arm, p, self.gap)
+        t = self._lap(times, 'arm', t)
+        spider_timeout = self._run_program(program, times, t)
+        self.batches += 1
+
+        ran = len(parameters)
+        state = None
+        if spider_timeout:
+            state = self.glitcher.get_current_state()
+            ran = program.attempt_at(state) + 1
+            pending.extendleft(reversed(parameters[ran:]))
+        responses, ambiguous = self.demultiplexer.responses(ran)
+        self.ambiguous += len(ambiguous)
+        end = time()
+
+        attempts = []
+        for index in range(ran):
+            attempt = Attempt(self.counter + index, start + (end - start) * index / ran, parameters[index])
+            attempt.end = start + (end - start) * (index + 1) / ran
+            attempt.response = responses[index]
+            attempt.ambiguous = index in ambiguous
+            attempt.spider_timeout = spider_timeout and index == ran - 1
+            if self.read_state:
+                if attempt.spider_timeout:
+                    attempt.state = state - program.starts[index]
+                else:
+                    attempt.state = program.attempt_events(index)
+            attempt.times = {stage: ns // ran for stage, ns in times.items()}
+            attempts.append(attempt)
+        return attempts
+
+    def report(self):
+        """
+        Print how many batches ran, and what ``Campaign.report`` prints.
+        """
+        if self.batches:
+            print('{} batches, {:.1f} attempts per batch, {} attempts with an ambiguous response'.format(
+                self.batches, self.counter / self.batches, self.ambiguous))
+        super().report()
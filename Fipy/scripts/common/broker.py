@@ -0,0 +1,425 @@
+'''Keep the Spider and the target open between script runs.
+
+Every run of a script opens the Spider and target ports, resets the settings of the Spider and creates a
+Chronology, which takes seconds, and fails when an earlier run did not close a port. ``DeviceBroker`` is a process
+that opens them once and serves them to the scripts over a local socket (``multiprocessing.connection``), so a run
+starts with a warm Spider. Run it from the scripts directory, it stays up until it is stopped with Ctrl+C:
+
+    python -m common.broker COM42 COM43 --baudrate 115200 --timeout 0.5
+    python -m common.broker --simulate
+
+The target port is read by a ``FramedReader`` in the broker, so responses are split next to the port. A script
+gets stand-ins for the Chronology and the reader, and the byte counters of the Spider port for ``Campaign``:
+
+>>> glitcher, serial_target, spider_com_port = connect_broker(util, ('localhost', 6010))
+>>> campaign = Campaign(util, glitcher, serial_target, arm, read, classify, record, transport=spider_com_port)
+
+Every call is a round trip to the broker, except for the event methods of the Chronology (``set_gpio``, ``glitch``,
+...), which are sent along with the next other call. Uploading a program and starting it is one round trip, and an
+error of an event is raised by that next call. Errors of the broker are raised as ``RuntimeError`` with its
+traceback.
+
+One script at a time uses the devices: a script that connects while another is connected waits until it
+disconnected. When a script connects, the events of the previous one are forgotten, the target buffers are cleared
+and the timeout and baudrate of the target are set back to those of the broker command line, also when it crashed.
+``connect_broker`` then sets the baudrate of the script, when it differs. When a port fails, the broker closes the devices and opens them again for the next
+call.
+
+Calls are pickled, so anyone with the authkey can run code in the broker and drive the devices. The broker only
+listens on localhost, and generates a random authkey when it starts, which it writes to ``~/.fipy/broker-<port>.key``
+with only user access and removes when it stops. ``connect_broker`` reads the key from that file, or takes it in hex
+from the ``FIPY_BROKER_AUTHKEY`` environment variable, which the broker then also uses. Only ``fifth_script.py``,
+``fourth_script.py`` and ``demo_setup_spider_pinata_vccfi.py`` have a ``BROKER_ADDRESS`` option.
+'''
+
+import argparse
+import os
+import secrets
+import traceback
+import uuid
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from threading import Condition, Lock, Thread
+from time import perf_counter
+
+import serial
+
+from common.campaign import open_spider, open_spider_port, open_target
+from common.orchestrator import BenchUtil
+from common.serialreader import open_framed_reader
+
+ADDRESS = ('localhost', 6010)
+# The authkey in hex, instead of the key file of the broker
+AUTHKEY_VARIABLE = 'FIPY_BROKER_AUTHKEY'
+
+# The Chronology methods that only add an event, sent with the next other call
+EVENTS = frozenset(['forget_events', 'set_gpio', 'set_vcc', 'wait_time', 'wait_trigger', 'glitch'])
+
+_METHOD = '<method>'
+
+
+def key_path(port):
+    """
+    :return: the file with the authkey of the broker listening on ``port``
+    """
+    return os.path.join(os.path.expanduser('~'), '.fipy', 'broker-{}.key'.format(port))
+
+
+def new_authkey():
+    """
+    :return: the authkey of ``AUTHKEY_VARIABLE`` when it is set, otherwise a random one
+    """
+    if os.environ.get(AUTHKEY_VARIABLE):
+        return bytes.fromhex(os.environ[AUTHKEY_VARIABLE])
+    return secrets.token_bytes(32)
+
+
+def write_authkey(path, authkey):
+    """
+    Write the authkey to a file that only the user can read, replacing the key of an earlier broker.
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    # Created with user access only, before the key is in it
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(authkey.hex())
+    os.replace(temporary, path)
+
+
+def read_authkey(port):
+    """
+    :return: the authkey of ``AUTHKEY_VARIABLE`` when it is set, otherwise the one of the broker on ``port``
+    :raises RuntimeError: when the broker did not write a key
+    """
+    if os.environ.get(AUTHKEY_VARIABLE):
+        return bytes.fromhex(os.environ[AUTHKEY_VARIABLE])
+    path = key_path(port)
+    try:
+        with open(path) as f:
+            return bytes.fromhex(f.read().strip())
+    except FileNotFoundError:
+        raise RuntimeError('No authkey of a device broker on port {} in {}, is it running?'.format(port, path))
+
+
+def serial_devices(spider_port, target_port, baudrate, timeout):
+    """
+    :return: a function that opens the Spider and the target, for ``DeviceBroker``
+    """
+    def open_devices(util):
+        transport = open_spider_port(util, spider_port)
+        glitcher = open_spider(transport)
+        reader = open_framed_reader(util, open_target(util, target_port, baudrate, timeout))
+        return glitcher, reader, transport
+    return open_devices
+
+
+def simulated_devices(seed=None):
+    """
+    :return: a function that creates a realtime simulated Spider and target, for ``DeviceBroker``
+    """
+    def open_devices(util):
+        from common.simulation import FaultModel, SimulatedChronology
+
+        glitcher, target = SimulatedChronology.with_target(FaultModel(seed=seed), timeout=0.01, realtime=True)
+        return glitcher, open_framed_reader(util, target), None
+    return open_devices
+
+
+class DeviceBroker:
+    """
+    Owns the Spider and the target, and runs the calls of the connected script on them.
+    """
+
+    def __init__(self, open_devices, address=ADDRESS, authkey=None, key_file=None):
+        """
+        :param open_devices: function ``(util) -> (glitcher, reader, transport)`` that opens the devices and adds
+            their closing to the cleanup of ``util``, e.g. from ``serial_devices``. The transport, the port of the
+            Spider, can be None.
+        :param address: the (host, port) to listen on
+        :param authkey: the key the scripts must connect with, by default from ``new_authkey``
+        :param key_file: the file the key is written to while the broker runs, by default ``key_path`` of the port
+        """
+        self.open_devices = open_devices
+        self.address = address
+        self.authkey = new_authkey() if authkey is None else authkey
+        self.key_file = key_path(address[1]) if key_file is None else key_file
+        self.sessions = 0
+        self.opened = 0
+        self._util = None
+        self._devices = None
+        self._defaults = None
+        self._lock = Lock()
+        self._session = Condition()
+        self._owner = None
+        self._connections = 0
+
+    def devices(self):
+        """
+        :return: dict of device name to the opened device, opening them when they are not open
+        """
+        with self._lock:
+            if self._devices is None:
+                start = perf_counter()
+                util = BenchUtil()
+                try:
+                    glitcher, reader, transport = self.open_devices(util)
+                except BaseException:
+                    util.close()
+                    raise
+                self._util = util
+                self._devices = {'glitcher': glitcher, 'target': reader, 'transport': transport}
+                # The settings a script can change, restored for the next one
+                self._defaults = {'timeout': reader.timeout, 'baudrate': reader.baudrate}
+                self.opened += 1
+                print('Devices opened in {:.2f} s'.format(perf_counter() - start))
+            return self._devices
+
+    def close_devices(self):
+        """
+        Close the devices, they are opened again by the next call.
+        """
+        with self._lock:
+            if self._util is not None:
+                try:
+                    self._util.close()
+                except Exception:
+                    traceback.print_exc()
+            self._util = None
+            self._devices = None
+
+    def serve_forever(self):
+        """
+        Open the devices and serve scripts until interrupted.
+        """
+        self.devices()
+        with Listener(self.address, authkey=self.authkey) as listener:
+            write_authkey(self.key_file, self.authkey)
+            print('Device broker listening on {}:{}, authkey in {}'.format(*listener.address, self.key_file))
+            try:
+                while True:
+                    try:
+                        connection = listener.accept()
+                    except (AuthenticationError, OSError, EOFError) as e:
+                        # A client with the wrong authkey, or one that gave up
+                        print('Refused a connection: {}'.format(e))
+                        continue
+                    Thread(target=self._serve, args=(connection,), name='broker-connection', daemon=True).start()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                try:
+                    os.remove(self.key_file)
+                except OSError:
+                    pass
+                self.close_devices()
+
+    def _acquire(self, owner):
+        with self._session:
+            self._session.wait_for(lambda: self._owner in (None, owner))
+            if self._owner is None:
+                self._owner = owner
+                self.sessions += 1
+                self._reset()
+            self._connections += 1
+
+    def _release(self):
+        with self._session:
+            self._connections -= 1
+            if not self._connections:
+                self._owner = None
+                self._session.notify_all()
+
+    def _reset(self):
+        """
+        Clear what the previous script left behind, and restore the target settings it changed.
+        """
+        try:
+            devices = self.devices()
+            devices['glitcher'].forget_events()
+            target = devices['target']
+            for name, value in self._defaults.items():
+                if getattr(target, name) != value:
+                    setattr(target, name, value)
+            target.reset_input_buffer()
+            target.reset_output_buffer()
+        except Exception:
+            # The next call opens the devices again, or gets the error
+            traceback.print_exc()
+            self.close_devices()
+
+    def _serve(self, connection):
+        with connection:
+            try:
+                owner, device = connection.recv()
+            except (EOFError, OSError):
+                return
+            self._acquire(owner)
+            try:
+                while True:
+                    try:
+                        request = connection.recv()
+                    except (EOFError, OSError):
+                        return
+                    connection.send(self._call(device, *request))
+            finally:
+                self._release()
+
+    def _call(self, device, name, args, kwargs, events):
+        transport = None
+        try:
+            devices = self.devices()
+            transport = devices['transport']
+            glitcher = devices['glitcher']
+            for event, event_args, event_kwargs in events:
+                getattr(glitcher, event)(*event_args, **event_kwargs)
+            target = devices[device]
+            if name == '__getattr__':
+                value = getattr(target, args[0])
+                result = _METHOD if callable(value) else value
+            elif name == '__setattr__':
+                result = setattr(target, *args)
+            else:
+                result = getattr(target, name)(*args, **kwargs)
+            return 'ok', result, _transferred(transport)
+        except (serial.SerialException, OSError):
+            error = traceback.format_exc()
+            self.close_devices()
+        except Exception:
+            error = traceback.format_exc()
+        return 'error', error, _transferred(transport)
+
+
+def _transferred(transport):
+    if transport is None:
+        return 0, 0
+    return getattr(transport, 'bytes_written', 0), getattr(transport, 'bytes_read', 0)
+
+
+class SpiderCounters:
+    """
+    The bytes written to and read from the Spider port by the broker, updated with every reply.
+    """
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+
+class RemoteDevice:
+    """
+    A device of a ``DeviceBroker``, with the methods and attributes of the device.
+    """
+
+    def __init__(self, address, authkey, owner, device, counters, events=()):
+        """
+        :param owner: the id of the script, the devices of one script can be used at the same time
+        :param device: 'glitcher' or 'target'
+        :param counters: the ``SpiderCounters`` to update
+        :param events: names of methods that are sent with the next other call
+        """
+        self._device = device
+        self._counters = counters
+        self._events = frozenset(events)
+        self._pending = []
+        self._methods = {}
+        self._lock = Lock()
+        self._connection = Client(address, authkey=authkey)
+        self._connection.send((owner, device))
+
+    def _call(self, name, args=(), kwargs=None):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._connection.send((name, args, kwargs or {}, pending))
+            status, result, transferred = self._connection.recv()
+        self._counters.bytes_written, self._counters.bytes_read = transferred
+        if status == 'error':
+            raise RuntimeError('The device broker failed to run {}.{}:\n{}'.format(self._device, name, result))
+        return result
+
+    def _method(self, name):
+        if name in self._events:
+            def method(*args, **kwargs):
+                with self._lock:
+                    self._pending.append((name, args, kwargs))
+        else:
+            def method(*args, **kwargs):
+                return self._call(name, args, kwargs)
+        return method
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = self._methods.get(name)
+        if method is not None:
+            return method
+        if name not in self._events:
+            value = self._call('__getattr__', (name,))
+            if value != _METHOD:
+                return value
+        method = self._methods[name] = self._method(name)
+        return method
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            self._call('__setattr__', (name, value))
+
+    def close(self):
+        """
+        Disconnect from the broker. Events that were not sent yet are dropped.
+        """
+        self._connection.close()
+
+
+def connect_broker(util, address=ADDRESS, authkey=None, baudrate=None):
+    """
+    Use the Spider and target of a ``DeviceBroker``, and disconnect on cleanup. The first call waits while
+    another script uses them.
+
+    :param util: the fipy script util
+    :param address: the (host, port) of the broker
+    :param authkey: the key of the broker, by default from ``read_authkey``
+    :param baudrate: the target baudrate of the script, set on the target when it differs from the one of the
+        broker command line. The broker sets it back for the next script.
+    :return: a (glitcher, target, transport) tuple: the Chronology, the ``FramedReader`` of the target and the
+        byte counters of the Spider port
+    """
+    if authkey is None:
+        authkey = read_authkey(address[1])
+    owner = uuid.uuid4().hex
+    counters = SpiderCounters()
+    glitcher = RemoteDevice(address, authkey, owner, 'glitcher', counters, events=EVENTS)
+    util.add_to_cleanup(glitcher.close)
+    target = RemoteDevice(address, authkey, owner, 'target', counters)
+    util.add_to_cleanup(target.close)
+    if baudrate is not None and target.baudrate != int(baudrate):
+        target.baudrate = int(baudrate)
+    return glitcher, target, counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the Spider and the target open and serve them to scripts.')
+    parser.add_argument('spider_port', nargs='?', help='the Spider COM port')
+    parser.add_argument('target_port', nargs='?', help='the target COM port')
+    parser.add_argument('--baudrate', type=int, default=115200, help='the target baudrate')
+    parser.add_argument('--timeout', type=float, default=0.5, help='the default target read timeout in seconds')
+    parser.add_argument('--simulate', action='store_true', help='serve a simulated Spider and target instead')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the simulated target')
+    parser.add_argument('--port', type=int, default=ADDRESS[1], help='the local port to listen on')
+    args = parser.parse_args()
+
+    if args.simulate:
+        open_devices = simulated_devices(args.seed)
+    elif args.spider_port and args.target_port:
+        open_devices = serial_devices(args.spider_port, args.target_port, args.baudrate, args.timeout)
+    else:
+        parser.error('give the Spider and target ports, or --simulate')
+    broker = DeviceBroker(open_devices, (ADDRESS[0], args.port))
+    broker.serve_forever()
+    print('Served {} scripts, opened the devices {} times'.format(broker.sessions, broker.opened))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+'''Shared campaign loop for the Spider glitch scripts.
+
+Every Spider script runs the same iteration: clear the target's serial buffers, program the Chronology
+events, start the state machine, read the target's response, wait for the Spider to finish, classify the
+outcome, and log it. ``Campaign`` owns that loop; the scripts only provide the stages that differ:
+
+* ``arm(glitcher, p)`` adds the Chronology events (reset sequence, triggers, glitches) for parameters ``p``
+* ``read(target, p)`` reads the response of the target
+* ``classify(attempt)`` returns the ``ResultColor`` of an attempt
+* ``record(attempt)`` returns the result row as a list of ``(name, value)`` tuples
+* ``accept(p)`` (optional) returns False to skip parameters without running an attempt
+* ``sample(p)`` (optional) returns the parameters to use instead of ``p``, e.g. drawn from a ``PolygonRegion``
+* ``observe(attempt)`` (optional) is called with every classified attempt, e.g. to feed a ``ThompsonSearch``
+
+With ``pipelined=True`` the classify and record stages and the database write of an attempt run on a worker
+thread, while the main thread already arms and runs the next attempt. Rows are still written in attempt order.
+``util.monitor`` stays on the main thread: it updates the fipy UI, so the main thread passes it the rows the worker
+thread has written, before every attempt and at the end. Only use this when ``arm`` does not depend on the outcome
+of the previous attempt, and with a ``sink`` that accepts rows from another thread, e.g. ``SQLiteResultSink``: the
+fipy database is not known to accept writes from another thread. The observe stage runs on the worker thread as
+well, so an adaptive sample stage sees outcomes a few attempts late.
+
+With a ``sink`` (see ``common.results``) the result rows are written to it in batches instead of with ``db.add``.
+
+Every attempt measures the duration of its stages with ``perf_counter_ns`` in ``Attempt.times``: reset (clear
+the target buffers), arm, upload (the Chronology events), start, read, finish (wait for the Spider), state,
+classify, record, monitor and store. With ``timing=True`` the stages up to classify are added to the result row as
+'<stage> (us)' columns, and a latency histogram of all stages is printed at the end of the campaign.
+
+The events added by ``arm`` are recorded in a ``ChronologyProgram`` on the host and then uploaded to the Spider,
+all of them for every attempt, as the Chronology calls the scripts use only add events. With a ``transport`` the
+bytes sent to and received from the Spider are counted, and reported per attempt. To send fewer bytes per attempt,
+run several attempts per program with ``common.batch``.
+
+Usage example:
+
+>>> spider_com_port = open_spider_port(util, PARAMETERS['spider_com_port'])
+>>> glitcher = open_spider(spider_com_port)
+>>> serial_target = open_target(util, PARAMETERS['serial_com_port'],
+...                             PARAMETERS['serial_baudrate'], PARAMETERS['serial_timeout'])
+>>> campaign = Campaign(util, glitcher, serial_target, arm, read, classify, record, finish_timeout=2000)
+>>> campaign.run(PARAMETERS, db)
+'''
+
+from queue import Empty, Queue, SimpleQueue
+from threading import Thread
+from time import perf_counter_ns, time
+
+import serial
+
+from common.serialreader import read_bytes
+from common.timing import StageTimes
+
+
+class CountingSerial(serial.Serial):
+    """
+    Serial port that counts the bytes it transfers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.bytes_written = 0
+        self.bytes_read = 0
+        super().__init__(*args, **kwargs)
+
+    def write(self, data):
+        written = super().write(data)
+        self.bytes_written += len(data) if written is None else written
+        return written
+
+    def read(self, size=1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def open_spider_port(util, port):
+    """
+    Open the serial port of the Spider.
+
+    :param util: the fipy script util, used to close the port on cleanup
+    :param port: the Spider COM port
+    :return: the opened port, counting the bytes sent to and received from the Spider
+    """
+    spider_com_port = CountingSerial()
+    spider_com_port.port = str(port)
+    spider_com_port.open()
+    util.add_to_cleanup(spider_com_port.close)
+    return spider_com_port
+
+
+def open_spider(spider_com_port):
+    """
+    Reset the settings of the Spider and create a Chronology without events.
+
+    :param spider_com_port: the opened Spider port, see ``open_spider_port``
+    :return: the Chronology for Spider core 1
+    """
+    from spidersdk.chronology import Chronology
+    from spidersdk.spider import Spider
+
+    spider_core1 = Spider(Spider.CORE1, spider_com_port)
+    spider_core1.reset_settings()
+
+    try:
+        glitcher = Chronology(spider_core1)
+    except IndexError as e:
+        raise Exception(str(e) +
+                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
+
+    glitcher.forget_events()  # Forget any previous added events
+    return glitcher
+
+
+def open_target(util, port, baudrate, timeout):
+    """
+    Open the serial connection to the target and clear its buffers.
+
+    :param util: the fipy script util, used to close the port on cleanup
+    :param port: the target COM port
+    :param baudrate: the target baudrate
+    :param timeout: the read timeout in seconds
+    :return: the opened serial port
+    """
+    serial_target = serial.Serial()
+    serial_target.baudrate = int(baudrate)
+    serial_target.timeout = float(timeout)
+    serial_target.port = str(port)
+    serial_target.open()
+    serial_target.reset_input_buffer()
+    serial_target.reset_output_buffer()
+    util.add_to_cleanup(serial_target.close)
+    return serial_target
+
+
+def arm_reset(glitcher, glitch_out, reset_out, normal_vcc, trigger_out=None):
+    """
+    Add the events that power cycle and reset the target to the Chronology.
+
+    Sleeps might require manual tuning, based on device.
+
+    :param trigger_out: optional GPIO that is driven low during the reset and high afterwards
+    """
+    glitcher.set_gpio(reset_out, 0)
+    glitcher.set_vcc(glitch_out, 0)
+    if trigger_out is not None:
+        glitcher.set_gpio(trigger_out, 0)
+
+    glitcher.wait_time(0.1e-3)
+    glitcher.set_gpio(reset_out, 1)
+
+    glitcher.set_vcc(glitch_out, normal_vcc)
+    if trigger_out is not None:
+        glitcher.set_gpio(trigger_out, 1)
+
+
+def read_response(target, size, idle=None):
+    """
+    Read the response of the target and print it.
+
+    :param size: the number of bytes to read. One more byte is read if the response contains a NUL byte, which
+        happens frequently after a reset.
+    :param idle: with a ``FramedReader`` as target, stop reading when the target is silent for this many seconds
+        instead of waiting for the read timeout
+    :return: the response
+    """
+    response = read_bytes(target, size, idle=idle)
+    if b'\x00' in response:
+        response = response + read_bytes(target, 1, idle=idle, wait_first=False)
+    print(response)
+    print(len(response))
+    return response
+
+
+class ChronologyProgram:
+    """
+    Chronology events recorded on the host before they are sent to the Spider, e.g. to run the events of several
+    attempts in one program. Supports the event methods of ``Chronology`` used by the ``arm`` stages.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def _add(self, name, args, kwargs):
+        self.events.append((name, args, tuple(sorted(kwargs.items()))))
+
+    def set_gpio(self, *args, **kwargs):
+        self._add('set_gpio', args, kwargs)
+
+    def set_vcc(self, *args, **kwargs):
+        self._add('set_vcc', args, kwargs)
+
+    def wait_time(self, *args, **kwargs):
+        self._add('wait_time', args, kwargs)
+
+    def wait_trigger(self, *args, **kwargs):
+        self._add('wait_trigger', args, kwargs)
+
+    def glitch(self, *args, **kwargs):
+        self._add('glitch', args, kwargs)
+
+    def load(self, glitcher):
+        """
+        Replace the events of the Chronology with the recorded ones.
+        """
+        glitcher.forget_events()
+        for name, args, kwargs in self.events:
+            getattr(glitcher, name)(*args, **dict(kwargs))
+
+
+class Attempt:
+    """
+    The state of one campaign iteration, passed to the classify and record stages.
+    """
+
+    def __init__(self, id, t, parameters):
+        self.id = id
+        self.t = t
+        self.parameters = parameters
+        self.response = b''
+        self.spider_timeout = False
+        self.state = None
+        self.color = None
+        self.end = None
+        self.spider_bytes = 0
+        self.times = {}
+        # The response may belong to another attempt, see ``common.batch``
+        self.ambiguous = False
+
+    def lap(self, stage, start):
+        """
+        Store the duration of a stage.
+
+        :param start: the ``perf_counter_ns`` at the start of the stage
+        :return: the ``perf_counter_ns`` now, the start of the next stage
+        """
+        now = perf_counter_ns()
+        self.times[stage] = now - start
+        return now
+
+    def elapsed_ms(self):
+        """
+        Duration of the iteration in milliseconds: until 'end' if it is set, otherwise until now.
+        """
+        end = time() if self.end is None else self.end
+        return int((end - self.t) * 1000)
+
+
+class Campaign:
+    """
+    Runs the per-iteration loop of a Spider glitch campaign.
+    """
+
+    def __init__(self, util, glitcher, target, arm, read, classify, record, accept=None,
+                 finish_timeout=1000, read_state=False, row_factory=None, pipelined=False, queue_size=64,
+                 transport=None, sample=None, observe=None, sink=None, timing=False):
+        """
+        :param util: the fipy script util
+        :param glitcher: the Spider Chronology
+        :param target: the serial connection to the target
+        :param arm: stage that adds the Chronology events for an attempt
+        :param read: stage that reads the response of the target
+        :param classify: stage that returns the color of an attempt
+        :param record: stage that returns the result row of an attempt as (name, value) tuples
+        :param accept: optional stage that returns False for parameters that should be skipped
+        :param finish_timeout: timeout passed to ``Chronology.wait_until_finish``
+        :param read_state: also store ``Chronology.get_current_state()`` in the attempt. This costs a Spider
+            round trip, so it is off by default.
+        :param row_factory: converts a result row to the object passed to ``util.monitor`` and the database,
+            defaults to fipy ``Parameters``
+        :param pipelined: classify, record and store attempts on a worker thread
+        :param queue_size: maximum number of attempts waiting for the worker thread before the loop blocks
+        :param transport: the ``CountingSerial`` of the Spider, to report the bytes transferred per attempt
+        :param sample: optional stage that returns the parameters to use instead of the iterated ones
+        :param observe: optional stage that is called with every classified attempt
+        :param sink: optional result sink with an ``add(row)`` method, used instead of ``db.add``
+        :param timing: add the stage durations to the result rows and print their histograms at the end
+        """
+        self.util = util
+        self.glitcher = glitcher
+        self.target = target
+        self.arm = arm
+        self.read = read
+        self.classify = classify
+        self.record = record
+        self.accept = accept
+        self.finish_timeout = finish_timeout
+        self.read_state = read_state
+        if row_factory is None:
+            from fipy.parameters import Parameters
+
+            def row_factory(row):
+                return Parameters(*row)
+        self.row_factory = row_factory
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.transport = transport
+        self.sample = sample
+        self.observe = observe
+        self.sink = sink
+        self.timing = timing
+        self.stage_times = StageTimes()
+        self.counter = 0
+        self.uploads = 0
+
+    def run(self, parameters, db):
+        """
+        Run one attempt for each set of parameters until they run out or the user stops the script.
+
+        :param parameters: the parameters to iterate over, normally the script's PARAMETERS
+        :param db: the result database, rows are added with ``db.add`` unless the campaign has a sink
+        """
+        try:
+            if self.pipelined:
+                pipeline = _Pipeline(self, db, self.queue_size)
+                try:
+                    self._loop(parameters, pipeline.submit)
+                finally:
+                    pipeline.close()
+            else:
+                self._loop(parameters, lambda attempt: self.log(attempt, db))
+        finally:
+            if self.sink is not None:
+                self.sink.flush()
+        self.report()
+
+    def _loop(self, parameters, submit):
+        for p in parameters:
+            if self.sample is not None:
+                p = self.sample(p)
+            if self.accept is not None and not self.accept(p):
+                continue
+            attempt = Attempt(self.counter, time(), p)
+            if not self.util.process_commands():
+                break
+            self.execute(attempt)
+            self.counter += 1
+            submit(attempt)
+
+    def execute(self, attempt):
+        """
+        Program the Spider and run the attempt.
+        """
+        glitcher = self.glitcher
+        transferred = self._transferred()
+        t = perf_counter_ns()
+        self.target.reset_input_buffer()
+        self.target.reset_output_buffer()
+        t = attempt.lap('reset', t)
+
+        program = ChronologyProgram()
+        self.arm(program, attempt.parameters)
+        t = attempt.lap('arm', t)
+        program.load(glitcher)
+        self.uploads += 1
+        t = attempt.lap('upload', t)
+        glitcher.start()
+        t = attempt.lap('start', t)
+
+        attempt.response = self.read(self.target, attempt.parameters)
+        t = attempt.lap('read', t)
+        attempt.spider_timeout = glitcher.wait_until_finish(self.finish_timeout)
+        t = attempt.lap('finish', t)
+        if self.read_state:
+            attempt.state = glitcher.get_current_state()
+            attempt.lap('state', t)
+        attempt.spider_bytes = self._transferred() - transferred
+
+    def _transferred(self):
+        if self.transport is None:
+            return 0
+        return self.transport.bytes_written + self.transport.bytes_read
+
+    def report(self):
+        """
+        Print how much was sent to the Spider.
+        """
+        if not self.counter:
+            return
+        print('{} attempts, Chronology uploaded {} times'.format(self.counter, self.uploads))
+        if self.transport is not None:
+            print('Spider transport: {} bytes written, {} bytes read, {:.1f} bytes per attempt'.format(
+                self.transport.bytes_written, self.transport.bytes_read, self._transferred() / self.counter))
+        if self.sink is not None:
+            self.sink.report()
+        if self.timing:
+            self.stage_times.report()
+
+    def log(self, attempt, db):
+        """
+        Classify an attempt and send its result row to the database or sink and the monitor.
+        """
+        self.show(attempt, self.store(attempt, db))
+
+    def store(self, attempt, db):
+        """
+        Classify an attempt and send its result row to the database or sink.
+
+        :return: the result row for ``show``
+        """
+        t = perf_counter_ns()
+        attempt.color = self.classify(attempt)
+        if self.observe is not None and not attempt.ambiguous:
+            self.observe(attempt)
+        t = attempt.lap('classify', t)
+        row = self.record(attempt)
+        if self.timing:
+            row = row + [('{} (us)'.format(stage), ns // 1000) for stage, ns in attempt.times.items()]
+        result = self.row_factory(row)
+        t = attempt.lap('record', t)
+        if self.sink is None:
+            db.add(result)
+        else:
+            self.sink.add(row)
+        attempt.lap('store', t)
+        return result
+
+    def show(self, attempt, result):
+        """
+        Send the result row of a stored attempt to the monitor, on the main thread.
+        """
+        t = perf_counter_ns()
+        self.util.monitor(result)
+        attempt.lap('monitor', t)
+        if self.timing:
+            self.stage_times.add_all(attempt.times)
+
+
+class _Pipeline:
+    """
+    Worker thread that stores attempts in the order they are submitted. The main thread shows the stored attempts
+    on the monitor when it submits the next one, and when the pipeline is closed.
+    """
+
+    def __init__(self, campaign, db, queue_size):
+        self._campaign = campaign
+        self._db = db
+        self._queue = Queue(maxsize=queue_size)
+        self._stored = SimpleQueue()
+        self._error = None
+        self._thread = Thread(target=self._work, name='campaign-pipeline', daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            attempt = self._queue.get()
+            if attempt is None:
+                return
+            if self._error is None:
+                try:
+                    self._stored.put((attempt, self._campaign.store(attempt, self._db)))
+                except BaseException as e:
+                    self._error = e
+
+    def _show(self):
+        while True:
+            try:
+                attempt, result = self._stored.get_nowait()
+            except Empty:
+                return
+            self._campaign.show(attempt, result)
+
+    def submit(self, attempt):
+        """Queue an attempt for logging, raising any error of the worker thread."""
+        if self._error is not None:
+            raise self._error
+        self._show()
+        attempt.end = time()
+        self._queue.put(attempt)
+
+    def close(self):
+        """Wait until all queued attempts are logged."""
+        self._queue.put(None)
+        self._thread.join()
+        self._show()
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,226 @@
+'''Columnar result storage in Parquet files.
+
+Analysing a campaign of tens of millions of attempts from its SQLite table means reading every row, even to count
+the colors. ``ParquetResultSink`` writes the same result rows to a directory of Parquet files with typed columns
+(integers, floats, booleans, the response bytes as binary), so reading one column only reads that column.
+
+Every ``chunk_rows`` rows are written to their own file, ``part-00000.parquet``, ``part-00001.parquet`` and so on,
+so the files written before a crash stay readable. ``read_results`` reads the directory back as one Arrow table.
+Run this module to convert an existing SQLite result table:
+
+    python -m common.columnar logs/fifth_script.sqlite fifth_script logs/fifth_script.parquet
+
+pyarrow is optional, it is only imported when Parquet files are written or read:
+
+>>> sink = MultiSink(open_result_sink(util, 'logs/{}.sqlite'.format(script_name), script_name),
+...                  open_parquet_sink(util, 'logs/{}.parquet'.format(script_name)))
+>>> campaign = Campaign(..., sink=sink)
+>>> read_results('logs/fifth_script.parquet', columns=['Color']).column('Color').value_counts()
+'''
+
+import argparse
+import os
+import sqlite3
+from threading import Lock
+from time import perf_counter
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet result files need pyarrow, install it with "pip install pyarrow"')
+    return pyarrow
+
+
+class ParquetResultSink:
+    """
+    Writes result rows to a directory of Parquet files.
+    """
+
+    def __init__(self, directory, chunk_rows=65536, compression='zstd'):
+        """
+        :param directory: the output directory, created if it does not exist
+        :param chunk_rows: number of rows per file
+        :param compression: the Parquet compression codec
+        """
+        self._pa = _pyarrow()
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        os.makedirs(directory, exist_ok=True)
+        self._parts = len([name for name in os.listdir(directory) if name.endswith('.parquet')])
+        self._lock = Lock()
+        self._columns = None
+        self._positions = None
+        self._buffer = []
+        self.rows = 0
+        self.flush_times = []
+
+    def add(self, row):
+        """
+        Buffer a result row, and write a file when the buffer holds ``chunk_rows`` rows.
+
+        :param row: the result as a list of (name, value) tuples, with the same names for every row
+        """
+        with self._lock:
+            if self._columns is None:
+                positions = {}
+                for i, (name, _) in enumerate(row):
+                    positions.setdefault(name, i)
+                self._columns = list(positions)
+                self._positions = list(positions.values())
+            self._buffer.append([row[i][1] for i in self._positions])
+            if len(self._buffer) >= self.chunk_rows:
+                self._flush()
+
+    def add_rows(self, columns, rows):
+        """
+        Write rows that are already in column order, e.g. from an SQLite cursor.
+
+        :param columns: the column names
+        :param rows: the rows, sequences of values in column order
+        """
+        with self._lock:
+            if self._columns is None:
+                self._columns = list(columns)
+                self._positions = list(range(len(self._columns)))
+            self._buffer.extend(rows)
+            while len(self._buffer) >= self.chunk_rows:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the buffered rows to a file.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        start = perf_counter()
+        chunk, self._buffer = self._buffer[:self.chunk_rows], self._buffer[self.chunk_rows:]
+        table = self._pa.table({name: self._pa.array([row[i] for row in chunk])
+                                for i, name in enumerate(self._columns)})
+        path = os.path.join(self.directory, 'part-{:05d}.parquet'.format(self._parts))
+        self._pa.parquet.write_table(table, path, compression=self.compression)
+        self._parts += 1
+        self.rows += len(chunk)
+        self.flush_times.append(perf_counter() - start)
+
+    def close(self):
+        """
+        Write the buffered rows.
+        """
+        with self._lock:
+            while self._buffer:
+                self._flush()
+
+    def report(self):
+        """
+        Print the number of rows and files written.
+        """
+        if self.flush_times:
+            print('Parquet: {} rows in {} files, {:.1f} ms per file'.format(
+                self.rows, len(self.flush_times), 1000 * sum(self.flush_times) / len(self.flush_times)))
+
+
+def open_parquet_sink(util, directory, **kwargs):
+    """
+    Open a ``ParquetResultSink`` that writes its buffered rows on cleanup.
+
+    :param util: the fipy script util
+    :param kwargs: passed on to ``ParquetResultSink``
+    :return: the sink
+    """
+    sink = ParquetResultSink(directory, **kwargs)
+    util.add_to_cleanup(sink.close)
+    return sink
+
+
+class MultiSink:
+    """
+    Sends result rows to several sinks, e.g. SQLite and Parquet.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def add(self, row):
+        for sink in self.sinks:
+            sink.add(row)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    def report(self):
+        for sink in self.sinks:
+            sink.report()
+
+
+def read_results(directory, columns=None):
+    """
+    Read a directory of Parquet result files.
+
+    Columns that only held None in some files are promoted to the type of the other files.
+
+    :param directory: the directory written by ``ParquetResultSink``
+    :param columns: the columns to read, all columns if None
+    :return: a pyarrow Table
+    """
+    pa = _pyarrow()
+    import pyarrow.dataset
+
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.parquet'))
+    schema = pa.unify_schemas([pa.parquet.read_schema(path) for path in paths], promote_options='permissive')
+    return pyarrow.dataset.dataset(paths, schema=schema, format='parquet').to_table(columns=columns)
+
+
+def convert_sqlite(path, table, directory, chunk_rows=65536, **kwargs):
+    """
+    Convert an SQLite result table to Parquet files.
+
+    :param path: the SQLite database, e.g. 'logs/fifth_script.sqlite'
+    :param table: the result table, normally the script name
+    :param directory: the output directory
+    :param kwargs: passed on to ``ParquetResultSink``
+    :return: the number of rows converted
+    """
+    sink = ParquetResultSink(directory, chunk_rows=chunk_rows, **kwargs)
+    connection = sqlite3.connect(path)
+    try:
+        cursor = connection.execute('SELECT * FROM "{}"'.format(table.replace('"', '""')))
+        columns = [description[0] for description in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            sink.add_rows(columns, rows)
+    finally:
+        connection.close()
+    sink.close()
+    return sink.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert an SQLite result table to Parquet files.')
+    parser.add_argument('database', help='the SQLite database, e.g. logs/fifth_script.sqlite')
+    parser.add_argument('table', help='the result table, normally the script name')
+    parser.add_argument('directory', help='the output directory, e.g. logs/fifth_script.parquet')
+    parser.add_argument('--chunk-rows', type=int, default=65536, help='number of rows per file')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    rows = convert_sqlite(args.database, args.table, args.directory, chunk_rows=args.chunk_rows)
+    print('Converted {} rows in {:.1f} s'.format(rows, perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+'''Run one campaign on several benches in parallel.
+
+A bench is one Spider with its target. ``Orchestrator`` starts one process per bench, which creates the campaign of
+a script for the ports of its bench, and shares the parameters of one campaign between them in chunks. A bench
+asks for a new chunk when it finished the previous one, so a faster bench runs more attempts. The result rows of
+all benches are written to one sink, with a 'bench' column holding the id of the bench. Every bench numbers its
+attempts from 0, so the 'id' column of the rows is renumbered with one counter in the order they are written.
+
+A bench that sends nothing, no result and no progress, for ``stall_timeout`` seconds is stopped, the rest of its
+chunk is given to the next bench that asks for work, and the bench is started again up to ``restarts`` times. A
+bench that fails, e.g. because its port cannot be opened, is not started again. The attempt a bench was running
+when it stalled is run again on another bench.
+
+The campaign is created by a factory ``(util, bench) -> Campaign``, given as 'module:name' so the bench processes
+can import it, e.g. ``fifth_script:bench_campaign``. The benches are a JSON list of dicts with an 'id' and the
+settings the factory needs:
+
+    [{"id": "bench1", "spider_com_port": "COM42", "serial_com_port": "COM43"},
+     {"id": "bench2", "spider_com_port": "COM52", "serial_com_port": "COM53"}]
+
+The parameters are drawn from the settings of the script in the fipy UI. Run from the scripts directory:
+
+    python -m common.orchestrator benches.json fifth_script:bench_campaign fifth_script.py.json --attempts 100000
+    python -m common.orchestrator --simulate 4 --attempts 20000
+'''
+
+import argparse
+import importlib
+import itertools
+import json
+import os
+import random
+import traceback
+from collections import deque
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from threading import Lock
+from time import perf_counter
+
+from common.results import SQLiteResultSink
+
+# The settings types of the fipy UI
+RANDOM = 1
+SWEEP = 2
+
+
+def load_factory(spec):
+    """
+    :param spec: 'module:name' of a function ``(util, bench) -> Campaign``
+    """
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name or 'bench_campaign')
+
+
+def read_settings(path):
+    """
+    :param path: the settings of a script in the fipy UI, e.g. 'fifth_script.py.json'
+    :return: dict of the name to the value of every setting with a single value, e.g. ports and the normal voltage
+    """
+    with open(path) as f:
+        settings = json.load(f)
+    return {name: setting['value'] for name, setting in settings.items() if 'value' in setting}
+
+
+def settings_parameters(path, attempts=None, seed=None):
+    """
+    Parameters like the fipy UI iterates them: random settings are drawn between their min and max for every
+    attempt, swept settings step through every combination of their values, repeated until the attempts run out.
+
+    :param path: the settings of a script in the fipy UI
+    :param attempts: number of parameter sets, defaults to the attempts of the settings
+    :return: an iterator over dicts of parameters
+    """
+    with open(path) as f:
+        settings = json.load(f)
+    if attempts is None:
+        attempts = settings['attempts']['attempts']
+    fixed = read_settings(path)
+    ranges = {name: (setting['min'], setting['max']) for name, setting in settings.items()
+              if setting.get('type') == RANDOM}
+    sweeps = {}
+    for name, setting in settings.items():
+        if setting.get('type') == SWEEP:
+            count = int(round((setting['end'] - setting['start']) / setting['step'])) + 1
+            sweeps[name] = [setting['start'] + i * setting['step'] for i in range(count)]
+    grid = itertools.cycle(itertools.product(*sweeps.values()))
+    rng = random.Random(seed)
+    for _ in range(attempts):
+        p = dict(fixed)
+        for name, (low, high) in ranges.items():
+            if isinstance(low, int) and isinstance(high, int):
+                p[name] = rng.randint(low, high)
+            else:
+                p[name] = rng.uniform(low, high)
+        p.update(zip(sweeps, next(grid)))
+        yield p
+
+
+class BenchUtil:
+    """
+    The fipy script util methods used by ``Campaign``, for a campaign in a bench process.
+    """
+
+    def __init__(self):
+        self.cleanup = []
+
+    def process_commands(self):
+        return True
+
+    def monitor(self, result):
+        pass
+
+    def add_to_cleanup(self, function):
+        self.cleanup.append(function)
+
+    def close(self):
+        """
+        Run the cleanup functions, the last added first.
+        """
+        while self.cleanup:
+            self.cleanup.pop()()
+
+
+class _Channel:
+    """
+    The bench end of the pipe, shared by the campaign loop and the pipeline thread of a campaign.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.connection.send(message)
+
+    def recv(self):
+        return self.connection.recv()
+
+    # The result sink methods used by Campaign
+    def add(self, row):
+        self.send(('row', row))
+
+    def flush(self):
+        pass
+
+    def report(self):
+        pass
+
+
+def _chunks(channel):
+    """
+    Ask the orchestrator for chunks of parameters and iterate over them, reporting the index of every attempt.
+    """
+    while True:
+        channel.send(('ready',))
+        task = channel.recv()
+        if task is None:
+            return
+        chunk_id, parameters = task
+        for index, p in enumerate(parameters):
+            channel.send(('next', chunk_id, index))
+            yield p
+
+
+def _bench_main(spec, bench, connection):
+    channel = _Channel(connection)
+    util = BenchUtil()
+    try:
+        campaign = load_factory(spec)(util, bench)
+        campaign.sink = channel
+        campaign.run(_chunks(channel), None)
+        channel.send(('done', campaign.counter))
+    except BaseException:
+        channel.send(('error', traceback.format_exc()))
+    finally:
+        util.close()
+
+
+class _Bench:
+    """
+    The orchestrator's view of a bench process.
+    """
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.id = bench['id']
+        self.process = None
+        self.connection = None
+        self.chunk = None
+        self.index = 0
+        self.last_seen = 0.0
+        self.attempts = 0
+        self.stalls = 0
+        self.starts = 0
+        self.finished = False
+        self.failed = False
+
+    def remainder(self):
+        """
+        :return: the chunk with the parameters the bench did not finish, or None
+        """
+        if self.chunk is None:
+            return None
+        chunk_id, parameters = self.chunk
+        self.chunk = None
+        return chunk_id, parameters[self.index:]
+
+
+class Orchestrator:
+    """
+    Runs one campaign on several benches, one process per bench.
+    """
+
+    def __init__(self, factory, benches, chunk_size=64, stall_timeout=60.0, restarts=1, report_interval=10.0):
+        """
+        :param factory: 'module:name' of the campaign factory ``(util, bench) -> Campaign``
+        :param benches: a dict per bench, with an 'id' and the settings of the factory
+        :param chunk_size: number of parameter sets a bench gets at once. Small chunks balance better, large ones
+            cost fewer messages.
+        :param stall_timeout: seconds without a message after which a bench is stopped. Must be longer than the
+            slowest attempt.
+        :param restarts: number of times a stalled bench is started again
+        :param report_interval: seconds between progress reports, None for no reports
+        """
+        self.factory = factory
+        self.benches = [_Bench(bench) for bench in benches]
+        self.chunk_size = chunk_size
+        self.stall_timeout = stall_timeout
+        self.restarts = restarts
+        self.report_interval = report_interval
+        self.elapsed = 0.0
+        self._row_ids = itertools.count()
+
+    def _start(self, bench):
+        bench.connection, child = Pipe()
+        bench.process = Process(target=_bench_main, args=(self.factory, bench.bench, child),
+                                name='bench-{}'.format(bench.id), daemon=True)
+        bench.process.start()
+        child.close()
+        bench.starts += 1
+        bench.last_seen = perf_counter()
+
+    def _stop(self, bench, pending):
+        """
+        Stop a bench process and put the rest of its chunk in front of the pending chunks.
+        """
+        if bench.process.is_alive():
+            bench.process.terminate()
+        bench.process.join()
+        bench.connection.close()
+        remainder = bench.remainder()
+        if remainder is not None and remainder[1]:
+            pending.appendleft(remainder)
+
+    def run(self, parameters, sink):
+        """
+        Run the campaign until the parameters run out.
+
+        :param parameters: the parameters of the campaign, e.g. from ``settings_parameters``
+        :param sink: the result sink, e.g. a ``SQLiteResultSink``. Rows get a 'bench' column in front, and their
+            'id' column is numbered across the benches.
+        :raises RuntimeError: when the benches stopped before the parameters ran out, as the last running ones failed
+        """
+        source = iter(parameters)
+        chunk_ids = itertools.count()
+        self._row_ids = itertools.count()
+        pending = deque()
+
+        def next_chunk():
+            if pending:
+                return pending.popleft()
+            chunk = list(itertools.islice(source, self.chunk_size))
+            return (next(chunk_ids), chunk) if chunk else None
+
+        start = perf_counter()
+        last_report = start
+        for bench in self.benches:
+            self._start(bench)
+        try:
+            while True:
+                running = [bench for bench in self.benches if not bench.finished]
+                if not running:
+                    break
+                ready = wait([bench.connection for bench in running], timeout=1.0)
+                now = perf_counter()
+                for bench in running:
+                    if bench.connection not in ready:
+                        if now - bench.last_seen > self.stall_timeout:
+                            self._stalled(bench, pending)
+                        continue
+                    try:
+                        while bench.connection.poll():
+                            self._handle(bench, bench.connection.recv(), next_chunk, sink, pending)
+                            if bench.finished:
+                                break
+                    except (EOFError, OSError):
+                        print('Bench {} exited unexpectedly'.format(bench.id))
+                        self._failed(bench, pending)
+                    bench.last_seen = now
+                if self.report_interval is not None and now - last_report >= self.report_interval:
+                    last_report = now
+                    self.report(now - start)
+                if all(bench.failed for bench in self.benches):
+                    break
+        finally:
+            for bench in self.benches:
+                if not bench.finished:
+                    self._failed(bench, pending)
+            self.elapsed = perf_counter() - start
+            sink.flush()
+        self.report(self.elapsed)
+        # The parameters can be endless, so only check whether one is left
+        left = sum(len(chunk) for _, chunk in pending)
+        more = next(source, None) is not None
+        if left or more:
+            failed = sum(bench.failed for bench in self.benches)
+            raise RuntimeError('{} benches finished and {} failed, {}{} parameter sets were not run'.format(
+                len(self.benches) - failed, failed, 'at least ' if more else '', left + more))
+
+    def _handle(self, bench, message, next_chunk, sink, pending):
+        kind = message[0]
+        if kind == 'row':
+            row = [('id', next(self._row_ids)) if name == 'id' else (name, value) for name, value in message[1]]
+            sink.add([('bench', bench.id)] + row)
+            bench.attempts += 1
+        elif kind == 'next':
+            bench.index = message[2]
+        elif kind == 'ready':
+            bench.chunk = next_chunk()
+            bench.index = 0
+            bench.connection.send(bench.chunk)
+        elif kind == 'done':
+            bench.process.join()
+            bench.connection.close()
+            bench.finished = True
+        elif kind == 'error':
+            print('Bench {} failed:\n{}'.format(bench.id, message[1]))
+            self._failed(bench, pending)
+
+    def _stalled(self, bench, pending):
+        bench.stalls += 1
+        print('Bench {} stalled, {} of its attempts are moved to the other benches'.format(
+            bench.id, 0 if bench.chunk is None else len(bench.chunk[1]) - bench.index))
+        self._stop(bench, pending)
+        if bench.stalls <= self.restarts:
+            self._start(bench)
+        else:
+            bench.finished = bench.failed = True
+
+    def _failed(self, bench, pending):
+        self._stop(bench, pending)
+        bench.finished = bench.failed = True
+
+    def report(self, elapsed):
+        """
+        Print the attempts and the throughput of every bench.
+        """
+        total = sum(bench.attempts for bench in self.benches)
+        print('{} attempts in {:.1f} s, {:.1f} attempts/s'.format(total, elapsed, total / max(elapsed, 1e-9)))
+        for bench in self.benches:
+            state = 'failed' if bench.failed else 'done' if bench.finished else 'running'
+            print('  {:<12} {:>10} attempts {:>10.1f} attempts/s {:>3} stalls  {}'.format(
+                bench.id, bench.attempts, bench.attempts / max(elapsed, 1e-9), bench.stalls, state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one campaign on several benches in parallel.')
+    parser.add_argument('benches', nargs='?', help='JSON file with a list of benches, each a dict with an "id"')
+    parser.add_argument('factory', nargs='?', help='module:name of the campaign factory, e.g. '
+                                                   'fifth_script:bench_campaign')
+    parser.add_argument('settings', nargs='?', help='the settings of the script in the fipy UI, for the parameters')
+    parser.add_argument('--simulate', type=int, metavar='BENCHES',
+                        help='run a simulated campaign on this many simulated benches instead')
+    parser.add_argument('--attempts', type=int, default=None, help='defaults to the attempts of the settings')
+    parser.add_argument('--database', default=None, help='default logs/<table>.sqlite')
+    parser.add_argument('--table', default=None, help='default the module of the factory')
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--stall-timeout', type=float, default=60.0)
+    parser.add_argument('--restarts', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.simulate:
+        from common.simulation import simulated_parameters
+        factory = 'common.simulation:simulated_campaign'
+        benches = [{'id': 'sim{}'.format(i), 'seed': i, 'realtime': True} for i in range(args.simulate)]
+        parameters = simulated_parameters(args.attempts or 10000, args.seed)
+    elif args.benches and args.factory and args.settings:
+        factory = args.factory
+        with open(args.benches) as f:
+            benches = json.load(f)
+        parameters = settings_parameters(args.settings, args.attempts, args.seed)
+    else:
+        parser.error('give the benches, factory and settings, or --simulate')
+    table = args.table or factory.partition(':')[0].rpartition('.')[2]
+    path = args.database or 'logs/{}.sqlite'.format(table)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    sink = SQLiteResultSink(path, table)
+    try:
+        Orchestrator(factory, benches, chunk_size=args.chunk_size, stall_timeout=args.stall_timeout,
+                     restarts=args.restarts).run(parameters, sink)
+    finally:
+        sink.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''Offline re-classification of campaign results.
+
+When the meaning of a response changes, e.g. what counts as GREEN or ORANGE, the colors of an existing campaign
+can be updated from its stored ``Data`` and ``spider_timeout`` columns, instead of running the campaign again.
+The rows are streamed from the database in chunks, classified by a pool of worker processes, and the changed
+colors are written back in bulk in one transaction.
+
+The classifier is given as ``module:name``, e.g. the ``CLASSIFIER`` of a script (see ``common.classifier``), so
+every worker process can import it. Run from the scripts directory:
+
+    python -m common.reclassify logs/fifth_script.sqlite fifth_script fifth_script:CLASSIFIER --dry-run
+'''
+
+import argparse
+import importlib
+import os
+import sqlite3
+from collections import Counter, deque
+from multiprocessing import Pool
+from time import perf_counter
+
+_classifier = None
+
+
+def load_classifier(spec):
+    """
+    :param spec: 'module:name' of a ``Classifier``, or of a function ``(response, spider_timeout) -> color``
+    :return: a function ``(response, spider_timeout) -> color``
+    """
+    module, _, name = spec.partition(':')
+    classifier = getattr(importlib.import_module(module), name or 'CLASSIFIER')
+    return getattr(classifier, 'classify_response', classifier)
+
+
+def _init_worker(spec):
+    global _classifier
+    _classifier = load_classifier(spec)
+
+
+def _as_bytes(data):
+    if data is None:
+        return b''
+    if isinstance(data, str):
+        return data.encode('latin-1')
+    return bytes(data)
+
+
+def _classify_chunk(rows):
+    """
+    :param rows: (rowid, data, spider_timeout, color) tuples
+    :return: the (new color, rowid) tuples of the changed rows, and a Counter of (old, new) colors
+    """
+    changed = []
+    transitions = Counter()
+    for rowid, data, spider_timeout, color in rows:
+        new = int(_classifier(_as_bytes(data), bool(spider_timeout)))
+        transitions[color, new] += 1
+        if new != color:
+            changed.append((new, rowid))
+    return changed, transitions
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _chunks(cursor, chunk_rows):
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            return
+        yield rows
+
+
+def reclassify(path, table, spec, processes=None, chunk_rows=20000, dry_run=False,
+               data_column='Data', timeout_column='spider_timeout', color_column='Color'):
+    """
+    Classify the stored responses of a result table again and update their colors.
+
+    :param path: the result database, e.g. 'logs/fifth_script.sqlite'
+    :param table: the result table, normally the script name
+    :param spec: the classifier, see ``load_classifier``
+    :param processes: number of worker processes, all CPUs if None. With 1 the rows are classified in this process.
+    :param chunk_rows: number of rows sent to a worker at once
+    :param dry_run: only count the changes, do not update the database
+    :param data_column: the response column
+    :param timeout_column: the Spider timeout column. Tables without it are classified as without timeout.
+    :param color_column: the color column that is updated
+    :return: Counter of (old color, new color) to the number of rows
+    """
+    connection = sqlite3.connect(path)
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(_quote(table)))]
+        timeout = _quote(timeout_column) if timeout_column in columns else '0'
+        cursor = connection.execute('SELECT rowid, {}, {}, {} FROM {}'.format(
+            _quote(data_column), timeout, _quote(color_column), _quote(table)))
+        update = 'UPDATE {} SET {} = ? WHERE rowid = ?'.format(_quote(table), _quote(color_column))
+
+        transitions = Counter()
+
+        def apply(result):
+            changed, chunk_transitions = result
+            transitions.update(chunk_transitions)
+            if changed and not dry_run:
+                connection.executemany(update, changed)
+
+        processes = processes or os.cpu_count()
+        if processes == 1:
+            _init_worker(spec)
+            for rows in _chunks(cursor, chunk_rows):
+                apply(_classify_chunk(rows))
+        else:
+            # The cursor can only be used from this thread, so the chunks are read here and at most two per worker
+            # are in flight, which also bounds the memory use
+            with Pool(processes, initializer=_init_worker, initargs=(spec,)) as pool:
+                pending = deque()
+                for rows in _chunks(cursor, chunk_rows):
+                    pending.append(pool.apply_async(_classify_chunk, (rows,)))
+                    if len(pending) >= 2 * processes:
+                        apply(pending.popleft().get())
+                while pending:
+                    apply(pending.popleft().get())
+        connection.commit()
+    finally:
+        connection.close()
+    return transitions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update the colors of a result table with a new classifier.')
+    parser.add_argument('database', help='the result database, e.g. logs/fifth_script.sqlite')
+    parser.add_argument('table', help='the result table, normally the script name')
+    parser.add_argument('classifier', help='module:name of the classifier, e.g. fifth_script:CLASSIFIER')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes, default all CPUs')
+    parser.add_argument('--chunk-rows', type=int, default=20000, help='number of rows per worker task')
+    parser.add_argument('--dry-run', action='store_true', help='only report the changes')
+    args = parser.parse_args()
+
+    start = perf_counter()
+    transitions = reclassify(args.database, args.table, args.classifier, processes=args.processes,
+                             chunk_rows=args.chunk_rows, dry_run=args.dry_run)
+    print('{} rows in {:.1f} s'.format(sum(transitions.values()), perf_counter() - start))
+    for (old, new), count in sorted(transitions.items()):
+        if old != new:
+            print('  Color {} -> {}: {} rows{}'.format(old, new, count, ' (dry run)' if args.dry_run else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+'''Parameter space regions, e.g. the glitch length vs. glitch voltage area where faults were observed.
+
+``PolygonRegion`` answers point-in-polygon queries from a precomputed lookup grid, only falling back to the
+(prepared) shapely geometry for grid cells on the polygon boundary, and samples points uniformly from inside
+the polygon, so no parameter draws are wasted.
+
+Instead of tracing a polygon off a plot, ``learn_region`` builds one around the successful results (e.g. GREEN
+and ORANGE) of a previous campaign in its results database. Run this module to print the learned polygon:
+
+    python -m common.region logs/fifth_script.sqlite fifth_script glitch_length2 glitch_voltage2 --colors 1 4
+
+Usage example:
+
+>>> region = PolygonRegion(polygon_points)
+>>> accept = region.accepts('glitch_length', 'glitch_voltage')      # filter parameters from PARAMETERS
+>>> sample = region.sampler('glitch_length', 'glitch_voltage', x_type=int)  # or replace them by samples
+'''
+
+import argparse
+import random
+import sqlite3
+from bisect import bisect
+from collections import ChainMap
+from itertools import accumulate
+
+import shapely
+from shapely.affinity import affine_transform
+from shapely.geometry import MultiPoint, Point, box
+from shapely.geometry.polygon import Polygon, orient
+from shapely.prepared import prep
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+def _triangle_area(a, b, c):
+    return ((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1])) / 2.0
+
+
+def _in_triangle(p, a, b, c):
+    return _triangle_area(a, b, p) >= 0 and _triangle_area(b, c, p) >= 0 and _triangle_area(c, a, p) >= 0
+
+
+def triangulate(polygon):
+    """
+    Split a simple polygon into triangles by ear clipping.
+
+    :param polygon: a shapely Polygon without holes
+    :return: a list of (a, b, c) triangles, every corner an (x, y) tuple
+    """
+    vertices = list(orient(polygon).exterior.coords)[:-1]
+    triangles = []
+    while len(vertices) > 3:
+        for i in range(len(vertices)):
+            a, b, c = vertices[i - 1], vertices[i], vertices[(i + 1) % len(vertices)]
+            if _triangle_area(a, b, c) <= 0:
+                continue  # reflex or degenerate corner
+            others = (v for v in vertices if v is not a and v is not b and v is not c)
+            if any(_in_triangle(v, a, b, c) for v in others):
+                continue
+            triangles.append((a, b, c))
+            del vertices[i]
+            break
+        else:
+            raise ValueError('Polygon cannot be triangulated, is it self-intersecting?')
+    triangles.append(tuple(vertices))
+    return triangles
+
+
+class PolygonRegion:
+    """
+    A polygon in a two dimensional parameter space with fast containment tests and rejection-free sampling.
+    """
+
+    def __init__(self, points, grid_size=64):
+        """
+        :param points: the (x, y) corners of the polygon
+        :param grid_size: number of lookup grid cells along each axis
+        """
+        self.polygon = Polygon(points)
+        self._prepared = prep(self.polygon)
+
+        # Lookup grid: every cell is completely inside, completely outside, or on the boundary of the polygon
+        self.x_min, self.y_min, x_max, y_max = self.polygon.bounds
+        self.grid_size = grid_size
+        self._cell_width = (x_max - self.x_min) / grid_size or 1.0
+        self._cell_height = (y_max - self.y_min) / grid_size or 1.0
+        self._grid = []
+        for column in range(grid_size):
+            cells = []
+            for row in range(grid_size):
+                cell = box(self.x_min + column * self._cell_width, self.y_min + row * self._cell_height,
+                           self.x_min + (column + 1) * self._cell_width, self.y_min + (row + 1) * self._cell_height)
+                if self._prepared.contains(cell):
+                    cells.append(INSIDE)
+                elif self._prepared.intersects(cell):
+                    cells.append(BOUNDARY)
+                else:
+                    cells.append(OUTSIDE)
+            self._grid.append(cells)
+
+        self._triangles = triangulate(self.polygon)
+        self._cumulative_areas = list(accumulate(abs(_triangle_area(*t)) for t in self._triangles))
+
+    @classmethod
+    def around(cls, points, method='concave', ratio=0.5, margin=0.0, grid_size=64):
+        """
+        Create the region enclosing a set of points.
+
+        The points are scaled to a unit square first, so parameters with very different ranges (e.g. nanoseconds
+        and volts) weigh equally.
+
+        :param points: the (x, y) points to enclose, at least three that are not on one line
+        :param method: 'convex' for the convex hull, 'concave' for a concave hull
+        :param ratio: concave hull ratio, from 0 (tightest) to 1 (convex hull)
+        :param margin: grow the region by this fraction of the point spread, so a narrowing campaign keeps
+            exploring just outside of the faults found so far
+        :param grid_size: number of lookup grid cells along each axis
+        """
+        hull_points = MultiPoint(list(points))
+        x_min, y_min, x_max, y_max = hull_points.bounds
+        x_scale, y_scale = (x_max - x_min) or 1.0, (y_max - y_min) or 1.0
+        unit = affine_transform(hull_points, [1 / x_scale, 0, 0, 1 / y_scale, -x_min / x_scale, -y_min / y_scale])
+
+        if method == 'convex':
+            hull = unit.convex_hull
+        elif method == 'concave':
+            hull = shapely.concave_hull(unit, ratio=ratio)
+        else:
+            raise ValueError("Unknown hull method '{}'".format(method))
+        if margin > 0:
+            hull = hull.buffer(margin).simplify(margin / 10)
+        if not isinstance(hull, Polygon) or hull.area == 0:
+            raise ValueError('Need at least three points that are not on one line to build a region')
+
+        hull = affine_transform(Polygon(hull.exterior), [x_scale, 0, 0, y_scale, x_min, y_min])
+        return cls(list(hull.exterior.coords), grid_size)
+
+    def contains(self, x, y):
+        """
+        :return: True if (x, y) lies inside the polygon
+        """
+        column = int((x - self.x_min) // self._cell_width)
+        row = int((y - self.y_min) // self._cell_height)
+        if not (0 <= column < self.grid_size and 0 <= row < self.grid_size):
+            return False
+        cell = self._grid[column][row]
+        if cell == BOUNDARY:
+            return self._prepared.contains(Point(x, y))
+        return cell == INSIDE
+
+    def sample(self, rng=random):
+        """
+        Draw a point uniformly from inside the polygon.
+
+        :param rng: the random generator, e.g. a seeded ``random.Random``
+        :return: the (x, y) point
+        """
+        index = bisect(self._cumulative_areas, rng.random() * self._cumulative_areas[-1])
+        a, b, c = self._triangles[min(index, len(self._triangles) - 1)]
+        u, v = rng.random(), rng.random()
+        if u + v > 1:
+            u, v = 1 - u, 1 - v
+        return (a[0] + u * (b[0] - a[0]) + v * (c[0] - a[0]),
+                a[1] + u * (b[1] - a[1]) + v * (c[1] - a[1]))
+
+    def accepts(self, x_key, y_key):
+        """
+        :return: a campaign ``accept`` stage that skips parameters outside the polygon
+        """
+        def accept(p):
+            return self.contains(p[x_key], p[y_key])
+        return accept
+
+    def sampler(self, x_key, y_key, x_type=float, y_type=float, rng=random):
+        """
+        :return: a campaign ``sample`` stage that replaces the two parameters by a point from inside the polygon.
+            Use ``int`` as type for integer parameters; rounding can move a point just outside the polygon.
+        """
+        def sample(p):
+            x, y = self.sample(rng)
+            return ChainMap({x_key: x_type(round(x)) if x_type is int else x_type(x),
+                             y_key: y_type(round(y)) if y_type is int else y_type(y)}, p)
+        return sample
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def learn_region(path, table, x_key, y_key, colors, **kwargs):
+    """
+    Build a region around the results of a previous campaign.
+
+    :param path: the results database, e.g. 'logs/fifth_script.sqlite'
+    :param table: the results table, normally the script name
+    :param x_key: the result column of the x axis, e.g. 'glitch_length2'
+    :param y_key: the result column of the y axis, e.g. 'glitch_voltage2'
+    :param colors: the result colors to enclose, e.g. [ResultColor.GREEN, ResultColor.ORANGE]
+    :param kwargs: passed on to ``PolygonRegion.around``
+    :return: the PolygonRegion
+    """
+    colors = [int(color) for color in colors]
+    query = 'SELECT {}, {} FROM {} WHERE "Color" IN ({})'.format(
+        _quote(x_key), _quote(y_key), _quote(table), ', '.join('?' * len(colors)))
+    connection = sqlite3.connect(path)
+    try:
+        points = connection.execute(query, colors).fetchall()
+    finally:
+        connection.close()
+    return PolygonRegion.around(points, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the polygon around the results of a campaign.')
+    parser.add_argument('database', help='the results database, e.g. logs/fifth_script.sqlite')
+    parser.add_argument('table', help='the results table, normally the script name')
+    parser.add_argument('x', help='the result column of the x axis, e.g. glitch_length2')
+    parser.add_argument('y', help='the result column of the y axis, e.g. glitch_voltage2')
+    parser.add_argument('--colors', type=int, nargs='+', required=True, help='the result color values to enclose')
+    parser.add_argument('--method', choices=('concave', 'convex'), default='concave')
+    parser.add_argument('--ratio', type=float, default=0.5, help='concave hull ratio, 0 is tightest')
+    parser.add_argument('--margin', type=float, default=0.0, help='grow the region by this fraction')
+    args = parser.parse_args()
+
+    region = learn_region(args.database, args.table, args.x, args.y, args.colors,
+                          method=args.method, ratio=args.ratio, margin=args.margin)
+    print('polygon_points={}'.format(list(region.polygon.exterior.coords)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+'''Batched result storage.
+
+Adding every result row to the database with its own commit costs an fsync per attempt, which adds milliseconds
+to every iteration of a fast campaign. ``SQLiteResultSink`` buffers rows and writes them with one prepared
+``executemany`` and one commit per batch, in a database in WAL mode. A batch is written when it holds
+``batch_size`` rows, when ``flush_interval`` seconds passed since the previous write, on ``flush`` and on
+``close``. At most the rows of one batch are lost when the script crashes.
+
+The write latencies are recorded, ``report`` prints them at the end of a campaign:
+
+>>> sink = open_result_sink(util, 'logs/{}.sqlite'.format(script_name), script_name)
+>>> campaign = Campaign(..., sink=sink)
+>>> campaign.run(PARAMETERS, db)
+'''
+
+import sqlite3
+from threading import Lock
+from time import perf_counter
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+class SQLiteResultSink:
+    """
+    Writes result rows to an SQLite table in batches.
+    """
+
+    def __init__(self, path, table, batch_size=256, flush_interval=1.0, synchronous='NORMAL'):
+        """
+        :param path: the database file, e.g. 'logs/fifth_script.sqlite'
+        :param table: the table, created on the first row if it does not exist
+        :param batch_size: number of rows written per transaction
+        :param flush_interval: maximum number of seconds a row waits in the buffer, checked when a row is added
+        :param synchronous: the SQLite synchronous pragma. With WAL, 'NORMAL' only syncs on checkpoints.
+        """
+        self.path = path
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous={}'.format(synchronous))
+        self._lock = Lock()
+        self._columns = None
+        self._positions = None
+        self._insert = None
+        self._buffer = []
+        self._last_flush = perf_counter()
+        self.rows = 0
+        self.flush_times = []
+
+    def _prepare(self, row):
+        # Rows can repeat a name, the first value is stored
+        positions = {}
+        for i, (name, _) in enumerate(row):
+            positions.setdefault(name, i)
+        self._columns = list(positions)
+        self._positions = list(positions.values())
+        columns = ', '.join(_quote(name) for name in self._columns)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(_quote(self.table), columns))
+        # A table of an earlier run can miss columns, e.g. after enabling the stage timing of a campaign
+        table_info = self._connection.execute('PRAGMA table_info({})'.format(_quote(self.table)))
+        existing = {column[1] for column in table_info}
+        for name in self._columns:
+            if name not in existing:
+                self._connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(_quote(self.table), _quote(name)))
+        self._connection.commit()
+        self._insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            _quote(self.table), columns, ', '.join('?' * len(self._columns)))
+
+    def add(self, row):
+        """
+        Buffer a result row, and write the buffer when it is full or old enough.
+
+        :param row: the result as a list of (name, value) tuples, with the same names for every row
+        """
+        with self._lock:
+            if self._insert is None:
+                self._prepare(row)
+            self._buffer.append(tuple(row[i][1] for i in self._positions))
+            if len(self._buffer) >= self.batch_size or perf_counter() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """
+        Write the buffered rows.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            start = perf_counter()
+            self._connection.executemany(self._insert, self._buffer)
+            self._connection.commit()
+            self.flush_times.append(perf_counter() - start)
+            self.rows += len(self._buffer)
+            self._buffer = []
+        self._last_flush = perf_counter()
+
+    def close(self):
+        """
+        Write the buffered rows and close the database.
+        """
+        with self._lock:
+            if self._connection is None:
+                return
+            self._flush()
+            self._connection.close()
+            self._connection = None
+
+    def report(self):
+        """
+        Print the number of rows written and the write latencies.
+        """
+        if not self.flush_times:
+            return
+        times = sorted(self.flush_times)
+        print('Results: {} rows in {} writes, write latency mean {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms, '
+              '{:.1f} us per row'.format(
+                self.rows, len(times), 1000 * sum(times) / len(times),
+                1000 * times[min(int(len(times) * 0.99), len(times) - 1)], 1000 * times[-1],
+                1e6 * sum(times) / self.rows))
+
+
+def open_result_sink(util, path, table, **kwargs):
+    """
+    Open a ``SQLiteResultSink`` that is flushed and closed on cleanup.
+
+    :param util: the fipy script util
+    :param kwargs: passed on to ``SQLiteResultSink``
+    :return: the sink
+    """
+    sink = SQLiteResultSink(path, table, **kwargs)
+    util.add_to_cleanup(sink.close)
+    return sink
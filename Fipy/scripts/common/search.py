@@ -0,0 +1,167 @@
+'''Adaptive glitch parameter search.
+
+A static sweep spends most attempts where nothing happens, and with three glitches (nine parameters) a random
+sweep rarely hits the small areas where faults occur. ``ThompsonSearch`` learns from the color of every attempt
+and proposes the next parameters with Thompson sampling: every candidate value of every parameter keeps a Beta
+distribution of its fault rate, a proposal draws one sample from each distribution and picks the value with the
+highest draw. Values that produced faults are proposed more often, while values with few attempts still get
+explored.
+
+The parameters are modelled independently of each other, so the number of distributions grows with the sum,
+not the product, of the candidate values, and the search stays usable in nine dimensions. Interactions between
+parameters (e.g. a glitch length that only works at a certain voltage) are not modelled; combine the search with
+a ``PolygonRegion`` accept stage, or narrow the ranges between campaigns for that. Give that accept stage to
+``sampler`` as well: it then proposes again until a proposal is accepted, and counts every rejected proposal as an
+attempt without reward for the parameters the region checks. Otherwise the values outside the region keep their
+prior, while the values inside lose reward with every attempt without a fault, until almost every proposal is
+outside and the campaign stops attempting.
+
+The search plugs into a ``Campaign`` as sample and observe stages, the iteration over PARAMETERS still decides
+the number of attempts and provides the parameters that are not searched:
+
+>>> search = ThompsonSearch.from_settings(Path(__file__).with_suffix('.py.json'),
+...                                        ['glitch_delay2', 'glitch_length2', 'glitch_voltage2'],
+...                                        rewards={ResultColor.GREEN: 1.0, ResultColor.ORANGE: 0.5})
+>>> campaign = Campaign(..., sample=search.sampler(), observe=search.observer())
+'''
+
+import json
+from collections import ChainMap
+from threading import Lock
+
+import numpy
+
+
+class ThompsonSearch:
+    """
+    Thompson sampling over discrete candidate values of independent parameters.
+    """
+
+    def __init__(self, space, rewards, prior=(1.0, 1.0), seed=None):
+        """
+        :param space: dict of parameter name to the sequence of candidate values
+        :param rewards: dict of result color to the reward of an attempt with that color, between 0 and 1.
+            Colors that are not in the dict have reward 0.
+        :param prior: the (alpha, beta) of the Beta distribution of a value without attempts
+        :param seed: seed of the random generator, for reproducible searches
+        """
+        self.space = {key: list(values) for key, values in space.items()}
+        self.rewards = {int(color): float(reward) for color, reward in rewards.items()}
+        self._index = {key: {value: i for i, value in enumerate(values)} for key, values in self.space.items()}
+        self._alpha = {key: numpy.full(len(values), prior[0]) for key, values in self.space.items()}
+        self._beta = {key: numpy.full(len(values), prior[1]) for key, values in self.space.items()}
+        self._rng = numpy.random.default_rng(seed)
+        self._lock = Lock()
+        self.observations = 0
+        self.total_reward = 0.0
+        self.rejections = 0
+
+    @classmethod
+    def from_settings(cls, path, keys, rewards, steps=32, **kwargs):
+        """
+        Create a search over the ranges configured for a script in the fipy UI.
+
+        :param path: the settings of the script, e.g. 'fifth_script.py.json'
+        :param keys: the parameters to search, they need a min and max in the settings
+        :param rewards: see ``__init__``
+        :param steps: maximum number of candidate values per parameter. Integer ranges with fewer values use all
+            of them.
+        :return: the ThompsonSearch
+        """
+        with open(path) as f:
+            settings = json.load(f)
+        space = {}
+        for key in keys:
+            low, high = settings[key]['min'], settings[key]['max']
+            if isinstance(low, int) and isinstance(high, int):
+                values = numpy.unique(numpy.linspace(low, high, min(steps, high - low + 1)).round().astype(int))
+                space[key] = [int(value) for value in values]
+            else:
+                space[key] = [float(value) for value in numpy.linspace(low, high, steps)]
+        return cls(space, rewards, **kwargs)
+
+    def propose(self):
+        """
+        :return: dict with a value for every searched parameter
+        """
+        with self._lock:
+            return {key: self.space[key][int(numpy.argmax(self._rng.beta(self._alpha[key], self._beta[key])))]
+                    for key in self.space}
+
+    def observe(self, parameters, color):
+        """
+        Update the fault rates of the parameter values of an attempt.
+
+        Parameters with a value that is not a candidate, e.g. when the attempt was not proposed by this search,
+        are ignored.
+        """
+        reward = self.rewards.get(int(color), 0.0)
+        with self._lock:
+            for key, index in self._index.items():
+                i = index.get(parameters[key])
+                if i is not None:
+                    self._alpha[key][i] += reward
+                    self._beta[key][i] += 1.0 - reward
+            self.observations += 1
+            self.total_reward += reward
+
+    def reject(self, parameters, keys=None):
+        """
+        Count a proposal that was not accepted as an attempt without reward.
+
+        :param keys: the parameters the accept stage checked, by default all searched parameters
+        """
+        with self._lock:
+            for key in self._index if keys is None else keys:
+                i = self._index[key].get(parameters[key])
+                if i is not None:
+                    self._beta[key][i] += 1.0
+            self.rejections += 1
+
+    def best(self, count=5):
+        """
+        :return: dict of parameter name to its ``count`` values with the highest expected fault rate, as
+            (value, rate) tuples
+        """
+        with self._lock:
+            result = {}
+            for key, values in self.space.items():
+                rates = self._alpha[key] / (self._alpha[key] + self._beta[key])
+                result[key] = [(values[i], float(rates[i])) for i in numpy.argsort(rates)[::-1][:count]]
+            return result
+
+    def report(self):
+        """
+        Print the mean reward and the most promising values.
+        """
+        if not self.observations:
+            return
+        print('Search: {} attempts, mean reward {:.4f}, {} proposals rejected'.format(
+            self.observations, self.total_reward / self.observations, self.rejections))
+        for key, values in self.best().items():
+            print('  {}: {}'.format(key, ', '.join('{} ({:.3f})'.format(v, rate) for v, rate in values)))
+
+    def sampler(self, accept=None, keys=None, tries=100):
+        """
+        :param accept: the accept stage of the campaign, proposals it rejects are passed to ``reject`` and
+            proposed again
+        :param keys: the parameters ``accept`` checks, see ``reject``
+        :param tries: maximum number of proposals per attempt, the last one is returned when none was accepted
+        :return: a campaign ``sample`` stage that replaces the searched parameters by a proposal
+        """
+        def sample(p):
+            for _ in range(tries):
+                proposal = ChainMap(self.propose(), p)
+                if accept is None or accept(proposal):
+                    break
+                self.reject(proposal, keys)
+            return proposal
+        return sample
+
+    def observer(self):
+        """
+        :return: a campaign ``observe`` stage that feeds the color of every attempt back to the search
+        """
+        def observe(attempt):
+            self.observe(attempt.parameters, attempt.color)
+        return observe
@@ -0,0 +1,281 @@
+'''Background serial reader that returns complete responses as soon as they arrived.
+
+``serial.read(n)`` only returns early when ``n`` bytes arrived, so every short or missing response of a glitched
+target costs the full read timeout, and reading "any more bytes?" always does. ``FramedReader`` reads the port on
+a background thread and returns a frame as soon as it is complete:
+
+* ``size`` bytes arrived
+* one of the ``terminators`` (e.g. ``b'\\r\\n'`` or ``b'.'``) arrived
+* the target went silent: no byte arrived for ``idle`` seconds
+* ``timeout`` seconds passed
+
+A target transmits a response without pauses, so ``idle`` can be a few byte times at the baudrate, see
+``byte_time``. By default it only starts counting at the first byte of a frame, because the target may need time
+before it responds; with ``wait_first=False`` it counts from the start of the read, e.g. to check for trailing
+bytes:
+
+>>> reader = open_framed_reader(util, serial_target)
+>>> reader.write(test.cmd)
+>>> received = reader.read_frame(size=len(test.expected), timeout=0.5)
+>>> received += reader.read_frame(size=1024, timeout=0.5, idle=32 * byte_time(115200), wait_first=False)
+
+``read_bursts`` returns everything received, split at the pauses of the target, with the arrival time of every
+burst, e.g. the responses of several attempts in one batch (see ``common.batch``).
+
+The reader has the ``read``, ``write`` and ``reset_*_buffer`` methods and the ``baudrate`` of the port, so it can replace the target
+port in a ``Campaign``. Without an idle time a plain read is as fast, so the scripts only start a reader when they
+read with one. ``read_bytes`` reads from either:
+
+>>> received = read_bytes(serial_target, len(test.expected), idle=idle)
+'''
+
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+
+import serial
+
+
+def byte_time(baudrate, bits=10):
+    """
+    :return: the time in seconds to transmit one byte, with a start and stop bit by default
+    """
+    return bits / float(baudrate)
+
+
+class FramedReader:
+    """
+    Reads a serial port on a background thread and splits the received bytes into frames.
+    """
+
+    def __init__(self, port, terminators=(), poll_interval=0.01):
+        """
+        :param port: the opened serial port. Its timeout is the default timeout of ``read_frame``, and is then
+            replaced by ``poll_interval``.
+        :param terminators: the default terminators of ``read_frame``
+        :param poll_interval: how long the background thread blocks on the port, this bounds the time to close
+        """
+        self.port = port
+        self.terminators = tuple(terminators)
+        self.timeout = port.timeout
+        port.timeout = poll_interval
+        self._buffer = bytearray()
+        self._last_byte = 0.0
+        # (stream position after the bytes, perf_counter) of every read of the port, for ``read_bursts``
+        self._arrivals = deque()
+        self._received = 0
+        self._consumed = 0
+        self._condition = Condition()
+        self._closed = False
+        self._error = None
+        self._paused = False
+        self._reading = False
+        self._thread = Thread(target=self._receive, name='framed-reader', daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        while True:
+            with self._condition:
+                # ``reset_input_buffer`` pauses the thread, so no bytes read before a reset are added after it
+                while self._paused and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                self._reading = True
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError) as e:
+                with self._condition:
+                    if not self._closed:
+                        self._error = e
+                    self._closed = True
+                    self._reading = False
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._reading = False
+                if data:
+                    self._buffer += data
+                    self._last_byte = perf_counter()
+                    self._received += len(data)
+                    self._arrivals.append((self._received, self._last_byte))
+                self._condition.notify_all()
+
+    def _frame_end(self, size, terminators):
+        end = None
+        for terminator in terminators:
+            index = self._buffer.find(terminator)
+            if index >= 0 and (end is None or index + len(terminator) < end):
+                end = index + len(terminator)
+        if size is not None and len(self._buffer) >= size and (end is None or size < end):
+            end = size
+        return end
+
+    def read_frame(self, size=None, terminators=None, timeout=None, idle=None, wait_first=True):
+        """
+        Wait for a frame and remove it from the received bytes.
+
+        :param size: return at most this many bytes, as soon as they arrived
+        :param terminators: return up to and including the first of these byte strings, defaults to the
+            terminators of the reader
+        :param timeout: maximum time to wait in seconds, defaults to the original timeout of the port
+        :param idle: return when no byte arrived for this many seconds
+        :param wait_first: only start the idle time at the first byte of the frame
+        :return: the frame, possibly incomplete or empty after a timeout or idle time
+        """
+        terminators = self.terminators if terminators is None else tuple(terminators)
+        timeout = self.timeout if timeout is None else timeout
+        start = perf_counter()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            while True:
+                end = self._frame_end(size, terminators)
+                if end is not None:
+                    break
+                if self._error is not None:
+                    raise self._error
+                now = perf_counter()
+                wait = None if deadline is None else deadline - now
+                if idle is not None and (self._buffer or not wait_first):
+                    idle_end = max(self._last_byte, start) + idle
+                    wait = idle_end - now if wait is None else min(wait, idle_end - now)
+                if self._closed or (wait is not None and wait <= 0):
+                    end = len(self._buffer)
+                    break
+                self._condition.wait(wait)
+            return self._consume(end)
+
+    def _consume(self, end):
+        frame = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._consumed += end
+        while self._arrivals and self._arrivals[0][0] <= self._consumed:
+            self._arrivals.popleft()
+        return frame
+
+    def read_bursts(self, idle, timeout=None):
+        """
+        Wait until bytes arrived and the target is silent for ``idle`` seconds, and return the received bytes split
+        into bursts, at every pause of at least ``idle`` seconds. The pauses are seen when they happened, however
+        late this is called, down to the latency of the background thread.
+
+        :param timeout: maximum time to wait for the first byte in seconds, defaults to the original timeout of
+            the port
+        :return: a list of (burst, ``perf_counter`` when its last byte arrived), empty after a timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else perf_counter() + timeout
+        with self._condition:
+            while True:
+                if self._error is not None:
+                    raise self._error
+                now = perf_counter()
+                if self._buffer:
+                    wait = self._last_byte + idle - now
+                    if wait <= 0 or self._closed:
+                        break
+                else:
+                    wait = None if deadline is None else deadline - now
+                    if self._closed or (wait is not None and wait <= 0):
+                        return []
+                self._condition.wait(wait)
+            bursts = []
+            start = self._consumed
+            previous = None
+            for position, arrival in self._arrivals:
+                if previous is not None and arrival - previous[1] >= idle:
+                    bursts.append((previous[0] - start, previous[1]))
+                    start = previous[0]
+                previous = position, arrival
+            bursts.append((previous[0] - start, previous[1]))
+            return [(self._consume(size), arrival) for size, arrival in bursts]
+
+    def read(self, size=1):
+        """
+        Read like ``serial.Serial.read``: return when size bytes arrived or the timeout passed.
+        """
+        return self.read_frame(size=size, terminators=())
+
+    def write(self, data):
+        return self.port.write(data)
+
+    @property
+    def last_byte_time(self):
+        """
+        The ``perf_counter`` when the last byte arrived. After a frame that ended at an idle time, this is the
+        arrival of its last byte.
+        """
+        with self._condition:
+            return self._last_byte
+
+    @property
+    def baudrate(self):
+        return self.port.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.port.baudrate = baudrate
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return len(self._buffer)
+
+    def reset_input_buffer(self):
+        """
+        Discard the received bytes, including those still in the port and those the background thread is reading.
+        The read of the thread is cancelled where the port supports it, otherwise this waits for it, at most
+        ``poll_interval``.
+        """
+        with self._condition:
+            self._paused = True
+            try:
+                if self._reading:
+                    cancel_read = getattr(self.port, 'cancel_read', None)
+                    if cancel_read is not None:
+                        cancel_read()
+                    self._condition.wait_for(lambda: not self._reading)
+                self.port.reset_input_buffer()
+                self._consume(len(self._buffer))
+            finally:
+                self._paused = False
+                self._condition.notify_all()
+
+    def reset_output_buffer(self):
+        self.port.reset_output_buffer()
+
+    def close(self):
+        """
+        Stop the background thread. The port is not closed.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+def read_bytes(target, size, idle=None, wait_first=True):
+    """
+    Read from a plain port, or from a ``FramedReader`` when there is an idle time.
+
+    :param idle: stop reading when the target is silent for this many seconds, instead of waiting for the read
+        timeout. Needs a ``FramedReader`` as target.
+    :param wait_first: see ``FramedReader.read_frame``
+    :return: the bytes read
+    """
+    if idle is None:
+        return target.read(size)
+    return target.read_frame(size=size, idle=idle, wait_first=wait_first)
+
+
+def open_framed_reader(util, port, **kwargs):
+    """
+    Start a ``FramedReader`` on an opened port and stop it on cleanup.
+
+    :param util: the fipy script util
+    :param kwargs: passed on to ``FramedReader``
+    :return: the reader
+    """
+    reader = FramedReader(port, **kwargs)
+    util.add_to_cleanup(reader.close)
+    return reader
@@ -0,0 +1,536 @@
+'''Simulated Spider and target, to run campaigns without hardware.
+
+``SimulatedChronology`` implements the part of the spidersdk ``Chronology`` that the scripts use, and
+``SimulatedTarget`` the part of ``serial.Serial`` they use for the target. When the program is started, the
+glitches after the first trigger are passed to a ``FaultModel``, which decides the outcome of the attempt, and the
+target queues the response of that outcome. ``SimulatedUtil`` stands in for the fipy script util, so a ``Campaign``
+runs on any machine, without fipy or spidersdk, at the speed of the host code:
+
+>>> glitcher, target = SimulatedChronology.with_target(FaultModel(seed=1))
+>>> campaign = Campaign(SimulatedUtil(), glitcher, target, arm, read, CLASSIFIER, record, row_factory=tuple)
+>>> campaign.run(parameters, ListDatabase())
+
+By default nothing waits: reads return the queued bytes at once and programs finish instantly, which measures the
+host loop alone. With ``realtime=True`` the waits of the program, read timeouts and Spider timeouts take their
+time like on hardware. ``SimulatedVCGlitcher`` and ``SimulatedScope`` do the same for the VCGlitcher smartcard
+scripts and the scope of the TVLA script. Run this module for the throughput of a simulated fifth_script-like
+campaign:
+
+    python -m common.simulation --attempts 10000
+'''
+
+import argparse
+import random
+from collections import Counter
+from threading import Condition, Thread
+from time import perf_counter, sleep
+
+NORMAL = 'normal'
+FAULT = 'fault'
+PARTIAL = 'partial'
+MUTE = 'mute'
+
+RESPONSES = {
+    NORMAL: b'0,aaaa,aaaa,String: Hello from secure world\r\n',
+    FAULT: b'1,aaa6,aaa5,String: Hello from secure world\r\n',
+    PARTIAL: b'0,aaa6,aaa5,String: Hello from secure world\r\n',
+    MUTE: b'',
+}
+
+
+class FaultModel:
+    """
+    Decides the outcome of an attempt from its glitches.
+
+    Glitches with a length and voltage inside the fault window fault the target with ``fault_rate``, half of those
+    only partially. Glitches longer than ``mute_length`` make the target crash without a response with
+    ``mute_rate``.
+    """
+
+    def __init__(self, length=(40, 60), voltage=(0.05, 0.15), fault_rate=0.3, mute_length=500, mute_rate=0.8,
+                 responses=None, seed=None):
+        """
+        :param length: the (min, max) glitch length of the fault window in ns
+        :param voltage: the (min, max) glitch voltage of the fault window in V
+        :param fault_rate: probability that a glitch inside the window faults the target
+        :param mute_length: glitch length in ns above which the target can crash
+        :param mute_rate: probability that a glitch longer than ``mute_length`` crashes the target
+        :param responses: dict of outcome to target response, defaults to ``RESPONSES``
+        :param seed: seed of the random generator
+        """
+        self.length = length
+        self.voltage = voltage
+        self.fault_rate = fault_rate
+        self.mute_length = mute_length
+        self.mute_rate = mute_rate
+        self.responses = dict(RESPONSES if responses is None else responses)
+        self.rng = random.Random(seed)
+
+    def outcome(self, glitches):
+        """
+        :param glitches: (voltage, delay, length) tuples of the glitches after the trigger, in V and seconds
+        :return: the outcome, e.g. ``FAULT``
+        """
+        outcome = NORMAL
+        for voltage, delay, length in glitches:
+            length_ns = length * 1e9
+            if length_ns > self.mute_length and self.rng.random() < self.mute_rate:
+                return MUTE
+            if (self.length[0] <= length_ns <= self.length[1] and self.voltage[0] <= voltage <= self.voltage[1]
+                    and self.rng.random() < self.fault_rate):
+                outcome = FAULT if self.rng.random() < 0.5 else PARTIAL
+        return outcome
+
+    def response(self, glitches):
+        return self.responses[self.outcome(glitches)]
+
+
+class SimulatedTarget:
+    """
+    Serial port of a simulated target. Only ``start`` of the ``SimulatedChronology`` makes it respond.
+    """
+
+    def __init__(self, timeout=0.1, realtime=False, baudrate=115200):
+        """
+        :param timeout: the read timeout in seconds
+        :param realtime: wait for the timeout when a read gets fewer bytes than requested
+        :param baudrate: only stored, the responses arrive at once
+        """
+        self.timeout = timeout
+        self.realtime = realtime
+        self.baudrate = baudrate
+        self.written = bytearray()
+        self._buffer = bytearray()
+        self._cancelled = False
+        self._condition = Condition()
+
+    def respond(self, data):
+        """
+        Queue bytes sent by the target.
+        """
+        with self._condition:
+            self._buffer += data
+            self._condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self._condition:
+            return len(self._buffer)
+
+    def read(self, size=1):
+        with self._condition:
+            if self.realtime and len(self._buffer) < size and self.timeout:
+                self._condition.wait_for(lambda: len(self._buffer) >= size or self._cancelled, self.timeout)
+            self._cancelled = False
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def cancel_read(self):
+        """
+        Make the waiting read, or else the next one, return at once, like pyserial on POSIX.
+        """
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def write(self, data):
+        self.written += data
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._buffer.clear()
+
+    def reset_output_buffer(self):
+        self.written.clear()
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedChronology:
+    """
+    Chronology of a simulated Spider, connected to a ``SimulatedTarget``.
+    """
+
+    def __init__(self, target, fault_model, triggers=1, realtime=False, attempt_triggers=None, trigger_latency=0.0,
+                 response_delay=0.0):
+        """
+        :param target: the target that responds when the program runs
+        :param fault_model: decides the response from the glitches
+        :param triggers: number of triggers the target gives per run, None for any number. A program that waits
+            for more triggers does not finish, like on hardware.
+        :param realtime: take the waits of the program and the Spider timeouts in real time
+        :param attempt_triggers: number of triggers of one attempt, for programs that run several attempts (see
+            ``common.batch``). Every attempt gets its own response. By default the whole program is one attempt.
+        :param trigger_latency: seconds the target takes to give a trigger, e.g. its boot time after a reset
+        :param response_delay: seconds from the last glitch or trigger of an attempt until its response is sent
+        """
+        self.target = target
+        self.fault_model = fault_model
+        self.triggers = triggers
+        self.realtime = realtime
+        self.attempt_triggers = attempt_triggers
+        self.trigger_latency = trigger_latency
+        self.response_delay = response_delay
+        self.events = []
+        self.vcc = {}
+        self.gpio = {}
+        self.runs = 0
+        self._state = 0
+        self._finished = True
+        self._duration = 0.0
+        self._started = 0.0
+
+    @classmethod
+    def with_target(cls, fault_model, timeout=0.1, **kwargs):
+        """
+        :return: a (SimulatedChronology, SimulatedTarget) pair
+        """
+        target = SimulatedTarget(timeout, realtime=kwargs.get('realtime', False))
+        return cls(target, fault_model, **kwargs), target
+
+    def forget_events(self):
+        self.events = []
+
+    def set_vcc(self, output, voltage):
+        self.events.append(('set_vcc', output, voltage))
+
+    def set_gpio(self, gpio, value):
+        self.events.append(('set_gpio', gpio, value))
+
+    def wait_time(self, seconds):
+        self.events.append(('wait_time', seconds))
+
+    def wait_trigger(self, gpio, edge=None, count=1):
+        self.events.append(('wait_trigger', gpio, edge, count))
+
+    def glitch(self, output, voltage, delay, length):
+        self.events.append(('glitch', output, voltage, delay, length))
+
+    def set_vcc_now(self, output, voltage):
+        self.vcc[output] = voltage
+
+    def set_gpio_now(self, gpio, value):
+        self.gpio[gpio] = value
+
+    def start(self):
+        """
+        Run the program: apply the events until a trigger does not come, and let the target respond to the
+        glitches after the first trigger of every attempt.
+        """
+        self.runs += 1
+        triggers = self.triggers
+        seen = 0
+        attempts = []  # [glitches, time of the last trigger or glitch] per attempt
+        duration = 0.0
+        self._state = len(self.events)
+        self._finished = True
+        for index, event in enumerate(self.events):
+            name = event[0]
+            if name == 'set_vcc':
+                self.vcc[event[1]] = event[2]
+            elif name == 'set_gpio':
+                self.gpio[event[1]] = event[2]
+            elif name == 'wait_time':
+                duration += event[1]
+            elif name == 'wait_trigger':
+                if triggers is not None and triggers < event[3]:
+                    self._state = index
+                    self._finished = False
+                    break
+                if triggers is not None:
+                    triggers -= event[3]
+                duration += self.trigger_latency
+                if not attempts or (self.attempt_triggers and seen % self.attempt_triggers == 0):
+                    attempts.append([[], duration])
+                seen += event[3]
+                attempts[-1][1] = duration
+            elif name == 'glitch' and attempts:
+                attempts[-1][0].append(event[2:])
+                duration += event[3] + event[4]
+                attempts[-1][1] = duration
+        if not attempts:
+            attempts.append([[], duration])
+        self._duration = duration
+        self._started = perf_counter()
+        responses = [(end + self.response_delay, self.fault_model.response(glitches)) for glitches, end in attempts]
+        if self.realtime:
+            Thread(target=self._respond, args=(self._started, responses), name='simulated-target', daemon=True).start()
+        else:
+            for _, response in responses:
+                self.target.respond(response)
+
+    def _respond(self, started, responses):
+        for at, response in responses:
+            delay = started + at - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            self.target.respond(response)
+
+    def wait_until_finish(self, timeout):
+        """
+        :param timeout: the timeout in ms
+        :return: True if the program did not finish within the timeout
+        """
+        if self.realtime:
+            if self._finished:
+                sleep(max(0.0, self._started + self._duration - perf_counter()))
+            else:
+                sleep(timeout / 1000.0)
+        return not self._finished
+
+    def get_current_state(self):
+        return self._state
+
+
+def t1_block(inf, nad=0x00, pcb=0x00):
+    """
+    :return: a smartcard T=1 block: prologue, information field and LRC
+    """
+    block = bytes([nad, pcb, len(inf)]) + bytes(inf)
+    lrc = 0
+    for byte in block:
+        lrc ^= byte
+    return block + bytes([lrc])
+
+
+class SimulatedVCGlitcher:
+    """
+    VCGlitcher with a T=1 smartcard, for the loop of ``demo_setup_vcglitcher_tc6_vccfi.py``.
+
+    ``cpu_start`` runs the demo program: the card sends its ATR unless the skip reset flag at address 0 is set,
+    and answers the command with a T=1 block holding the status word of the outcome of the armed glitch pattern.
+    A muted card sends nothing; with ``realtime=True`` its CPU program then never stops.
+    """
+
+    STATUSES = {
+        NORMAL: b'\x69\x85',
+        FAULT: b'\x90\x00',
+        PARTIAL: b'\x6f\x00',
+        MUTE: b'',
+    }
+
+    def __init__(self, fault_model, atr=b'\x3b\xd5\x18\xff\x81\x91\xfe\x1f\xc3\x80\x73\xc8\x21\x10\x0a',
+                 statuses=None, realtime=False):
+        """
+        :param fault_model: decides the outcome from the glitch, with the pattern delay and length in 2 ns steps
+        :param atr: the ATR of the card
+        :param statuses: dict of outcome to the status word of the response, defaults to ``STATUSES``
+        :param realtime: a muted card keeps the CPU program running
+        """
+        self.fault_model = fault_model
+        self.atr = atr
+        self.statuses = dict(self.STATUSES if statuses is None else statuses)
+        self.realtime = realtime
+        self.memory = {}
+        self.v_glitch = 0.0
+        self.runs = 0
+        self._pattern = []
+        self._armed = False
+        self._command = b''
+        self._fifo = bytearray()
+        self._stopped = True
+
+    def set_vcc_glitch_parameter(self, v_vcc, v_clk, v_glitch):
+        self.v_glitch = v_glitch
+
+    def memory_write(self, address, value):
+        self.memory[address] = value
+
+    def smartcard_fifo_write(self, data):
+        self._command = bytes(data)
+
+    def smartcard_fifo_read(self, size):
+        """
+        :param size: number of bytes, 0 for all received bytes
+        """
+        size = size or len(self._fifo)
+        data = bytes(self._fifo[:size])
+        del self._fifo[:size]
+        return data
+
+    def evcg_clear_pattern(self):
+        self._pattern = []
+
+    def evcg_add_pattern(self, delay, length):
+        self._pattern.append((delay, length))
+
+    def evcg_set_pattern(self):
+        pass
+
+    def evcg_set_arm(self, armed):
+        self._armed = armed
+
+    def cpu_start(self):
+        self.runs += 1
+        glitches = [(self.v_glitch, delay * 2e-9, length * 2e-9) for delay, length in self._pattern]
+        outcome = self.fault_model.outcome(glitches if self._armed else [])
+        self._armed = False
+        if not self.memory.get(0):
+            self._fifo += self.atr
+        status = self.statuses[outcome]
+        if status:
+            self._fifo += t1_block(status)
+        self._stopped = bool(status) or not self.realtime
+
+    def is_cpu_stopped(self):
+        return self._stopped
+
+    def cpu_stop(self):
+        self._stopped = True
+
+
+class SimulatedScope:
+    """
+    Oscilloscope with the methods of the fipy scopes used by ``demo_tvla.py``, returning random byte samples.
+    """
+
+    def __init__(self, num_samples=10000, num_segments=1, seed=None):
+        """
+        :param num_samples: number of samples per trace, over all segments
+        :param num_segments: number of segments per trace
+        """
+        self.num_samples = num_samples
+        self._num_segments = num_segments
+        rng = random.Random(seed)
+        self._samples = rng.randbytes(2 * num_samples)
+        self._offset = 0
+        self.traces = 0
+
+    def num_segments(self):
+        return self._num_segments
+
+    def arm(self):
+        pass
+
+    def check_if_done(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def force_trigger(self):
+        pass
+
+    def read_trace(self, channel, arm=False):
+        """
+        :return: (samples, number of samples), the samples are a new bytes object like a read from a scope
+        """
+        self.traces += 1
+        self._offset = (self._offset + 7919) % self.num_samples
+        return self._samples[self._offset:self._offset + self.num_samples], self.num_samples
+
+    def close(self):
+        pass
+
+
+class SimulatedUtil:
+    """
+    The fipy script util methods used by ``Campaign``, without the fipy UI.
+    """
+
+    def __init__(self):
+        self.cleanup = []
+        self.monitored = 0
+
+    def process_commands(self):
+        return True
+
+    def monitor(self, result):
+        self.monitored += 1
+
+    def add_to_cleanup(self, function):
+        self.cleanup.append(function)
+
+    def close(self):
+        """
+        Run the cleanup functions, the last added first.
+        """
+        while self.cleanup:
+            self.cleanup.pop()()
+
+
+class ListDatabase:
+    """
+    Result database that keeps the rows in a list.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, row, commit_frequency=None):
+        self.rows.append(row)
+
+
+def simulated_parameters(attempts, seed=None):
+    """
+    Random parameters for the simulated campaign of ``main``, similar to a fifth_script sweep.
+    """
+    rng = random.Random(seed)
+    for _ in range(attempts):
+        yield {'glitch_delay': rng.randint(1000, 2000), 'glitch_length': rng.randint(20, 600),
+               'glitch_voltage': rng.uniform(-0.1, 0.2)}
+
+
+def simulated_campaign(util, bench):
+    """
+    Create a fifth_script-like campaign on a simulated Spider and target. Also a campaign factory for
+    ``common.orchestrator``.
+
+    :param util: the util of the campaign, e.g. a ``SimulatedUtil``
+    :param bench: dict with the optional settings 'seed', 'realtime' and 'pipelined'
+    :return: the ``Campaign``
+    """
+    from common.campaign import Campaign, arm_reset
+    from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+
+    glitcher, target = SimulatedChronology.with_target(FaultModel(seed=bench.get('seed')), timeout=0.01,
+                                                       realtime=bench.get('realtime', False))
+    classifier = Classifier([
+        Rule('PINK', Timeout()),
+        Rule('YELLOW', Exact(b'', b'\x00')),
+        Rule('ORANGE', Contains(b'0,aaa6,aaa5,')),
+        Rule('GREEN', Contains(b'1,aaa6,aaa5,')),
+        Rule('RED'),
+    ])
+
+    def arm(glitcher, p):
+        arm_reset(glitcher, 1, 0, 0.9, trigger_out=8)
+        glitcher.wait_trigger(0, 1, count=1)
+        glitcher.glitch(1, p['glitch_voltage'], p['glitch_delay'] / 1e9, p['glitch_length'] / 1e9)
+
+    def record(attempt):
+        return [('id', attempt.id), ('iter_t (ms)', attempt.elapsed_ms())] + list(attempt.parameters.items()) + [
+            ('spider_timeout', attempt.spider_timeout), ('Data', attempt.response), ('Color', attempt.color)]
+
+    return Campaign(util, glitcher, target, arm, lambda target, p: target.read(45), classifier, record,
+                    row_factory=tuple, pipelined=bench.get('pipelined', False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a simulated campaign and print its throughput.')
+    parser.add_argument('--attempts', type=int, default=10000)
+    parser.add_argument('--pipelined', action='store_true', help='log the attempts on a worker thread')
+    parser.add_argument('--realtime', action='store_true', help='take waits and timeouts in real time')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    util = SimulatedUtil()
+    db = ListDatabase()
+    campaign = simulated_campaign(util, {'seed': args.seed, 'realtime': args.realtime, 'pipelined': args.pipelined})
+    start = perf_counter()
+    campaign.run(simulated_parameters(args.attempts, args.seed), db)
+    elapsed = perf_counter() - start
+    util.close()
+
+    print('{} attempts in {:.2f} s, {:.0f} attempts/s'.format(campaign.counter, elapsed, campaign.counter / elapsed))
+    print('Colors: {}'.format(dict(Counter(row[-1][1] for row in db.rows))))
+
+
+if __name__ == '__main__':
+    main()
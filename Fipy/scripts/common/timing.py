@@ -0,0 +1,99 @@
+'''Latency histograms of the campaign stages.
+
+``StageTimes`` collects durations in nanoseconds per stage, e.g. 'read' or 'finish', in log-linear buckets: four
+buckets per power of two, so percentiles are accurate to within 25% and memory stays constant however many
+attempts a campaign runs. ``Campaign(timing=True)`` fills one and prints it at the end of the campaign:
+
+    stage           count    mean us     p50 us     p99 us     max us
+    read            10000     1203.4     1179.6     1572.9     2041.2
+'''
+
+from threading import Lock
+
+
+def _bucket(ns):
+    bits = ns.bit_length()
+    if bits <= 3:
+        return ns
+    return (bits - 2) * 4 + ((ns >> (bits - 3)) & 3)
+
+
+def _bucket_limit(bucket):
+    """Largest duration in a bucket."""
+    if bucket < 8:
+        return bucket
+    bits = bucket // 4 + 2
+    return ((4 + bucket % 4 + 1) << (bits - 3)) - 1
+
+
+class StageTimes:
+    """
+    Histograms of the durations of named stages.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._totals = {}
+        self._maxima = {}
+        self._lock = Lock()
+
+    def add(self, stage, ns):
+        """
+        :param stage: the name of the stage
+        :param ns: the duration in nanoseconds
+        """
+        bucket = _bucket(ns)
+        with self._lock:
+            counts = self._counts.get(stage)
+            if counts is None:
+                counts = self._counts[stage] = {}
+                self._totals[stage] = 0
+                self._maxima[stage] = 0
+            counts[bucket] = counts.get(bucket, 0) + 1
+            self._totals[stage] += ns
+            if ns > self._maxima[stage]:
+                self._maxima[stage] = ns
+
+    def add_all(self, times):
+        """
+        :param times: dict of stage to duration in nanoseconds
+        """
+        for stage, ns in times.items():
+            self.add(stage, ns)
+
+    def percentile(self, stage, fraction):
+        """
+        :param fraction: e.g. 0.99 for the 99th percentile
+        :return: the upper limit in nanoseconds of the bucket holding the percentile
+        """
+        with self._lock:
+            counts = self._counts[stage]
+            rank = fraction * sum(counts.values())
+            seen = 0
+            for bucket in sorted(counts):
+                seen += counts[bucket]
+                if seen >= rank:
+                    return min(_bucket_limit(bucket), self._maxima[stage])
+            return self._maxima[stage]
+
+    def summary(self):
+        """
+        :return: a (stage, count, mean, p50, p99, max) tuple per stage in the order they were first added,
+            durations in nanoseconds
+        """
+        rows = []
+        for stage in list(self._counts):
+            count = sum(self._counts[stage].values())
+            rows.append((stage, count, self._totals[stage] / count, self.percentile(stage, 0.5),
+                         self.percentile(stage, 0.99), self._maxima[stage]))
+        return rows
+
+    def report(self):
+        """
+        Print the summary in microseconds.
+        """
+        print('{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'count', 'mean us', 'p50 us', 'p99 us',
+                                                                 'max us'))
+        for stage, count, mean, p50, p99, maximum in self.summary():
+            print('{:<12} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                stage, count, mean / 1e3, p50 / 1e3, p99 / 1e3, maximum / 1e3))
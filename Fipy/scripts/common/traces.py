@@ -0,0 +1,217 @@
+'''Scope captures to trace sets.
+
+In sequence mode a scope captures ``num_segments`` traces per arm, returned as one buffer of samples.
+``split_segments`` views that buffer as a (segments, samples) numpy array without copying it, so the segments can
+be added to the trace set with one ``extend`` and to a ``WelchTTest`` with one ``add``, instead of slicing and
+handling every segment in Python:
+
+>>> samples, num_samples = scope.read_trace(channel, arm=False)
+>>> segments = split_segments(samples, num_samples, num_segments)
+>>> traceset.extend([Trace(SampleCoding.BYTE, segment, parameters=trace_params, title=title) for segment in segments])
+
+Writing to the trace set on the acquisition thread delays the next ``scope.arm()`` whenever the disk is slow.
+``TraceWriter`` collects the samples, parameters and titles of the traces in a buffer on the acquisition thread, and
+hands full buffers to a background thread, which creates the traces and writes each buffer with one ``extend``.
+While one buffer is written the next one fills. A buffer is handed over when it holds ``chunk_size`` traces, when
+``flush_interval`` seconds passed since the previous one, on ``flush`` and on ``close``. When ``queue_size``
+buffers are waiting, the acquisition blocks until one is written: that back-pressure, the write latency and the
+throughput are printed by ``report``:
+
+>>> writer = open_trace_writer(util, traceset)
+>>> writer.add_segments(segments, trace_params, title)
+
+The samples are written later, so they must not change after they were added, use ``copy=True`` for a buffer that
+the scope reuses. Samples that are immutable bytes, or arrays on them like the segments of ``split_segments``, are
+not copied.
+'''
+
+from queue import Full, Queue
+from threading import Thread
+from time import perf_counter
+
+import numpy
+
+
+def split_segments(samples, num_samples, num_segments, dtype=numpy.int8):
+    """
+    :param samples: the samples of all segments, as bytes or an array
+    :param num_samples: number of samples of all segments. Samples after the last whole segment are left out.
+    :param num_segments: number of segments
+    :param dtype: the type of the samples when they are bytes, int8 for ``SampleCoding.BYTE``
+    :return: a (num_segments, num_samples // num_segments) array, a view on ``samples`` when it is bytes or an array
+    """
+    if isinstance(samples, (bytes, bytearray, memoryview)):
+        samples = numpy.frombuffer(samples, dtype=dtype)
+    else:
+        samples = numpy.asarray(samples)
+    length = num_samples // num_segments
+    return samples[:num_segments * length].reshape(num_segments, length)
+
+
+def _copy(samples):
+    if isinstance(samples, bytes):
+        return samples
+    if isinstance(samples, (bytearray, memoryview)):
+        return bytes(samples)
+    base = samples
+    while isinstance(base, numpy.ndarray) and base.base is not None:
+        base = base.base
+    if isinstance(base, bytes):
+        # A view on bytes, which do not change
+        return samples
+    return numpy.array(samples)
+
+
+def byte_trace(samples, parameters, title):
+    """
+    :return: a ``Trace`` with ``SampleCoding.BYTE`` samples, the default of ``TraceWriter``
+    """
+    from trsfile import SampleCoding, Trace
+
+    if parameters is None:
+        return Trace(SampleCoding.BYTE, samples, title=title)
+    return Trace(SampleCoding.BYTE, samples, parameters=parameters, title=title)
+
+
+class TraceWriter:
+    """
+    Writes traces to a trace set on a background thread, a buffer of traces at a time.
+    """
+
+    def __init__(self, traceset, make_trace=byte_trace, chunk_size=256, queue_size=4, flush_interval=1.0):
+        """
+        :param traceset: the opened trace set, it is not closed by the writer
+        :param make_trace: function ``(samples, parameters, title) -> Trace``, called on the background thread
+        :param chunk_size: number of traces written at once
+        :param queue_size: number of full buffers that can wait for the background thread before ``add`` blocks
+        :param flush_interval: maximum number of seconds a trace waits in the buffer, checked when a trace is added
+        """
+        self.traceset = traceset
+        self.make_trace = make_trace
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.traces = 0
+        self.samples = 0
+        self.write_times = []
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.max_queued = 0
+        self._buffer = []
+        self._last_flush = perf_counter()
+        self._started = self._last_flush
+        self._queue = Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = Thread(target=self._write, name='trace-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, samples, parameters=None, title='', copy=False):
+        """
+        Buffer a trace, and hand the buffer to the background thread when it is full or old enough.
+
+        :param samples: the samples of the trace
+        :param parameters: the ``TraceParameterMap`` of the trace, or None
+        :param copy: copy the samples, for a buffer that is reused. Bytes, and arrays on bytes, are not copied.
+        """
+        if copy:
+            samples = _copy(samples)
+        self._buffer.append((samples, parameters, title))
+        if len(self._buffer) >= self.chunk_size or perf_counter() - self._last_flush >= self.flush_interval:
+            self._submit()
+
+    def add_segments(self, segments, parameters=None, title='', copy=False):
+        """
+        Buffer a trace per row of ``segments``, e.g. from ``split_segments``, all with the same parameters and title.
+        """
+        if copy:
+            segments = _copy(segments)
+        self._buffer.extend((segment, parameters, title) for segment in segments)
+        if len(self._buffer) >= self.chunk_size or perf_counter() - self._last_flush >= self.flush_interval:
+            self._submit()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError('Writing the traces failed: {}'.format(self._error)) from self._error
+
+    def _submit(self):
+        self._check()
+        if self._buffer:
+            buffer, self._buffer = self._buffer, []
+            try:
+                self._queue.put_nowait(buffer)
+            except Full:
+                # Back-pressure: the disk does not keep up with the acquisition
+                start = perf_counter()
+                self._queue.put(buffer)
+                self.stalls += 1
+                self.stall_time += perf_counter() - start
+            self.max_queued = max(self.max_queued, self._queue.qsize())
+        self._last_flush = perf_counter()
+
+    def _write(self):
+        while True:
+            buffer = self._queue.get()
+            try:
+                if buffer is None:
+                    return
+                if self._error is None:
+                    start = perf_counter()
+                    self.traceset.extend([self.make_trace(*trace) for trace in buffer])
+                    self.write_times.append(perf_counter() - start)
+                    self.traces += len(buffer)
+                    self.samples += sum(len(samples) for samples, _, _ in buffer)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Write the buffered traces and wait until they are written.
+        """
+        self._submit()
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Write the buffered traces and stop the background thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+    def report(self):
+        """
+        Print the number of traces written, the write latency and throughput, and how long the acquisition waited.
+        """
+        if not self.write_times:
+            return
+        times = sorted(self.write_times)
+        elapsed = perf_counter() - self._started
+        print('Traces: {} traces in {} writes, write latency mean {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms, '
+              '{:.1f} Msamples/s while writing'.format(
+                self.traces, len(times), 1000 * sum(times) / len(times),
+                1000 * times[min(int(len(times) * 0.99), len(times) - 1)], 1000 * times[-1],
+                self.samples / max(sum(times), 1e-9) / 1e6))
+        print('Trace writer: {:.1f} traces/s, acquisition waited {} times for {:.2f} s, at most {} buffers '
+              'queued'.format(self.traces / max(elapsed, 1e-9), self.stalls, self.stall_time, self.max_queued))
+
+
+def open_trace_writer(util, traceset, **kwargs):
+    """
+    Start a ``TraceWriter`` that is flushed and stopped on cleanup, before the trace set is closed when it was
+    added to the cleanup before.
+
+    :param util: the fipy script util
+    :param kwargs: passed on to ``TraceWriter``
+    :return: the writer
+    """
+    writer = TraceWriter(traceset, **kwargs)
+    util.add_to_cleanup(writer.close)
+    return writer
@@ -0,0 +1,180 @@
+'''Welch's t-test of TVLA traces, updated while they are acquired.
+
+``WelchTTest`` keeps the number of traces, the mean and the central moment sums of every sample for the fixed (0)
+and random (1) TVLA group. A batch of traces, e.g. the segments of one scope capture, is merged into them with the
+pairwise update formulas of Pébay (2008), which stay accurate over millions of traces, unlike sums of powers.
+The first order test compares the means, the second order test the variances (the means of the centered squared
+samples), which needs moments up to the fourth.
+
+Computing the t-statistics costs a pass over all samples, so ``checkpoint`` only does it every ``interval``
+traces. It then writes a snapshot next to the trace set and tells whether the largest |t| crossed ``threshold``
+with at least ``min_traces`` traces in both groups, so the acquisition can stop early:
+
+>>> ttest = WelchTTest(order=2, snapshot_path=TRACE_PATH / '{}.ttest.npz'.format(ts_filename))
+>>> ttest.add(tvla_group, segments)
+>>> if ttest.checkpoint():
+...     break
+
+A snapshot is a numpy ``.npz`` file with the counts, means and variances of both groups and the t-statistics per
+order ('t1', 't2'), it is replaced atomically so it can be loaded while the acquisition runs.
+'''
+
+import os
+
+import numpy
+
+
+def _merge(a, b):
+    """
+    Pébay's update of the moments: ``a`` becomes the moments of the traces of ``a`` and ``b``.
+
+    :param a: [n, mean, M2, M3, M4], the moment sums of the highest order can be left out
+    :param b: the moments of the new traces, the same length as ``a``
+    """
+    na, nb = a[0], b[0]
+    n = na + nb
+    delta = b[1] - a[1]
+    a[1] = a[1] + delta * nb / n
+    if len(a) > 4:
+        a[4] = (a[4] + b[4] + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+                + 6 * delta ** 2 * (na * na * b[2] + nb * nb * a[2]) / n ** 2 + 4 * delta * (na * b[3] - nb * a[3]) / n)
+    if len(a) > 3:
+        a[3] = a[3] + b[3] + delta ** 3 * na * nb * (na - nb) / n ** 2 + 3 * delta * (na * b[2] - nb * a[2]) / n
+    a[2] = a[2] + b[2] + delta ** 2 * na * nb / n
+    a[0] = n
+
+
+def _welch(mean0, var0, n0, mean1, var1, n1):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = (mean0 - mean1) / numpy.sqrt(var0 / n0 + var1 / n1)
+    # Samples that are constant in both groups do not leak
+    return numpy.nan_to_num(t, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+class WelchTTest:
+    """
+    Per-sample Welch t-statistics of the fixed and random TVLA groups.
+    """
+
+    def __init__(self, order=1, threshold=4.5, min_traces=1000, interval=1000, snapshot_path=None, dtype=numpy.int8):
+        """
+        :param order: the highest order of the tests, 1 or 2
+        :param threshold: |t| above which a sample leaks, 4.5 by convention
+        :param min_traces: number of traces both groups need before a leak stops the acquisition
+        :param interval: number of traces between checkpoints
+        :param snapshot_path: the file the checkpoints write, None for no snapshots
+        :param dtype: the type of the samples when they are bytes, int8 for ``SampleCoding.BYTE``
+        """
+        if order not in (1, 2):
+            raise ValueError('Only first and second order tests are supported, not order {}'.format(order))
+        self.order = order
+        self.threshold = threshold
+        self.min_traces = min_traces
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.dtype = dtype
+        self.traces = 0
+        self.max_t = {}
+        self._groups = None
+        self._checked = 0
+
+    def add(self, group, samples):
+        """
+        :param group: the TVLA group of the traces, 0 for fixed or 1 for random
+        :param samples: the samples of one trace, or a (traces, samples) array of traces, as a numpy array or bytes
+        """
+        if isinstance(samples, (bytes, bytearray, memoryview)):
+            samples = numpy.frombuffer(samples, dtype=self.dtype)
+        samples = numpy.asarray(samples, dtype=numpy.float64)
+        if samples.ndim == 1:
+            samples = samples[numpy.newaxis]
+        if not len(samples):
+            return
+        if self._groups is None:
+            zeros = numpy.zeros(samples.shape[1])
+            self._groups = [[0] + [zeros] * (2 * self.order) for _ in range(2)]
+        if len(samples) == 1:
+            # The central moments of a single trace are 0
+            moments = [1, samples[0]] + [0.0] * (2 * self.order - 1)
+        else:
+            mean = samples.mean(axis=0)
+            moments = [len(samples), mean]
+            deviations = samples - mean
+            power = deviations
+            for _ in range(2 * self.order - 1):
+                power = power * deviations
+                moments.append(power.sum(axis=0))
+        _merge(self._groups[group], moments)
+        self.traces += len(samples)
+
+    def counts(self):
+        """
+        :return: the number of traces of the fixed and random group
+        """
+        if self._groups is None:
+            return 0, 0
+        return self._groups[0][0], self._groups[1][0]
+
+    def statistics(self):
+        """
+        :return: dict of 't1' and, for order 2, 't2' to the t-statistic of every sample, empty while a group has
+            fewer than two traces
+        """
+        if min(self.counts()) < 2:
+            return {}
+        (n0, mean0, m20, *high0), (n1, mean1, m21, *high1) = self._groups
+        result = {'t1': _welch(mean0, m20 / (n0 - 1), n0, mean1, m21 / (n1 - 1), n1)}
+        if self.order >= 2:
+            # The centered squares have mean M2 / n and variance M4 / n - (M2 / n) ** 2
+            square0, square1 = m20 / n0, m21 / n1
+            result['t2'] = _welch(square0, high0[1] / n0 - square0 ** 2, n0,
+                                  square1, high1[1] / n1 - square1 ** 2, n1)
+        return result
+
+    def leaking(self, statistics=None):
+        """
+        :param statistics: the result of ``statistics``, computed when not given
+        :return: True when both groups have ``min_traces`` traces and a |t| of any order is above the threshold
+        """
+        if min(self.counts()) < self.min_traces:
+            return False
+        if statistics is None:
+            statistics = self.statistics()
+        return any(numpy.abs(t).max() > self.threshold for t in statistics.values())
+
+    def checkpoint(self, force=False):
+        """
+        Every ``interval`` traces: compute the t-statistics, print the largest |t| of every order, write the
+        snapshot and check for leakage.
+
+        :param force: do it now, e.g. at the end of the acquisition
+        :return: True when the acquisition can stop, see ``leaking``
+        """
+        if not force and self.traces - self._checked < self.interval:
+            return False
+        self._checked = self.traces
+        statistics = self.statistics()
+        if not statistics:
+            return False
+        n0, n1 = self.counts()
+        for name, t in statistics.items():
+            index = int(numpy.abs(t).argmax())
+            self.max_t[name] = abs(float(t[index]))
+            print('TVLA {}: max |t| {:.2f} at sample {}, {} fixed and {} random traces'.format(
+                name, self.max_t[name], index, n0, n1))
+        if self.snapshot_path is not None:
+            self.save(self.snapshot_path, statistics)
+        return self.leaking(statistics)
+
+    def save(self, path, statistics=None):
+        """
+        Write the counts, means, variances and t-statistics to a numpy ``.npz`` file, replacing it atomically.
+        """
+        if statistics is None:
+            statistics = self.statistics()
+        (n0, mean0, m20, *_), (n1, mean1, m21, *_) = self._groups
+        temporary = '{}.tmp'.format(path)
+        with open(temporary, 'wb') as f:
+            numpy.savez(f, n=numpy.array([n0, n1]), mean0=mean0, mean1=mean1,
+                        var0=m20 / max(n0 - 1, 1), var1=m21 / max(n1 - 1, 1), **statistics)
+        os.replace(temporary, path)
@@ -0,0 +1,288 @@
+'''TVLA input blocks read from a memory-mapped file.
+
+A TVLA input file of the SABuild "GenerateData" module is a sequence of fixed size blocks: the input, followed by
+the key in dual state. Reading the whole file at the start of a campaign takes minutes and as much memory as the
+file for large sets. ``TVLAInputs`` maps the file instead, and returns a block as a view on the map, so only the
+pages of the blocks that were used are read, and the operating system can drop them again. The index wraps around
+at the end of the file, like the ``tvla_counter`` of the script:
+
+>>> tvla_inputs = open_tvla_inputs(util, METADATA_PATH / '10k_aes_dec_hw_r5_0-7_dual_state', 32, prefetch=4096)
+>>> data = bytes(tvla_inputs[tvla_counter])
+
+With ``prefetch`` the blocks after the one that is used are read ahead, ``prefetch`` blocks at a time: with
+``madvise`` where the platform has it, otherwise by reading their pages on a background thread. A campaign then
+does not wait for the disk when it gets to a block the first time.
+
+``TVLASchedule`` draws the group of every trace, takes its input (and key in dual state) from the file for the
+fixed group or at random for the random group, and computes the expected AES output, for ``chunk_size`` traces at
+a time on a background thread. One decryptor decrypts all inputs of a chunk with the same key in one ECB call, so
+a fixed key costs one call per chunk. The random keys of dual state still need a decryptor each. The acquisition
+loop takes the traces from a ring of ``depth`` chunks:
+
+>>> schedule = open_tvla_schedule(util, tvla_inputs, dual_state=True, in_bytes=16)
+>>> trace = next(schedule)
+>>> trace.group, trace.input, trace.key, trace.output
+'''
+
+import mmap
+from collections import namedtuple
+from queue import Empty, Queue
+from threading import Thread
+
+import numpy
+
+
+class TVLAInputs:
+    """
+    The blocks of a TVLA input file, as views on a memory map.
+    """
+
+    def __init__(self, path, block_size, prefetch=0):
+        """
+        :param path: the TVLA input file
+        :param block_size: the number of bytes per block, e.g. 16 for an input and 32 for an input and a key.
+            Bytes after the last complete block are ignored.
+        :param prefetch: number of blocks to read ahead, 0 to only read a block when it is used
+        :raises ValueError: when the file does not hold a single block
+        """
+        self.path = path
+        self.block_size = block_size
+        self.prefetch = prefetch
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = len(self._map) // block_size
+        if not count:
+            self._map.close()
+            raise ValueError('{} holds {} bytes, less than one block of {} bytes'.format(
+                path, len(self._map), block_size))
+        self.blocks = numpy.frombuffer(self._map, dtype=numpy.uint8, count=count * block_size).reshape(
+            count, block_size)
+        if prefetch and hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._ahead = (0, 0)
+        self._thread = None
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def nbytes(self):
+        """
+        The number of bytes of the blocks.
+        """
+        return self.blocks.nbytes
+
+    def __getitem__(self, index):
+        """
+        :param index: the index of the block, wrapped around at the end of the file
+        :return: the block as a read-only uint8 array on the map
+        """
+        index %= len(self.blocks)
+        if self.prefetch:
+            start, end = self._ahead
+            if end < len(self.blocks):
+                # Read the next blocks ahead when half of the blocks read ahead were used
+                end -= self.prefetch // 2
+            if not start <= index < end:
+                self._read_ahead(index)
+        return self.blocks[index]
+
+    def take(self, index, count):
+        """
+        :param index: the index of the first block, wrapped around at the end of the file
+        :param count: number of blocks
+        :return: a (count, block_size) array, a view on the map unless the blocks wrap around
+        """
+        index %= len(self.blocks)
+        if self.prefetch:
+            self._read_ahead((index + count) % len(self.blocks))
+        if index + count <= len(self.blocks):
+            return self.blocks[index:index + count]
+        return numpy.take(self.blocks, range(index, index + count), axis=0, mode='wrap')
+
+    def _read_ahead(self, index):
+        """
+        Read the ``prefetch`` blocks from ``index`` on ahead.
+        """
+        end = min(index + self.prefetch, len(self.blocks))
+        self._ahead = index, end
+        start = index * self.block_size // mmap.PAGESIZE * mmap.PAGESIZE
+        length = end * self.block_size - start
+        if length <= 0:
+            return
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_WILLNEED, start, length)
+        elif self._thread is None or not self._thread.is_alive():
+            self._thread = Thread(target=self._touch, args=(start, start + length), name='tvla-prefetch',
+                                  daemon=True)
+            self._thread.start()
+
+    def _touch(self, start, end):
+        try:
+            for offset in range(start, end, mmap.PAGESIZE):
+                self._map[offset]
+        except ValueError:
+            # Closed while reading ahead
+            pass
+
+    def close(self):
+        """
+        Close the map. When views on it are still used, it is closed when the last one is gone.
+        """
+        self.blocks = None
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+
+
+def open_tvla_inputs(util, path, block_size, prefetch=0):
+    """
+    Map a TVLA input file and close it on cleanup.
+
+    :param util: the fipy script util
+    :return: the ``TVLAInputs``
+    """
+    inputs = TVLAInputs(path, block_size, prefetch=prefetch)
+    util.add_to_cleanup(inputs.close)
+    return inputs
+
+
+# A trace of a ``TVLASchedule``: its TVLA group, 0 for fixed and 1 for random, the input, key and expected output
+# as bytes, and the index of the input block for the fixed group, None for the random group
+ScheduledTrace = namedtuple('ScheduledTrace', ['group', 'input', 'key', 'output', 'block'])
+
+
+class TVLASchedule:
+    """
+    The groups, inputs, keys and expected outputs of the next traces, computed in chunks on a background thread.
+    """
+
+    def __init__(self, inputs, dual_state, in_bytes=16, key=None, chunk_size=1024, depth=4, seed=None):
+        """
+        :param inputs: the ``TVLAInputs`` of the fixed group. In dual state a block holds the input and the key.
+        :param dual_state: take the key of the fixed group from the blocks and draw random keys for the random
+            group, instead of using ``key``
+        :param in_bytes: the number of bytes of an input, a multiple of the AES block size
+        :param key: the AES key when not in dual state
+        :param chunk_size: number of traces computed at once
+        :param depth: number of chunks computed ahead
+        :param seed: seed of the random generator of the groups, inputs and keys
+        """
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        if not dual_state and key is None:
+            raise ValueError('A TVLA schedule needs a key when it is not in dual state')
+        self.inputs = inputs
+        self.dual_state = dual_state
+        self.in_bytes = in_bytes
+        self.key = None if key is None else bytes(key)
+        self.chunk_size = chunk_size
+        self.traces = 0
+        ecb = modes.ECB()
+        backend = default_backend()
+        self._decryptor = lambda key: Cipher(algorithms.AES(key), ecb, backend).decryptor()
+        self._fixed_decryptor = None if dual_state else self._decryptor(self.key)
+        self._width = inputs.block_size if dual_state else in_bytes
+        self._rng = numpy.random.default_rng(seed)
+        self._block = 0
+        self._chunk = iter(())
+        self._ring = Queue(maxsize=depth)
+        self._running = True
+        self._thread = Thread(target=self._produce, name='tvla-schedule', daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        while self._running:
+            try:
+                chunk = self.compute(self.chunk_size)
+            except Exception as e:
+                chunk = e
+            self._ring.put(chunk)
+            if isinstance(chunk, Exception):
+                return
+
+    def compute(self, count):
+        """
+        Compute the next traces. Used by the background thread, the traces of a chunk follow each other.
+
+        :return: a list of ``ScheduledTrace``
+        """
+        in_bytes = self.in_bytes
+        groups = self._rng.integers(0, 2, count, dtype=numpy.uint8)
+        data = self._rng.integers(0, 256, (count, self._width), dtype=numpy.uint8)
+        fixed = numpy.flatnonzero(groups == 0)
+        data[fixed] = self.inputs.take(self._block, len(fixed))[:, :self._width]
+        blocks = numpy.full(count, -1)
+        blocks[fixed] = (self._block + numpy.arange(len(fixed))) % len(self.inputs)
+        self._block = (self._block + len(fixed)) % len(self.inputs)
+
+        inputs = numpy.ascontiguousarray(data[:, :in_bytes])
+        if self.dual_state:
+            keys = data[:, in_bytes:]
+            outputs = numpy.empty_like(inputs)
+            # One decryptor per distinct key, for all inputs with that key
+            unique_keys, inverse, counts = numpy.unique(keys, axis=0, return_inverse=True, return_counts=True)
+            order = numpy.argsort(inverse.reshape(-1), kind='stable')
+            end = 0
+            for key, key_count in zip(unique_keys, counts):
+                rows = order[end:end + key_count]
+                end += key_count
+                decrypted = self._decryptor(key.tobytes()).update(inputs[rows].tobytes())
+                outputs[rows] = numpy.frombuffer(decrypted, dtype=numpy.uint8).reshape(-1, in_bytes)
+            keys = [row.tobytes() for row in keys]
+        else:
+            outputs = numpy.frombuffer(self._fixed_decryptor.update(inputs.tobytes()), dtype=numpy.uint8).reshape(
+                -1, in_bytes)
+            keys = [self.key] * count
+
+        input_bytes = inputs.tobytes()
+        output_bytes = outputs.tobytes()
+        return [ScheduledTrace(group, input_bytes[i * in_bytes:(i + 1) * in_bytes], key,
+                               output_bytes[i * in_bytes:(i + 1) * in_bytes], None if block < 0 else block)
+                for i, (group, key, block) in enumerate(zip(groups.tolist(), keys, blocks.tolist()))]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        :return: the ``ScheduledTrace`` of the next trace
+        """
+        trace = next(self._chunk, None)
+        if trace is None:
+            chunk = self._ring.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            self._chunk = iter(chunk)
+            trace = next(self._chunk)
+        self.traces += 1
+        return trace
+
+    def close(self):
+        """
+        Stop the background thread.
+        """
+        self._running = False
+        while self._thread.is_alive():
+            try:
+                self._ring.get(timeout=0.1)
+            except Empty:
+                pass
+        self._thread.join()
+
+
+def open_tvla_schedule(util, inputs, dual_state, **kwargs):
+    """
+    Start a ``TVLASchedule`` and stop it on cleanup.
+
+    :param util: the fipy script util
+    :param kwargs: passed on to ``TVLASchedule``
+    :return: the schedule
+    """
+    schedule = TVLASchedule(inputs, dual_state, **kwargs)
+    util.add_to_cleanup(schedule.close)
+    return schedule
@@ -6,6 +6,8 @@ import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
+from common.broker import connect_broker
+from common.serialreader import byte_time, open_framed_reader, read_bytes
 from spidersdk.chronology import Chronology
 from spidersdk.spider import Spider
 
@@ -28,6 +30,12 @@ RESET_OUT  = 0
 TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 
+# A response is complete when the target is silent for this many byte times, e.g. 32, 0 for the whole response
+IDLE_BYTES = 0
+# Use the Spider and target of a device broker at this (host, port), e.g. ('localhost', 6010), instead of opening
+# the ports, so the run starts with a warm Spider. Start it with: python -m common.broker <Spider COM> <Target COM>
+BROKER_ADDRESS = None
+
 
 @fipy_script
 def execute_script(util):
@@ -39,29 +47,37 @@ def execute_script(util):
                                     '{}'.format(script_name))
     util.add_to_cleanup(util.close_database)
 
-    # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
-
-    # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
+    if BROKER_ADDRESS:
+        # The broker holds the Spider and the target, with the ports of its command line
+        glitcher, reader, _ = connect_broker(util, BROKER_ADDRESS, baudrate=PARAMETERS['serial_baudrate'])
+        reader.timeout = float(PARAMETERS['serial_timeout'])
+    else:
+        # Hardware initialization (Spider)
+        spider_com_port = serial.Serial()
+        spider_com_port.port = str(PARAMETERS['spider_com_port'])
+        spider_com_port.open()
+        spider_core1 = Spider(Spider.CORE1, spider_com_port)
+        spider_core1.reset_settings()
+        util.add_to_cleanup(spider_com_port.close)
+
+        # Hardware initialization (Pinata)
+        serial_target = serial.Serial()
+        serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
+        serial_target.timeout = float(PARAMETERS['serial_timeout'])
+        serial_target.port = str(PARAMETERS['serial_com_port'])
+        serial_target.open()
+        serial_target.reset_input_buffer()
+        serial_target.reset_output_buffer()
+        util.add_to_cleanup(serial_target.close)
+        # Only a background reader returns when the target is silent, a plain read is as fast otherwise
+        reader = open_framed_reader(util, serial_target) if IDLE_BYTES else serial_target
+
+        try:
+            glitcher = Chronology(spider_core1)
+        except IndexError as e:
+            raise Exception(str(e) +
+                            "\n\nDid you select the right COM port for Spider? Is it powered on?")
+    idle = IDLE_BYTES * byte_time(PARAMETERS['serial_baudrate']) if IDLE_BYTES else None
 
 
     glitcher.forget_events()  # Forget any previous added events
@@ -78,8 +94,8 @@ def execute_script(util):
         if not util.process_commands():
             break
             
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
+        reader.reset_input_buffer()
+        reader.reset_output_buffer()
         glitcher.forget_events()  
 
         glitcher.set_gpio(RESET_OUT, 0)
@@ -99,10 +115,10 @@ def execute_script(util):
             
         glitcher.start()  
 
-        response = serial_target.read(31)
+        response = read_bytes(reader, 31, idle=idle)
         
         if b'\x00' in response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            response = response+serial_target.read(1)
+            response = response+read_bytes(reader, 1, idle=idle, wait_first=False)
         print(response)
         print(len(response))
         # Block for 1 second or until Spider reaches final state.
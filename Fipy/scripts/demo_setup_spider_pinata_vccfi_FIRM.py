@@ -32,6 +32,7 @@ import serial
 from fipy.parameters import *
 from fipy.plugins.firm.scriptutils import firm_run
 from fipy.scriptutils import ResultColor, fipy_script
+from common.serialreader import byte_time, open_framed_reader, read_bytes
 from spidersdk.chronology import Chronology
 from spidersdk.spider import Spider
 
@@ -62,6 +63,8 @@ TRIGGER_EDGE = Spider.RISING_EDGE
 
 READ_MARGIN = 1024  # Number of additional bytes to check for.
 RESPONSE_LENGTH = 136  # Length of the expected/success response
+# A response is complete when the target is silent for this many byte times, e.g. 32, 0 for the whole response
+IDLE_BYTES = 0
 
 def reset(glitcher, normal_vcc):
     glitcher.set_vcc_now(GLITCH_OUT, 0)
@@ -115,6 +118,10 @@ def execute_script(util):
     reset(glitcher, float(PARAMETERS['normal_voltage']))
     # Get test properties from device. This includes reading expected data and setting the test commands.
     test_properties = TestProperties.get_test_properties(serial_target)
+    # With an idle time, read the responses on a background thread from now on, so reads return as soon as the
+    # target is silent
+    reader = open_framed_reader(util, serial_target) if IDLE_BYTES else serial_target
+    idle = IDLE_BYTES * byte_time(serial_target.baudrate) if IDLE_BYTES else None
 
     counter = 0
     do_reset = True
@@ -134,8 +141,8 @@ def execute_script(util):
         if do_reset or test_type == TestType.REGISTER:
             reset(glitcher, normal_vcc)
             do_reset = False
-            serial_target.reset_input_buffer()
-            serial_target.reset_output_buffer()
+            reader.reset_input_buffer()
+            reader.reset_output_buffer()
 
         # Configure state machine for glitch with current parameters
         glitcher.set_gpio(TRIGGER_OUT, 1)
@@ -152,8 +159,8 @@ def execute_script(util):
         glitcher.start()
 
         # Send the command to perform the specific test application
-        serial_target.write(test.cmd)
-        received = serial_target.read(len(test.expected))
+        reader.write(test.cmd)
+        received = read_bytes(reader, len(test.expected), idle=idle)
 
         # Block for 1 second or until Spider reaches final state.
         spider_timeout = glitcher.wait_until_finish(1000)
@@ -162,7 +169,7 @@ def execute_script(util):
             color = ResultColor.PINK  # no trigger, check setup
         else:
             # Check if there are more bytes
-            received += serial_target.read(READ_MARGIN)
+            received += read_bytes(reader, READ_MARGIN, idle=idle, wait_first=False)
             if received == test.expected:
                 color = ResultColor.GREEN
             elif len(received) <= 1:
@@ -1,12 +1,8 @@
 import datetime
 from time import time, sleep
 from pathlib import Path
-import numpy
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-
-from trsfile import Header, SampleCoding, Trace, TracePadding, trs_open
+from trsfile import Header, SampleCoding, TracePadding, trs_open
 
 from trsfile.standardparameters import (
     StandardTraceParameters,
@@ -27,6 +23,10 @@ from fipy.scriptutils import ResultColor, fipy_script, Util
 from fipy.device.lecroyscope import LecroyScope
 from fipy.transformutil import TransformUtil
 
+from common.traces import open_trace_writer, split_segments
+from common.ttest import WelchTTest
+from common.tvla import open_tvla_inputs, open_tvla_schedule
+
 
 # Comment out channels you don't want to measure.
 CHANNELS_ENABLED = [
@@ -39,6 +39,24 @@ CHANNELS_ENABLED = [
 IN_BYTES = 16
 KEY_BYTES = 16
 
+# Number of TVLA input blocks read ahead from the file while sampling, 0 for none
+TVLA_PREFETCH_BLOCKS = 65536
+# Number of traces whose inputs and expected outputs are computed at once
+TVLA_SCHEDULE_CHUNK = 1024
+# Number of traces written to the trace set at once, on a background thread
+TRACE_WRITE_CHUNK = 256
+
+# Welch's t-test of the traces of every channel while they are acquired, up to
+# this order (1 or 2), 0 for none. A snapshot of the t-statistics is written next
+# to the trace set every TTEST_INTERVAL traces.
+TTEST_ORDER = 1
+TTEST_INTERVAL = 10000
+# Stop when a sample leaks: |t| above TTEST_THRESHOLD with at least
+# TTEST_MIN_TRACES traces in both TVLA groups
+TTEST_EARLY_STOP = False
+TTEST_THRESHOLD = 4.5
+TTEST_MIN_TRACES = 10000
+
 # tu needs to global as it is needed for the PARAMETERS, as well as the script
 tu = TransformUtil()
 
@@ -94,14 +112,14 @@ def execute_script(util: Util):
         tvla_data_filename = METADATA_PATH / f"10k_aes_dec_hw_r5_0-7_key_{AES_ROOT_KEY}"
         tvla_data_len = IN_BYTES  # Input only
 
-    # TODO read from file during sampling
-    # Reading in input binary, generated from GenerateData module in inspector
-    with open(tvla_data_filename, "rb") as f:
-        tvla_data = f.read()  # 10M input = ~153MB
-        f.close()
-    num_tvla_input = int(len(tvla_data) / tvla_data_len)
+    # Input binary, generated from GenerateData module in inspector. It is
+    # memory-mapped and read while sampling, not loaded up front (10M input = ~153MB)
+    tvla_inputs = open_tvla_inputs(
+        util, tvla_data_filename, tvla_data_len, prefetch=TVLA_PREFETCH_BLOCKS
+    )
+    num_tvla_input = len(tvla_inputs)
     print(
-        f"Read TVLA input data {len(tvla_data)} bytes {num_tvla_input} blocks of {tvla_data_len} bytes in total"
+        f"Mapped TVLA input data {tvla_inputs.nbytes} bytes {num_tvla_input} blocks of {tvla_data_len} bytes in total"
     )
 
     # XYZ
@@ -111,6 +129,8 @@ def execute_script(util: Util):
     # Scope
     scope = None
     traceset = None
+    writer = None
+    ttests = {}
     num_segments = 1
     num_samples = 0
 
@@ -162,16 +182,35 @@ def execute_script(util: Util):
             padding_mode=TracePadding.AUTO,
         )
         util.add_to_cleanup(traceset.close)
+        writer = open_trace_writer(util, traceset, chunk_size=TRACE_WRITE_CHUNK)
+
+        if TTEST_ORDER:
+            ttests = {
+                channel: WelchTTest(
+                    order=TTEST_ORDER,
+                    threshold=TTEST_THRESHOLD,
+                    min_traces=TTEST_MIN_TRACES,
+                    interval=TTEST_INTERVAL,
+                    snapshot_path=TRACE_PATH / f"{ts_filename}_{channel}.ttest.npz",
+                )
+                for channel in CHANNELS_ENABLED
+            }
 
     counter = 0
     color = ResultColor.GREEN
     trace_count = 0
     debug = True
 
-    if not PARAMETERS["tvla_dual_state"]:  # single state, fixed key
-        cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
-
-    tvla_counter = 0
+    # The TVLA group, input, key and expected output of the next traces, with the
+    # outputs decrypted in batches on a background thread
+    schedule = open_tvla_schedule(
+        util,
+        tvla_inputs,
+        bool(PARAMETERS["tvla_dual_state"]),
+        in_bytes=IN_BYTES,
+        key=None if PARAMETERS["tvla_dual_state"] else key,
+        chunk_size=TVLA_SCHEDULE_CHUNK,
+    )
 
     for p in PARAMETERS:
         t = time()
@@ -206,36 +245,11 @@ def execute_script(util: Util):
 
         cmd = b""
 
-        # set data n stage
-        tvla_group = numpy.random.randint(0, 2)  # 0 or 1
-
-        if tvla_group == 0:
-            # first block tvla input
-            data = tvla_data[
-                tvla_counter * tvla_data_len : (tvla_counter + 1) * tvla_data_len
-            ]
-            if debug:
-                print("data:", tvla_counter, len(data), data.hex())
-            tvla_counter = (tvla_counter + 1) % num_tvla_input
-
-            if PARAMETERS["tvla_dual_state"]:
-                key = data[KEY_BYTES:]
-
-            input_data = data[:IN_BYTES]
-
-        elif tvla_group == 1:
-            input_data = numpy.random.bytes(IN_BYTES)
-            if PARAMETERS["tvla_dual_state"]:
-                key = numpy.random.bytes(KEY_BYTES)
-
-        assert len(input_data) == IN_BYTES, "wrong data length"
-
-        # update the key if necessary
-        if PARAMETERS["tvla_dual_state"]:
-            cipher = Cipher(algorithms.AES(key), modes.ECB(), default_backend())
-
-        # decrypt multiple block
-        exp = cipher.decryptor().update(input_data)
+        # set data n stage: group 0 (fixed) or 1 (random), with the expected output
+        # computed ahead by the schedule
+        tvla_group, input_data, key, exp, tvla_block = next(schedule)
+        if debug and tvla_group == 0:
+            print("data:", tvla_block, input_data.hex(), key.hex())
 
         if scope_enabled:
             scope.arm()
@@ -287,30 +301,24 @@ def execute_script(util: Util):
                         StandardTraceParameters.TVLA_SET_INDEX, tvla_group
                     )
 
-                    for segment in range(num_segments):
-                        # Store each segment as a separate trace in the tracefile
-                        title = []
-                        if move_table:
-                            title.append(f"({chip_pos.x:.1f}-{chip_pos.y:.1f})")
-                        title.append(f"{channel}-{counter}")
-                        if num_segments > 1:
-                            title.append(f"{num_segments}")
-
-                        segment_samples = samples[
-                            segment
-                            * (num_samples // num_segments) : (segment + 1)
-                            * (num_samples // num_segments)
-                        ]
-
-                        trace = Trace(
-                            SampleCoding.BYTE,
-                            segment_samples,
-                            parameters=trace_params,
-                            title="-".join(title),
-                        )
-
-                        traceset.append(trace)
-                        trace_count += 1
+                    # Store each segment as a separate trace in the tracefile, the
+                    # segments are views on the samples
+                    title = []
+                    if move_table:
+                        title.append(f"({chip_pos.x:.1f}-{chip_pos.y:.1f})")
+                    title.append(f"{channel}-{counter}")
+                    if num_segments > 1:
+                        title.append(f"{num_segments}")
+                    title = "-".join(title)
+
+                    # The traces are written on a background thread, so the samples are
+                    # copied unless they are bytes, in case the scope reuses its buffer
+                    segments = split_segments(samples, num_samples, num_segments)
+                    writer.add_segments(segments, trace_params, title, copy=True)
+                    trace_count += len(segments)
+
+                    if ttests:
+                        ttests[channel].add(tvla_group, segments)
 
                     if debug:
                         print(f"Collected {trace_count} traces")
@@ -341,3 +349,14 @@ def execute_script(util: Util):
         db.add(result, commit_frequency=32)
 
         counter += 1
+
+        leaking = [ttest.checkpoint() for ttest in ttests.values()]
+        if TTEST_EARLY_STOP and any(leaking):
+            print(f"Leakage above |t| = {TTEST_THRESHOLD}, stopped after {trace_count} traces")
+            break
+
+    for ttest in ttests.values():
+        ttest.checkpoint(force=True)
+    if writer:
+        writer.flush()
+        writer.report()
@@ -25,14 +25,20 @@ To build this setup:
 
 from time import sleep, time
 from pathlib import Path
-from shapely.geometry import Point  
-from shapely.geometry.polygon import Polygon 
-import serial
 import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
-from spidersdk.chronology import Chronology
+from common.batch import BatchCampaign
+from common.broker import connect_broker
+from common.campaign import Campaign, arm_reset, open_spider, open_spider_port, open_target, read_response
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+from common.columnar import MultiSink, open_parquet_sink
+from common.orchestrator import read_settings
+from common.region import PolygonRegion, learn_region
+from common.results import open_result_sink
+from common.serialreader import byte_time, open_framed_reader
+from common.search import ThompsonSearch
 from spidersdk.spider import Spider
 
 
@@ -62,85 +68,96 @@ RESET_OUT  = 0
 TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 
+# Write the results in batches, with a commit per 256 rows, instead of committing every attempt. The rows go to the
+# fipy database file through a second connection, which switches the file to WAL mode.
+BATCHED_RESULTS = False
+# Classify and store an attempt on a worker thread while the next attempt runs (needs BATCHED_RESULTS, the fipy
+# database is only written from the main thread)
+PIPELINED = False
+# A response is complete when the target is silent for this many byte times, instead of after the read timeout,
+# e.g. 32. Only for targets that send a response without pauses, 0 to wait for the whole response.
+IDLE_BYTES = 0
+# Add the duration of every stage of an attempt to the results as '<stage> (us)' columns, which changes the table,
+# and print their histograms at the end
+STAGE_TIMING = False
+# Run this many attempts in one Chronology program, without the host in between, 0 for one attempt per program.
+# BATCH_GAP seconds are waited after every attempt, for its response.
+BATCH_SIZE = 0
+BATCH_GAP = 0.01
+# Use the Spider and target of a device broker at this (host, port), e.g. ('localhost', 6010), instead of opening
+# the ports, so the run starts with a warm Spider. Start it with: python -m common.broker <Spider COM> <Target COM>
+BROKER_ADDRESS = None
+# Also write the results to Parquet files in logs/<script>.parquet, for fast analysis (needs pyarrow and
+# BATCHED_RESULTS)
+COLUMNAR_RESULTS = False
+
+# Draw the glitch length and voltage from inside the polygon, instead of skipping parameters outside of it
+SAMPLE_FROM_REGION = False
+# Replace the polygon by the region around the GREEN and ORANGE results of previous runs of this script,
+# grown by LEARN_MARGIN so the search keeps exploring just outside of it
+LEARN_REGION = False
+LEARN_MARGIN = 0.05
+# Propose the delay, length and voltage of the glitches from the colors of previous attempts (Thompson sampling),
+# within the min and max configured in the UI, instead of sweeping them
+ADAPTIVE_SEARCH = False
+SEARCH_KEYS = ['glitch_delay', 'glitch_length', 'glitch_voltage',
+               'glitch_delay2', 'glitch_length2', 'glitch_voltage2',
+               'glitch_delay3', 'glitch_length3', 'glitch_voltage3']
+
 polygon_points=[(68.56966642835827, -0.09875319275962799), (77.79473930467995, -0.08229298470840235), (85.93450948966968, -0.058590285114637444), (87.56246352666761, -0.017768969147597874), (88.64776621799957, 0.005933730446167032), (111.98177408163679, 0.014931977514170386), (134.230479253942, 0.007470016530948087), (153.76592769791733, -0.019524724673061947), (169.50281672223082, -0.04893362972458508), (177.64258690722053, -0.0675885321826408), (190.6662192032041, -0.09809478443757896), (203.68985149918763, -0.09941160108167701), (222.68264859749698, -0.099192131640994), (241.67544569580633, -0.09348592618323578), (247.10195915246615, -0.07943988197952324), (256.8696833744538, -0.04981150748731711), (272.6065723987673, -0.03444864663950652), (290.5140668057447, -0.05244514077551321), (307.87890986705605, -0.07329473764039901), (330.1276150393613, -0.08251245414908537), (355.63222828566245, -0.08953547625094163), (379.5088874949656, -0.08448767911523244), (404.47084939560074, -0.06319914336898062), (420.2077384199142, -0.04256901594477783), (437.02993013555965, -0.03642387160565359), (447.88295704887923, -0.044544240910924904), (457.1080299252009, -0.06144338784351656), (475.5581756778443, -0.07153898211493495), (486.95385393682994, -0.07592837092859511), (517.8849806397909, -0.06714959330127478), (564.5529963670652, -0.05595665182644134), (601.453287872352, -0.061004448962150536), (623.1593416989913, -0.06934428770810486), (657.889027821614, -0.06912481826742184), (682.3083383765833, -0.06363808225034664), (713.2394650795442, -0.059907101758735495), (760.4501321524846, -0.06561330721649372), (793.0092128924434, -0.06056551008078452), (828.8242017063982, -0.05793187679258842), (853.2435122613673, -0.057492937911222404), (872.2363093596767, -0.06210179616556558), (898.2835739516438, -0.06429649057239567), (952.006057172576, -0.06034604064010151), (985.6504406038669, -0.054200896300977276), (998.1314215541844, -0.04827522140253605), (1000.3020269368483, 0.04763292417593862), (46.86361260171901, 0.038854146548618296), (46.32096125605303, -0.09897266220031099), (68.56966642835827, -0.09875319275962799)]
-polygon = Polygon(polygon_points) 
-@fipy_script
-def execute_script(util):
-    util.set_termination_timeout(5)
-    util.parameter_init(PARAMETERS)
+region = PolygonRegion(polygon_points)
 
-    script_name = Path(__file__).stem
-    db = util.create_database_table('logs/{}.sqlite'.format(script_name),
-                                    '{}'.format(script_name))
-    util.add_to_cleanup(util.close_database)
 
-    # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
-
-    # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
-
-
-    glitcher.forget_events()  # Forget any previous added events
-        
-    normal_vcc = float(PARAMETERS['normal_voltage'])
+CLASSIFIER = Classifier([
+    Rule(ResultColor.YELLOW, Timeout(), Exact(b'', b'\x00')),
+    Rule(ResultColor.ORANGE, Timeout(), Contains(b'0,aaa6,aaa5,')),
+    Rule(ResultColor.GREEN, Timeout(), Contains(b'1,aaa6,aaa5,')),
+    Rule(ResultColor.CYAN, Timeout(), Contains(b'0,aaaa,aaaa,')),
+    Rule(ResultColor.MAGENTA, Timeout()),
+    Rule(ResultColor.RED, Contains(b'0,aaaa,aaaa')),
+    Rule(ResultColor.WHITE),
+])
 
-    glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
-    glitcher.set_gpio_now(RESET_OUT, 1)
-    counter = 0
-    do_reset = True
-    
-    for p in PARAMETERS:
-        if not polygon.contains(Point(p["glitch_length2"], p["glitch_voltage2"])):            
-            continue
-        t = time()
-        if not util.process_commands():
-            break
-            
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
-        glitcher.forget_events()  
 
-        if do_reset:
-            # Perform reset "Now", instead of in the state machine
-            # sleeps might require manual tuning, based on device
-            glitcher.set_gpio(RESET_OUT, 0)
-            glitcher.set_vcc(GLITCH_OUT, 0)
-            glitcher.set_gpio(TRIGGER_OUT, 0)
+def create_campaign(util, settings, sink=None, search=None, search_region=region):
+    """
+    Open the Spider and the target, and create the campaign of this script.
 
-            glitcher.wait_time(0.1e-3)
-            glitcher.set_gpio(RESET_OUT, 1)
+    :param util: the fipy script util
+    :param settings: the ports, baudrate, read timeout and normal voltage, e.g. PARAMETERS
+    :param sink: optional result sink, see ``Campaign``
+    :param search: optional ``ThompsonSearch`` that proposes the parameters
+    :param search_region: the region the glitch length and voltage of the second glitch are taken from
+    :return: the ``Campaign``
+    """
+    if BROKER_ADDRESS:
+        # The broker holds the Spider and the target, with the ports of its command line
+        glitcher, serial_target, spider_com_port = connect_broker(util, BROKER_ADDRESS, baudrate=settings['serial_baudrate'])
+        serial_target.timeout = float(settings['serial_timeout'])
+    else:
+        # Hardware initialization (Spider)
+        spider_com_port = open_spider_port(util, settings['spider_com_port'])
+        glitcher = open_spider(spider_com_port)
 
-            #glitcher.wait_time(10e-3)
+        # Hardware initialization (Pinata)
+        serial_target = open_target(util, settings['serial_com_port'], settings['serial_baudrate'],
+                                    settings['serial_timeout'])
+        if IDLE_BYTES or BATCH_SIZE:
+            # Only a background reader returns when the target is silent, a plain read is as fast otherwise
+            serial_target = open_framed_reader(util, serial_target)
+    idle = IDLE_BYTES * byte_time(settings['serial_baudrate']) if IDLE_BYTES else None
 
-            glitcher.set_vcc(GLITCH_OUT, normal_vcc)
-            
-            glitcher.set_gpio(TRIGGER_OUT, 1)
+    normal_vcc = float(settings['normal_voltage'])
 
-            #do_reset = False
-            
+    glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
+    glitcher.set_gpio_now(RESET_OUT, 1)
+    do_reset = True
 
-        # Clear states from previous iteration
+    def arm(glitcher, p):
+        if do_reset:
+            # Reset the target from the state machine, at the start of every attempt
+            arm_reset(glitcher, GLITCH_OUT, RESET_OUT, normal_vcc, trigger_out=TRIGGER_OUT)
 
-        #glitcher.set_gpio(TRIGGER_OUT, 1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         if p['glitches']>0:
             glitcher.glitch(
@@ -154,47 +171,21 @@ def execute_script(util):
                 p['glitch_voltage2'],
                 p['glitch_delay2'] / 1e9,
                 p['glitch_length2'] / 1e9)
-            #glitcher.set_gpio(TRIGGER_OUT, 0)
         if p['glitches']>2:
             glitcher.glitch(
-                    GLITCH_OUT,
-                    p['glitch_voltage3'],
-                    p['glitch_delay3'] / 1e9,
-                    p['glitch_length3'] / 1e9)
+                GLITCH_OUT,
+                p['glitch_voltage3'],
+                p['glitch_delay3'] / 1e9,
+                p['glitch_length3'] / 1e9)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
 
-        glitcher.start()  
-
-        pin_response = serial_target.read(45)
-        if b'\x00' in pin_response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            pin_response = pin_response+serial_target.read(1)
-        print(pin_response)
-        print(len(pin_response))
-        # Block for 1 second or until Spider reaches final state.
-        spider_timeout = glitcher.wait_until_finish(0.001)
-        state=glitcher.get_current_state()
-        if spider_timeout:
-            if len(pin_response)==0 or pin_response==b'\x00': 
-                color = ResultColor.YELLOW
-            elif b'0,aaa6,aaa5,' in pin_response:
-                color = ResultColor.ORANGE
-            elif b'1,aaa6,aaa5,' in pin_response:
-                color = ResultColor.GREEN
-            elif b'0,aaaa,aaaa,' in pin_response:
-                color = ResultColor.CYAN
-            else:
-                color = ResultColor.MAGENTA
-        elif b'0,aaaa,aaaa' in pin_response:
-                color = ResultColor.RED
-        else:  
-                color = ResultColor.WHITE
-
-      
-        result = Parameters(
-            ("id", counter),
-            ("timestamp", int(t)),
-            ("iter_t (ms)", int((time() - t) * 1000)),
+    def record(attempt):
+        p = attempt.parameters
+        row = [
+            ("id", attempt.id),
+            ("timestamp", int(attempt.t)),
+            ("iter_t (ms)", attempt.elapsed_ms()),
             ("glitch_voltage1", p['glitch_voltage']),
             ("glitch_delay1", p['glitch_delay']),
             ("glitch_length1", p['glitch_length']),
@@ -206,14 +197,95 @@ def execute_script(util):
             ("glitch_delay3", p['glitch_delay3']),
             ("glitch_length3", p['glitch_length3']),
             ("normal_voltage", p['normal_voltage']),
-            ("spider_timeout", spider_timeout),
+            ("spider_timeout", attempt.spider_timeout),
             ("do_reset", do_reset),
-            ("state",state),
-            ("Data", pin_response),
-            ("Color", int(color))
-        )
+            ("state", attempt.state),
+            ("Data", attempt.response),
+            ("Color", int(attempt.color))
+        ]
+        if BATCH_SIZE:
+            # The response may belong to a neighbouring attempt of the batch
+            row.append(("ambiguous", attempt.ambiguous))
+        return row
+
+    accept = None if SAMPLE_FROM_REGION else search_region.accepts('glitch_length2', 'glitch_voltage2')
+    sample = None
+    if search:
+        # Propose again until the region accepts, the rejected values count as attempts without a fault
+        sample = search.sampler(accept=accept, keys=['glitch_length2', 'glitch_voltage2'])
+    elif SAMPLE_FROM_REGION:
+        sample = search_region.sampler('glitch_length2', 'glitch_voltage2', x_type=int)
+
+    stages = dict(
+        transport=spider_com_port,
+        sink=sink,
+        timing=STAGE_TIMING,
+        accept=accept,
+        sample=sample,
+        observe=search.observer() if search else None,
+        pipelined=PIPELINED,
+        read_state=True)
+    if BATCH_SIZE:
+        campaign = BatchCampaign(
+            util, glitcher, serial_target, arm, CLASSIFIER, record,
+            batch_size=BATCH_SIZE,
+            # The responses of a batch are split at the pauses of the target, which needs an idle time
+            idle=idle or 32 * byte_time(settings['serial_baudrate']),
+            gap=BATCH_GAP,
+            finish_timeout=100 * BATCH_SIZE,
+            **stages)
+        # The attempts of the calibration batch do not glitch
+        campaign.calibrate({'glitches': 0})
+        return campaign
+    return Campaign(
+        util, glitcher, serial_target,
+        arm=arm,
+        read=lambda target, p: read_response(target, 45, idle=idle),
+        classify=CLASSIFIER,
+        record=record,
+        finish_timeout=0.001,
+        **stages)
+
 
-        util.monitor(result)
+def bench_campaign(util, bench):
+    """
+    Campaign factory for ``common.orchestrator``: the campaign of this script on one bench, with the settings of the
+    UI and the ports of the bench. The adaptive search is not used, as every bench would learn on its own.
+    """
+    settings = read_settings(Path(__file__).with_suffix('.py.json'))
+    settings.update(bench)
+    return create_campaign(util, settings)
+
+
+@fipy_script
+def execute_script(util):
+    util.set_termination_timeout(5)
+    util.parameter_init(PARAMETERS)
+
+    if COLUMNAR_RESULTS and not BATCHED_RESULTS:
+        raise ValueError('COLUMNAR_RESULTS needs BATCHED_RESULTS, the results would not be written to the database')
+    if PIPELINED and not BATCHED_RESULTS:
+        raise ValueError('PIPELINED needs BATCHED_RESULTS, the fipy database is only written from the main thread')
+
+    script_name = Path(__file__).stem
+    search_region = region
+    if LEARN_REGION:
+        search_region = learn_region('logs/{}.sqlite'.format(script_name), script_name,
+                                     'glitch_length2', 'glitch_voltage2', [ResultColor.GREEN, ResultColor.ORANGE],
+                                     margin=LEARN_MARGIN)
+        print('Learned region: {}'.format(list(search_region.polygon.exterior.coords)))
+    search = None
+    if ADAPTIVE_SEARCH:
+        search = ThompsonSearch.from_settings(Path(__file__).with_suffix('.py.json'), SEARCH_KEYS,
+                                              rewards={ResultColor.GREEN: 1.0, ResultColor.ORANGE: 0.5})
+    db = util.create_database_table('logs/{}.sqlite'.format(script_name),
+                                    '{}'.format(script_name))
+    util.add_to_cleanup(util.close_database)
+    sink = open_result_sink(util, 'logs/{}.sqlite'.format(script_name), script_name) if BATCHED_RESULTS else None
+    if COLUMNAR_RESULTS:
+        sink = MultiSink(sink, open_parquet_sink(util, 'logs/{}.parquet'.format(script_name)))
 
-        counter += 1
-        db.add(result)
+    campaign = create_campaign(util, PARAMETERS, sink=sink, search=search, search_region=search_region)
+    campaign.run(PARAMETERS, db)
+    if search:
+        search.report()
@@ -25,14 +25,13 @@ To build this setup:
 
 from time import sleep, time
 from pathlib import Path
-from shapely.geometry import Point  
-from shapely.geometry.polygon import Polygon 
-import serial
 import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
-from spidersdk.chronology import Chronology
+from common.campaign import Campaign, arm_reset, open_spider, open_spider_port, open_target, read_response
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+from common.region import PolygonRegion
 from spidersdk.spider import Spider
 
 
@@ -63,8 +62,24 @@ TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 ICW_TRIG_1= 15
 
+# Draw the glitch length and voltage from inside the polygon, instead of skipping parameters outside of it
+SAMPLE_FROM_REGION = False
+
 polygon_points=[(68.56966642835827, -0.09875319275962799), (77.79473930467995, -0.08229298470840235), (85.93450948966968, -0.058590285114637444), (87.56246352666761, -0.017768969147597874), (88.64776621799957, 0.005933730446167032), (111.98177408163679, 0.014931977514170386), (134.230479253942, 0.007470016530948087), (153.76592769791733, -0.019524724673061947), (169.50281672223082, -0.04893362972458508), (177.64258690722053, -0.0675885321826408), (190.6662192032041, -0.09809478443757896), (203.68985149918763, -0.09941160108167701), (222.68264859749698, -0.099192131640994), (241.67544569580633, -0.09348592618323578), (247.10195915246615, -0.07943988197952324), (256.8696833744538, -0.04981150748731711), (272.6065723987673, -0.03444864663950652), (290.5140668057447, -0.05244514077551321), (307.87890986705605, -0.07329473764039901), (330.1276150393613, -0.08251245414908537), (355.63222828566245, -0.08953547625094163), (379.5088874949656, -0.08448767911523244), (404.47084939560074, -0.06319914336898062), (420.2077384199142, -0.04256901594477783), (437.02993013555965, -0.03642387160565359), (447.88295704887923, -0.044544240910924904), (457.1080299252009, -0.06144338784351656), (475.5581756778443, -0.07153898211493495), (486.95385393682994, -0.07592837092859511), (517.8849806397909, -0.06714959330127478), (564.5529963670652, -0.05595665182644134), (601.453287872352, -0.061004448962150536), (623.1593416989913, -0.06934428770810486), (657.889027821614, -0.06912481826742184), (682.3083383765833, -0.06363808225034664), (713.2394650795442, -0.059907101758735495), (760.4501321524846, -0.06561330721649372), (793.0092128924434, -0.06056551008078452), (828.8242017063982, -0.05793187679258842), (853.2435122613673, -0.057492937911222404), (872.2363093596767, -0.06210179616556558), (898.2835739516438, -0.06429649057239567), (952.006057172576, -0.06034604064010151), (985.6504406038669, -0.054200896300977276), (998.1314215541844, -0.04827522140253605), (1000.3020269368483, 0.04763292417593862), (46.86361260171901, 0.038854146548618296), (46.32096125605303, -0.09897266220031099), (68.56966642835827, -0.09875319275962799)]
-polygon = Polygon(polygon_points) 
+region = PolygonRegion(polygon_points)
+
+
+CLASSIFIER = Classifier([
+    Rule(ResultColor.YELLOW, Timeout(), Exact(b'', b'\x00')),
+    Rule(ResultColor.ORANGE, Timeout(), Contains(b'0,aaa6,aaa5,')),
+    Rule(ResultColor.GREEN, Timeout(), Contains(b'1,aaa6,aaa5,')),
+    Rule(ResultColor.CYAN, Timeout(), Contains(b'0,aaaa,aaaa,')),
+    Rule(ResultColor.MAGENTA, Timeout()),
+    Rule(ResultColor.RED, Contains(b'0,aaaa,aaaa')),
+    Rule(ResultColor.WHITE),
+])
+
+
 @fipy_script
 def execute_script(util):
     util.set_termination_timeout(5)
@@ -76,72 +91,24 @@ def execute_script(util):
     util.add_to_cleanup(util.close_database)
 
     # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
+    spider_com_port = open_spider_port(util, PARAMETERS['spider_com_port'])
+    glitcher = open_spider(spider_com_port)
 
     # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
-
-
-    glitcher.forget_events()  # Forget any previous added events
-        
+    serial_target = open_target(util, PARAMETERS['serial_com_port'],
+                                PARAMETERS['serial_baudrate'], PARAMETERS['serial_timeout'])
+
     normal_vcc = float(PARAMETERS['normal_voltage'])
 
     glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
     glitcher.set_gpio_now(RESET_OUT, 1)
-    counter = 0
     do_reset = True
-    
-    for p in PARAMETERS:
-        if not polygon.contains(Point(p["glitch_length2"], p["glitch_voltage2"])):            
-            continue
-        t = time()
-        if not util.process_commands():
-            break
-            
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
-        glitcher.forget_events()  
 
+    def arm(glitcher, p):
         if do_reset:
-            # Perform reset "Now", instead of in the state machine
-            # sleeps might require manual tuning, based on device
-            glitcher.set_gpio(RESET_OUT, 0)
-            glitcher.set_vcc(GLITCH_OUT, 0)
-            glitcher.set_gpio(TRIGGER_OUT, 0)
-
-            glitcher.wait_time(0.1e-3)
-            glitcher.set_gpio(RESET_OUT, 1)
+            # Reset the target from the state machine, at the start of every attempt
+            arm_reset(glitcher, GLITCH_OUT, RESET_OUT, normal_vcc, trigger_out=TRIGGER_OUT)
 
-            #glitcher.wait_time(10e-3)
-
-            glitcher.set_vcc(GLITCH_OUT, normal_vcc)
-            
-            glitcher.set_gpio(TRIGGER_OUT, 1)
-
-            #do_reset = False
-            
-
-        # Clear states from previous iteration
-
-        #glitcher.set_gpio(TRIGGER_OUT, 1)
         glitcher.wait_trigger(ICW_TRIG_1, TRIGGER_EDGE, count=1)
         if p['glitches']>0:
             glitcher.glitch(
@@ -155,47 +122,21 @@ def execute_script(util):
                 p['glitch_voltage2'],
                 p['glitch_delay2'] / 1e9,
                 p['glitch_length2'] / 1e9)
-            #glitcher.set_gpio(TRIGGER_OUT, 0)
         if p['glitches']>2:
             glitcher.glitch(
-                    GLITCH_OUT,
-                    p['glitch_voltage3'],
-                    p['glitch_delay3'] / 1e9,
-                    p['glitch_length3'] / 1e9)
+                GLITCH_OUT,
+                p['glitch_voltage3'],
+                p['glitch_delay3'] / 1e9,
+                p['glitch_length3'] / 1e9)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
 
-        glitcher.start()  
-
-        pin_response = serial_target.read(45)
-        if b'\x00' in pin_response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            pin_response = pin_response+serial_target.read(1)
-        print(pin_response)
-        print(len(pin_response))
-        # Block for 1 second or until Spider reaches final state.
-        spider_timeout = glitcher.wait_until_finish(0.001)
-        state=glitcher.get_current_state()
-        if spider_timeout:
-            if len(pin_response)==0 or pin_response==b'\x00': 
-                color = ResultColor.YELLOW
-            elif b'0,aaa6,aaa5,' in pin_response:
-                color = ResultColor.ORANGE
-            elif b'1,aaa6,aaa5,' in pin_response:
-                color = ResultColor.GREEN
-            elif b'0,aaaa,aaaa,' in pin_response:
-                color = ResultColor.CYAN
-            else:
-                color = ResultColor.MAGENTA
-        elif b'0,aaaa,aaaa' in pin_response:
-                color = ResultColor.RED
-        else:  
-                color = ResultColor.WHITE
-
-      
-        result = Parameters(
-            ("id", counter),
-            ("timestamp", int(t)),
-            ("iter_t (ms)", int((time() - t) * 1000)),
+    def record(attempt):
+        p = attempt.parameters
+        return [
+            ("id", attempt.id),
+            ("timestamp", int(attempt.t)),
+            ("iter_t (ms)", attempt.elapsed_ms()),
             ("glitch_voltage1", p['glitch_voltage']),
             ("glitch_delay1", p['glitch_delay']),
             ("glitch_length1", p['glitch_length']),
@@ -207,14 +148,22 @@ def execute_script(util):
             ("glitch_delay3", p['glitch_delay3']),
             ("glitch_length3", p['glitch_length3']),
             ("normal_voltage", p['normal_voltage']),
-            ("spider_timeout", spider_timeout),
+            ("spider_timeout", attempt.spider_timeout),
             ("do_reset", do_reset),
-            ("state",state),
-            ("Data", pin_response),
-            ("Color", int(color))
-        )
-
-        util.monitor(result)
-
-        counter += 1
-        db.add(result)
+            ("state", attempt.state),
+            ("Data", attempt.response),
+            ("Color", int(attempt.color))
+        ]
+
+    campaign = Campaign(
+        util, glitcher, serial_target,
+        transport=spider_com_port,
+        arm=arm,
+        read=lambda target, p: read_response(target, 45),
+        classify=CLASSIFIER,
+        record=record,
+        accept=None if SAMPLE_FROM_REGION else region.accepts('glitch_length2', 'glitch_voltage2'),
+        sample=region.sampler('glitch_length2', 'glitch_voltage2', x_type=int) if SAMPLE_FROM_REGION else None,
+        finish_timeout=0.001,
+        read_state=True)
+    campaign.run(PARAMETERS, db)
@@ -27,12 +27,15 @@ from time import sleep, time
 from pathlib import Path
 from shapely.geometry import Point  
 from shapely.geometry.polygon import Polygon 
-import serial
 import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
-from spidersdk.chronology import Chronology
+from common.broker import connect_broker
+from common.campaign import Campaign, arm_reset, open_spider, open_spider_port, open_target, read_response
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+from common.results import open_result_sink
+from common.serialreader import byte_time, open_framed_reader
 from spidersdk.spider import Spider
 
 
@@ -62,83 +65,79 @@ RESET_OUT  = 0
 TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 
+# Write the results in batches, with a commit per 256 rows, instead of committing every attempt. The rows go to the
+# fipy database file through a second connection, which switches the file to WAL mode.
+BATCHED_RESULTS = False
+# Classify and store an attempt on a worker thread while the next attempt runs (needs BATCHED_RESULTS, the fipy
+# database is only written from the main thread)
+PIPELINED = False
+# A response is complete when the target is silent for this many byte times, instead of after the read timeout,
+# e.g. 32. Only for targets that send a response without pauses, 0 to wait for the whole response.
+IDLE_BYTES = 0
+# Add the duration of every stage of an attempt to the results as '<stage> (us)' columns, which changes the table,
+# and print their histograms at the end
+STAGE_TIMING = False
+# Use the Spider and target of a device broker at this (host, port), e.g. ('localhost', 6010), instead of opening
+# the ports, so the run starts with a warm Spider. Start it with: python -m common.broker <Spider COM> <Target COM>
+BROKER_ADDRESS = None
+
 polygon_points=[(0.03245327621211658, -2.993695811849991), (26.318397565247437, -2.9982900398827823), (35.08037899492587, -1.5694851216847727), (63.34483521969503, -0.6092914628314481), (155.76960707469016, -0.2233763080770017), (316.0290738691313, -0.3382320088967772), (451.1331746235279, -0.4347107975853888), (500.31332845462623, -0.4530877097165531), (499.74803933013084, 0.1579446186446538), (235.7580181907869, 0.19469844290698202), (87.36962301074881, 0.180915758808609), (15.860548762082843, -0.0901436951260619), (-0.5328358482832662, -0.8435970925037903), (0.03245327621211658, -2.993695811849991)]
 polygon = Polygon(polygon_points)
+
+
+CLASSIFIER = Classifier([
+    Rule(ResultColor.PINK, Timeout()),  # no trigger, check setup
+    Rule(ResultColor.YELLOW, Exact(b'', b'\x00')),
+    Rule(ResultColor.ORANGE, Contains(b'0,aaa6,aaa5,')),
+    Rule(ResultColor.GREEN, Contains(b'1,aaa6,aaa5,')),
+    Rule(ResultColor.RED, Contains(b'0,aaaa,aaaa,String')),
+    Rule(ResultColor.CYAN, Contains(b'0,aaaa,aaaa,')),
+    Rule(ResultColor.MAGENTA),
+])
+
+
 @fipy_script
 def execute_script(util):
     util.set_termination_timeout(5)
     util.parameter_init(PARAMETERS)
 
+    if PIPELINED and not BATCHED_RESULTS:
+        raise ValueError('PIPELINED needs BATCHED_RESULTS, the fipy database is only written from the main thread')
+
     script_name = Path(__file__).stem
     db = util.create_database_table('logs/{}.sqlite'.format(script_name),
                                     '{}'.format(script_name))
     util.add_to_cleanup(util.close_database)
+    sink = open_result_sink(util, 'logs/{}.sqlite'.format(script_name), script_name) if BATCHED_RESULTS else None
+
+    if BROKER_ADDRESS:
+        # The broker holds the Spider and the target, with the ports of its command line
+        glitcher, serial_target, spider_com_port = connect_broker(util, BROKER_ADDRESS, baudrate=PARAMETERS['serial_baudrate'])
+        serial_target.timeout = float(PARAMETERS['serial_timeout'])
+    else:
+        # Hardware initialization (Spider)
+        spider_com_port = open_spider_port(util, PARAMETERS['spider_com_port'])
+        glitcher = open_spider(spider_com_port)
+
+        # Hardware initialization (Pinata)
+        serial_target = open_target(util, PARAMETERS['serial_com_port'], PARAMETERS['serial_baudrate'],
+                                    PARAMETERS['serial_timeout'])
+        if IDLE_BYTES:
+            # Only a background reader returns when the target is silent, a plain read is as fast otherwise
+            serial_target = open_framed_reader(util, serial_target)
+    idle = IDLE_BYTES * byte_time(PARAMETERS['serial_baudrate']) if IDLE_BYTES else None
 
-    # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
-
-    # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
-
-
-    glitcher.forget_events()  # Forget any previous added events
-        
     normal_vcc = float(PARAMETERS['normal_voltage'])
 
     glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
     glitcher.set_gpio_now(RESET_OUT, 1)
-    counter = 0
     do_reset = True
-    
-    for p in PARAMETERS:
-        #if not polygon.contains(Point(p["glitch_length2"], p["glitch_voltage2"])):            
-        #    continue
-        t = time()
-        if not util.process_commands():
-            break
-            
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
-        glitcher.forget_events()  
 
+    def arm(glitcher, p):
         if do_reset:
-            # Perform reset "Now", instead of in the state machine
-            # sleeps might require manual tuning, based on device
-            glitcher.set_gpio(RESET_OUT, 0)
-            glitcher.set_vcc(GLITCH_OUT, 0)
-            
-            glitcher.wait_time(0.1e-3)
-            glitcher.set_gpio(RESET_OUT, 1)
-
-            #glitcher.wait_time(10e-3)
+            # Reset the target from the state machine, at the start of every attempt
+            arm_reset(glitcher, GLITCH_OUT, RESET_OUT, normal_vcc)
 
-            glitcher.set_vcc(GLITCH_OUT, normal_vcc)
-
-
-            #do_reset = False
-            
-
-        # Clear states from previous iteration
-
-        #glitcher.set_gpio(TRIGGER_OUT, 1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         if p['glitches']>0:
             glitcher.glitch(
@@ -152,45 +151,19 @@ def execute_script(util):
                 p['glitch_voltage2'],
                 p['glitch_delay2'] / 1e9,
                 p['glitch_length2'] / 1e9)
-            #glitcher.set_gpio(TRIGGER_OUT, 0)
         if p['glitches']>2:
             glitcher.glitch(
-                    GLITCH_OUT,
-                    p['glitch_voltage3'],
-                    p['glitch_delay3'] / 1e9,
-                    p['glitch_length3'] / 1e9)
-        #glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
-
-        glitcher.start()  
-
-        pin_response = serial_target.read(45)
-        if b'\x00' in pin_response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            pin_response = pin_response+serial_target.read(1)
-        print(pin_response)
-        print(len(pin_response))
-        # Block for 1 second or until Spider reaches final state.
-        spider_timeout = glitcher.wait_until_finish(0.1)
-
-        if spider_timeout:
-            color = ResultColor.PINK  # no trigger, check setup
-        elif len(pin_response)==0 or pin_response==b'\x00': 
-            color = ResultColor.YELLOW
-        elif b'0,aaa6,aaa5,' in pin_response:
-            color = ResultColor.ORANGE
-        elif b'1,aaa6,aaa5,' in pin_response:
-            color = ResultColor.GREEN
-        elif b'0,aaaa,aaaa,String' in pin_response:
-            color = ResultColor.RED
-        elif b'0,aaaa,aaaa,' in pin_response:
-            color = ResultColor.CYAN
-        else:
-            color = ResultColor.MAGENTA
-
-      
-        result = Parameters(
-            ("id", counter),
-            ("timestamp", int(t)),
-            ("iter_t (ms)", int((time() - t) * 1000)),
+                GLITCH_OUT,
+                p['glitch_voltage3'],
+                p['glitch_delay3'] / 1e9,
+                p['glitch_length3'] / 1e9)
+
+    def record(attempt):
+        p = attempt.parameters
+        return [
+            ("id", attempt.id),
+            ("timestamp", int(attempt.t)),
+            ("iter_t (ms)", attempt.elapsed_ms()),
             ("glitch_voltage1", p['glitch_voltage']),
             ("glitch_delay1", p['glitch_delay']),
             ("glitch_length1", p['glitch_length']),
@@ -202,13 +175,21 @@ def execute_script(util):
             ("glitch_delay3", p['glitch_delay3']),
             ("glitch_length3", p['glitch_length3']),
             ("normal_voltage", p['normal_voltage']),
-            ("spider_timeout", spider_timeout),
+            ("spider_timeout", attempt.spider_timeout),
             ("do_reset", do_reset),
-            ("Data", pin_response),
-            ("Color", int(color))
-        )
-
-        util.monitor(result)
-
-        counter += 1
-        db.add(result)
+            ("Data", attempt.response),
+            ("Color", int(attempt.color))
+        ]
+
+    campaign = Campaign(
+        util, glitcher, serial_target,
+        transport=spider_com_port,
+        sink=sink,
+        timing=STAGE_TIMING,
+        pipelined=PIPELINED,
+        arm=arm,
+        read=lambda target, p: read_response(target, 45, idle=idle),
+        classify=CLASSIFIER,
+        record=record,
+        finish_timeout=0.1)
+    campaign.run(PARAMETERS, db)
@@ -26,12 +26,12 @@ To build this setup:
 from time import sleep, time
 from pathlib import Path
 
-import serial
 import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
-from spidersdk.chronology import Chronology
+from common.campaign import Campaign, arm_reset, open_spider, open_spider_port, open_target, read_response
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
 from spidersdk.spider import Spider
 
 
@@ -54,6 +54,17 @@ TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 
 
+
+
+CLASSIFIER = Classifier([
+    Rule(ResultColor.PINK, Timeout()),  # no trigger, check setup
+    Rule(ResultColor.YELLOW, Exact(b'', b'\x00')),
+    Rule(ResultColor.GREEN, Contains(b'aaa6,aaa5\r\n')),
+    Rule(ResultColor.RED, Contains(b'aaaa,aaaa\r\n')),
+    Rule(ResultColor.MAGENTA),
+])
+
+
 @fipy_script
 def execute_script(util):
     util.set_termination_timeout(5)
@@ -65,114 +76,53 @@ def execute_script(util):
     util.add_to_cleanup(util.close_database)
 
     # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
+    spider_com_port = open_spider_port(util, PARAMETERS['spider_com_port'])
+    glitcher = open_spider(spider_com_port)
 
     # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
-
-
-    glitcher.forget_events()  # Forget any previous added events
-        
+    serial_target = open_target(util, PARAMETERS['serial_com_port'],
+                                PARAMETERS['serial_baudrate'], PARAMETERS['serial_timeout'])
+
     normal_vcc = float(PARAMETERS['normal_voltage'])
 
     glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
     glitcher.set_gpio_now(RESET_OUT, 1)
-    counter = 0
     do_reset = True
-    
-    for p in PARAMETERS:
-        t = time()
-        if not util.process_commands():
-            break
-            
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
-        glitcher.forget_events()  
 
+    def arm(glitcher, p):
         if do_reset:
-            # Perform reset "Now", instead of in the state machine
-            # sleeps might require manual tuning, based on device
-            glitcher.set_gpio(RESET_OUT, 0)
-            glitcher.set_vcc(GLITCH_OUT, 0)
-            
-            glitcher.wait_time(0.1e-3)
-            glitcher.set_gpio(RESET_OUT, 1)
-
-            #glitcher.wait_time(10e-3)
-
-            glitcher.set_vcc(GLITCH_OUT, normal_vcc)
+            # Reset the target from the state machine, at the start of every attempt
+            arm_reset(glitcher, GLITCH_OUT, RESET_OUT, normal_vcc)
 
-
-            #do_reset = False
-            
-
-        # Clear states from previous iteration
-
-        #glitcher.set_gpio(TRIGGER_OUT, 1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         glitcher.glitch(
             GLITCH_OUT,
             p['glitch_voltage'],
             p['glitch_delay'] / 1e9,
             p['glitch_length'] / 1e9)
-            
-        #glitcher.set_gpio(TRIGGER_OUT, 0)
-
-        glitcher.start()  
-
-        pin_response = serial_target.read(13)
-        if b'\x00' in pin_response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            pin_response = pin_response+serial_target.read(1)
-        print(pin_response)
-        print(len(pin_response))
-        # Block for 1 second or until Spider reaches final state.
-        spider_timeout = glitcher.wait_until_finish(2000)
-
-        if spider_timeout:
-            color = ResultColor.PINK  # no trigger, check setup
-        elif len(pin_response)==0 or pin_response==b'\x00': 
-            color = ResultColor.YELLOW
-        elif b'aaa6,aaa5\r\n' in pin_response:
-            color = ResultColor.GREEN
-        elif b'aaaa,aaaa\r\n' in pin_response:
-            color = ResultColor.RED
-        else:
-            color = ResultColor.MAGENTA
-
-      
-        result = Parameters(
-            ("id", counter),
-            ("timestamp", int(t)),
-            ("iter_t (ms)", int((time() - t) * 1000)),
+
+    def record(attempt):
+        p = attempt.parameters
+        return [
+            ("id", attempt.id),
+            ("timestamp", int(attempt.t)),
+            ("iter_t (ms)", attempt.elapsed_ms()),
             ("glitch_voltage", p['glitch_voltage']),
             ("glitch_delay", p['glitch_delay']),
             ("glitch_length", p['glitch_length']),
             ("normal_voltage", p['normal_voltage']),
-            ("spider_timeout", spider_timeout),
+            ("spider_timeout", attempt.spider_timeout),
             ("do_reset", do_reset),
-            ("Data", pin_response),
-            ("Color", int(color))
-        )
-
-        util.monitor(result)
-
-        counter += 1
-        db.add(result)
+            ("Data", attempt.response),
+            ("Color", int(attempt.color))
+        ]
+
+    campaign = Campaign(
+        util, glitcher, serial_target,
+        transport=spider_com_port,
+        arm=arm,
+        read=lambda target, p: read_response(target, 13),
+        classify=CLASSIFIER,
+        record=record,
+        finish_timeout=2000)
+    campaign.run(PARAMETERS, db)
@@ -1,105 +1,357 @@
-from math import sin, pi, ceil
-from random import random
-from typing import List
+import heapq
+import sys
+from collections import OrderedDict
+from functools import wraps
+from math import ceil, pi
+from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy
 
 from spidersdk import Spider
 from spidersdk.glitchpattern import PATTERN_STATE_LIMIT
 
+# Output formats accepted by the templates
+LIST = 'list'
+ARRAY = 'array'
+RUNS = 'runs'
+
+
+class RunLengthPattern(NamedTuple):
+    """
+    Compact pattern representation: a sequence of voltage levels, each held for a number of 'Spider.MIN_SEC' slots.
+    Adjacent runs always have different levels.
+    """
+    levels: numpy.ndarray
+    slots: numpy.ndarray
+
+    @classmethod
+    def encode(cls, pattern: Union[Sequence[float], numpy.ndarray], slots=None) -> 'RunLengthPattern':
+        """
+        Run-length encode a pattern.
+
+        :param pattern: one voltage level per 'Spider.MIN_SEC' slot, or one level per run if 'slots' is given
+        :param slots: optional number of slots for every entry of 'pattern'
+        :return: the encoded pattern with adjacent equal levels merged
+        """
+        levels = numpy.asarray(pattern, dtype=numpy.float64).ravel()
+        if slots is None:
+            slots = numpy.ones(len(levels), dtype=numpy.int64)
+        slots = numpy.broadcast_to(numpy.asarray(slots, dtype=numpy.int64), levels.shape)
+        keep = slots > 0
+        levels, slots = levels[keep], slots[keep]
+        if len(levels) == 0:
+            return cls(levels, slots)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(levels[1:] != levels[:-1]) + 1))
+        return cls(levels[starts], numpy.add.reduceat(slots, starts))
+
+    @property
+    def states(self) -> int:
+        """Number of runs, i.e. pattern states."""
+        return len(self.levels)
+
+    @property
+    def duration(self) -> float:
+        """Length of the pattern in seconds."""
+        return int(self.slots.sum()) * Spider.MIN_SEC
+
+    def to_array(self) -> numpy.ndarray:
+        """Expand to one voltage level per 'Spider.MIN_SEC' slot."""
+        return numpy.repeat(self.levels, self.slots)
+
+    def to_list(self) -> List[float]:
+        """Expand to one voltage level per 'Spider.MIN_SEC' slot, as a list."""
+        return self.to_array().tolist()
+
+
+Pattern = Union[List[float], numpy.ndarray, RunLengthPattern]
+
+
+def _size_of(pattern: Pattern) -> int:
+    """Approximate memory used by a pattern in bytes."""
+    if isinstance(pattern, RunLengthPattern):
+        return pattern.levels.nbytes + pattern.slots.nbytes
+    if isinstance(pattern, numpy.ndarray):
+        return pattern.nbytes
+    # List of distinct float objects
+    return sys.getsizeof(pattern) + len(pattern) * sys.getsizeof(0.0)
+
+
+class PatternCache:
+    """
+    Least recently used cache of generated patterns, bounded by the memory the cached patterns use.
+
+    Cached arrays are returned read-only and cached lists are returned as copies, so callers can never modify a
+    cached pattern.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_bytes: memory budget of the cache, 0 disables caching
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key, generate: Callable[[], Pattern]) -> Pattern:
+        """
+        Return the pattern stored for 'key', calling 'generate' to create it on a miss.
+        """
+        with self._lock:
+            pattern = self._entries.get(key)
+            if pattern is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if pattern is None:
+            pattern = generate()
+            if isinstance(pattern, numpy.ndarray):
+                pattern.flags.writeable = False
+            elif isinstance(pattern, RunLengthPattern):
+                pattern.levels.flags.writeable = False
+                pattern.slots.flags.writeable = False
+            self._store(key, pattern)
+        return list(pattern) if isinstance(pattern, list) else pattern
+
+    def _store(self, key, pattern: Pattern):
+        size = _size_of(pattern)
+        with self._lock:
+            if size > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = pattern
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= _size_of(evicted)
+
+    def clear(self):
+        """Drop all cached patterns and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for monitoring, e.g. to add to a result row."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+
+# Cache shared by all templates. Change 'cache.max_bytes' to resize it.
+cache = PatternCache()
+
+
+def cached(template):
+    """
+    Put 'cache' in front of a template function. Calls with a 'seed' of None are random and are never cached.
+    """
+    @wraps(template)
+    def wrapper(min_voltage: float, max_voltage: float, duration: float, output: str = LIST, **kwargs):
+        options = dict(template.__kwdefaults__ or {}, **kwargs)
+        if 'seed' in options and options['seed'] is None:
+            return template(min_voltage, max_voltage, duration, output, **kwargs)
+        key = (template.__name__, float(min_voltage), float(max_voltage), float(duration), output,
+               tuple(sorted(options.items())))
+        return cache.get(key, lambda: template(min_voltage, max_voltage, duration, output, **kwargs))
+
+    return wrapper
+
 
-def block(min_voltage: float, max_voltage: float, duration: float) -> List[float]:
+def _slot_count(duration: float) -> int:
+    """
+    Convert a duration into a whole number of 'Spider.MIN_SEC' slots.
+
+    The small epsilon keeps durations that are an exact multiple of 'Spider.MIN_SEC' (e.g. 1e-6) from being
+    truncated one slot short by floating point error.
+    """
+    return max(int(duration / Spider.MIN_SEC + 1e-9), 0)
+
+
+def _segments(duration: float) -> Tuple[int, int]:
+    """
+    Split a duration into template segments.
+
+    :param duration: the length of the pattern in seconds
+    :return: the number of segments (at most 'PATTERN_STATE_LIMIT') and the number of 'Spider.MIN_SEC' slots each
+    segment lasts.
+    """
+    slots = _slot_count(duration)
+    if slots <= PATTERN_STATE_LIMIT:
+        return slots, 1
+    return PATTERN_STATE_LIMIT, -(-slots // PATTERN_STATE_LIMIT)
+
+
+def _render(levels: numpy.ndarray, repeats: int, output: str) -> Pattern:
+    """
+    Expand one voltage level per segment into one voltage level per 'Spider.MIN_SEC' slot.
+    """
+    if output == RUNS:
+        return RunLengthPattern.encode(levels, repeats)
+    pattern = numpy.repeat(numpy.asarray(levels, dtype=numpy.float64), repeats)
+    if output == ARRAY:
+        return pattern
+    if output == LIST:
+        return pattern.tolist()
+    raise ValueError("Unknown pattern output format '{}'".format(output))
+
+
+@cached
+def block(min_voltage: float, max_voltage: float, duration: float, output: str = LIST) -> Pattern:
     """
     Generate new pattern from the selected template
 
     :param min_voltage:  the minimum voltage level of the template function
     :param max_voltage: the maximum voltage level of the template function
     :param duration: the length of the pattern in seconds
+    :param output: 'list' (default), 'array' to get a numpy array or 'runs' to get a RunLengthPattern
     :return: the resulting pattern as a list of doubles. Every double represents a voltage level with
     a duration of 'Spider.MIN_SEC' seconds.
     """
-    result = []
-
-    number_of_segments = int(ceil(duration / Spider.MIN_SEC / 2))
-    result.extend([min_voltage] * number_of_segments)
-    result.extend([max_voltage] * number_of_segments)
-
-    return result
+    number_of_segments = max(int(ceil(duration / Spider.MIN_SEC / 2 - 1e-9)), 0)
+    return _render(numpy.array([min_voltage, max_voltage]), number_of_segments, output)
 
 
-def sine(min_voltage: float, max_voltage: float, duration: float) -> List[float]:
+@cached
+def sine(min_voltage: float, max_voltage: float, duration: float, output: str = LIST) -> Pattern:
     """
     Generate new pattern from the selected template
 
     :param min_voltage:  the minimum voltage level of the template function
     :param max_voltage: the maximum voltage level of the template function
     :param duration: the length of the pattern in seconds
+    :param output: 'list' (default), 'array' to get a numpy array or 'runs' to get a RunLengthPattern
     :return: the resulting pattern as a list of doubles. Every double represents a voltage level with
     a duration of 'Spider.MIN_SEC' seconds.
     """
-    result = []
-
-    segment_length = duration / PATTERN_STATE_LIMIT
-    number_of_segments = int(duration / Spider.MIN_SEC)
-    if number_of_segments > PATTERN_STATE_LIMIT:
-        number_of_segments = PATTERN_STATE_LIMIT
+    number_of_segments, repeats = _segments(duration)
     voltage_offset = (max_voltage + min_voltage) / 2.0
     voltage_range = (max_voltage - min_voltage) / 2.0
-    for k in range(0, number_of_segments):
-        current_length = 0
-        while current_length < segment_length:
-            result.append(voltage_offset + (sin(2 * pi * (k / float(number_of_segments))) * voltage_range))
-            current_length += Spider.MIN_SEC
-
-    return result
+    k = numpy.arange(number_of_segments, dtype=numpy.float64)
+    levels = voltage_offset + numpy.sin(2 * pi * (k / max(number_of_segments, 1))) * voltage_range
+    return _render(levels, repeats, output)
 
 
-def ramp(min_voltage: float, max_voltage: float, duration: float) -> List[float]:
+@cached
+def ramp(min_voltage: float, max_voltage: float, duration: float, output: str = LIST) -> Pattern:
     """
     Generate new pattern from the selected template
 
     :param min_voltage:  the minimum voltage level of the template function
     :param max_voltage: the maximum voltage level of the template function
     :param duration: the length of the pattern in seconds
+    :param output: 'list' (default), 'array' to get a numpy array or 'runs' to get a RunLengthPattern
     :return: the resulting pattern as a list of doubles. Every double represents a voltage level with
     a duration of 'Spider.MIN_SEC' seconds.
     """
-    result = []
-
-    segment_length = duration / PATTERN_STATE_LIMIT
-    number_of_segments = int(duration / Spider.MIN_SEC)
-    if number_of_segments > PATTERN_STATE_LIMIT:
-        number_of_segments = PATTERN_STATE_LIMIT
-    increment = (max_voltage - min_voltage) / number_of_segments
-    for k in range(0, number_of_segments):
-        current_length = 0
-        while current_length < segment_length:
-            result.append(min_voltage + (k * increment))
-            current_length += Spider.MIN_SEC
-
-    return result
+    number_of_segments, repeats = _segments(duration)
+    increment = (max_voltage - min_voltage) / max(number_of_segments, 1)
+    levels = min_voltage + numpy.arange(number_of_segments, dtype=numpy.float64) * increment
+    return _render(levels, repeats, output)
 
 
-def randomized(min_voltage: float, max_voltage: float, duration: float) -> List[float]:
+@cached
+def randomized(min_voltage: float, max_voltage: float, duration: float, output: str = LIST, *,
+               seed: Optional[int] = None) -> Pattern:
     """
     Generate new pattern from the selected template
 
     :param min_voltage:  the minimum voltage level of the template function
     :param max_voltage: the maximum voltage level of the template function
     :param duration: the length of the pattern in seconds
+    :param output: 'list' (default), 'array' to get a numpy array or 'runs' to get a RunLengthPattern
+    :param seed: seed for the random levels. Patterns with a seed are reproducible and cached.
     :return: the resulting pattern as a list of doubles. Every double represents a voltage level with
     a duration of 'Spider.MIN_SEC' seconds.
     """
-    result = []
-
-    segment_length = duration / PATTERN_STATE_LIMIT
-    number_of_segments = int(duration / Spider.MIN_SEC)
-    if number_of_segments > PATTERN_STATE_LIMIT:
-        number_of_segments = PATTERN_STATE_LIMIT
+    number_of_segments, repeats = _segments(duration)
     voltage_range = max_voltage - min_voltage
-    for k in range(0, number_of_segments):
-        current_length = 0
-        value = (random() * voltage_range) + min_voltage
-        while current_length < segment_length:
-            result.append(value)
-            current_length += Spider.MIN_SEC
-
-    return result
\ No newline at end of file
+    random = numpy.random.random if seed is None else numpy.random.default_rng(seed).random
+    levels = random(number_of_segments) * voltage_range + min_voltage
+    return _render(levels, repeats, output)
+
+
+def compress(pattern: Pattern, max_states: int = PATTERN_STATE_LIMIT, resolution: float = 0.0,
+             max_error: Optional[float] = None) -> Tuple[RunLengthPattern, float]:
+    """
+    Reduce an arbitrary pattern to at most 'max_states' runs.
+
+    Adjacent runs are merged greedily, always picking the merge that adds the smallest error. A merged run gets the
+    duration weighted mean of its levels. Afterwards levels are optionally rounded to a multiple of 'resolution' and
+    runs that became equal are merged.
+
+    :param pattern: the pattern, as a list or array with one level per 'Spider.MIN_SEC' slot or as a RunLengthPattern
+    :param max_states: the maximum number of runs of the result
+    :param resolution: voltage step to quantize the levels to, 0 to keep the levels as they are
+    :param max_error: raise a ValueError if the result deviates more than this from the input
+    :return: the compressed pattern and its error: the largest absolute voltage difference between the input and
+    the result in any slot. The total duration is never changed.
+    """
+    if max_states < 1:
+        raise ValueError('max_states must be at least 1')
+    runs = pattern if isinstance(pattern, RunLengthPattern) else RunLengthPattern.encode(pattern)
+    levels = runs.levels.tolist()
+    slots = runs.slots.tolist()
+    weighted = [level * count for level, count in zip(levels, slots)]
+    low = list(levels)
+    high = list(levels)
+
+    count = len(levels)
+    if count > max_states:
+        # Doubly linked list of runs, with a version per run to skip stale heap entries
+        following = list(range(1, count + 1))
+        preceding = list(range(-1, count - 1))
+        version = [0] * count
+
+        def merge_error(a, b):
+            mean = (weighted[a] + weighted[b]) / (slots[a] + slots[b])
+            return max(mean - min(low[a], low[b]), max(high[a], high[b]) - mean)
+
+        heap = [(merge_error(a, a + 1), a, 0, 0) for a in range(count - 1)]
+        heapq.heapify(heap)
+        while count > max_states:
+            _, a, version_a, version_b = heapq.heappop(heap)
+            b = following[a]
+            if version[a] != version_a or b >= len(levels) or version[b] != version_b:
+                continue
+            # Absorb run b into run a
+            weighted[a] += weighted[b]
+            slots[a] += slots[b]
+            low[a] = min(low[a], low[b])
+            high[a] = max(high[a], high[b])
+            version[a] += 1
+            version[b] = -1
+            following[a] = following[b]
+            if following[a] < len(levels):
+                preceding[following[a]] = a
+            count -= 1
+            c = preceding[a]
+            if c >= 0:
+                heapq.heappush(heap, (merge_error(c, a), c, version[c], version[a]))
+            if following[a] < len(levels):
+                d = following[a]
+                heapq.heappush(heap, (merge_error(a, d), a, version[a], version[d]))
+        alive = [index for index, run_version in enumerate(version) if run_version >= 0]
+    else:
+        alive = range(count)
+
+    slots = numpy.array([slots[index] for index in alive], dtype=numpy.int64)
+    means = numpy.array([weighted[index] for index in alive], dtype=numpy.float64) / numpy.maximum(slots, 1)
+    low = numpy.array([low[index] for index in alive], dtype=numpy.float64)
+    high = numpy.array([high[index] for index in alive], dtype=numpy.float64)
+    if resolution > 0:
+        means = numpy.round(means / resolution) * resolution
+
+    error = float(numpy.max(numpy.maximum(means - low, high - means))) if len(means) else 0.0
+    if max_error is not None and error > max_error:
+        raise ValueError('Pattern cannot be compressed to {} states within {} V (error {} V)'.format(
+            max_states, max_error, error))
+    return RunLengthPattern.encode(means, slots), error
@@ -25,14 +25,13 @@ To build this setup:
 
 from time import sleep, time
 from pathlib import Path
-from shapely.geometry import Point  
-from shapely.geometry.polygon import Polygon  
-import serial
 import os
 
 from fipy.parameters import *
 from fipy.scriptutils import ResultColor, fipy_script
-from spidersdk.chronology import Chronology
+from common.campaign import Campaign, arm_reset, open_spider, open_spider_port, open_target, read_response
+from common.classifier import Classifier, Contains, Exact, Rule, Timeout
+from common.region import PolygonRegion, learn_region
 from spidersdk.spider import Spider
 
 
@@ -54,129 +53,92 @@ RESET_OUT  = 0
 TRIGGER_OUT = 8
 TRIGGER_EDGE = Spider.RISING_EDGE
 
+# Draw the glitch length and voltage from inside the polygon, instead of skipping parameters outside of it
+SAMPLE_FROM_REGION = False
+# Replace the polygon by the region around the GREEN and ORANGE results of previous runs of this script,
+# grown by LEARN_MARGIN so the search keeps exploring just outside of it
+LEARN_REGION = False
+LEARN_MARGIN = 0.05
+
 polygon_points=[(15.181344137391992, -0.4889995171124533), (32.44992150668392, -0.49087653910726375), (37.56142040799433, -0.09670192019707435), (52.20517401715389, 0.15669604910233303), (70.71708895703483, 0.31248887467159836), (105.80683817143603, 0.4363723263290864), (124.87134758713431, 0.45514254627719075), (155.67848961395111, 0.4757897882201054), (195.7415891107084, 0.5058221401370722), (230.00244661138356, 0.5339774700592286), (256.1125355937529, 0.532100448064418), (256.1125355937529, 0.6691230536855792), (192.14972501789566, 0.7029094495921668), (153.05366585381873, 0.6878932736336834), (114.92464702242216, 0.6728770976752001), (87.98566632632675, 0.624074525810129), (56.21148396682961, 0.5208383160955556), (39.909946930218034, 0.3537833585574277), (28.16731431909952, 0.1548190271075226), (21.674329228245757, -0.08543978822821185), (15.181344137391992, -0.4889995171124533)]
-polygon = Polygon(polygon_points) 
+region = PolygonRegion(polygon_points)
+
+
+CLASSIFIER = Classifier([
+    Rule(ResultColor.PINK, Timeout()),  # no trigger, check setup
+    Rule(ResultColor.YELLOW, Exact(b'', b'\x00')),
+    Rule(ResultColor.GREEN, Contains(b',12,\r\n')),
+    Rule(ResultColor.RED, Contains(b',13,\r\n')),
+    Rule(ResultColor.MAGENTA),
+])
+
+
 @fipy_script
 def execute_script(util):
     util.set_termination_timeout(5)
     util.parameter_init(PARAMETERS)
 
     script_name = Path(__file__).stem
+    search_region = region
+    if LEARN_REGION:
+        search_region = learn_region('logs/{}.sqlite'.format(script_name), script_name,
+                                     'glitch_length', 'glitch_voltage', [ResultColor.GREEN, ResultColor.ORANGE],
+                                     margin=LEARN_MARGIN)
+        print('Learned region: {}'.format(list(search_region.polygon.exterior.coords)))
     db = util.create_database_table('logs/{}.sqlite'.format(script_name),
                                     '{}'.format(script_name))
     util.add_to_cleanup(util.close_database)
 
     # Hardware initialization (Spider)
-    spider_com_port = serial.Serial()
-    spider_com_port.port = str(PARAMETERS['spider_com_port'])
-    spider_com_port.open()
-    spider_core1 = Spider(Spider.CORE1, spider_com_port)
-    spider_core1.reset_settings()
-    util.add_to_cleanup(spider_com_port.close)
+    spider_com_port = open_spider_port(util, PARAMETERS['spider_com_port'])
+    glitcher = open_spider(spider_com_port)
 
     # Hardware initialization (Pinata)
-    serial_target = serial.Serial()
-    serial_target.baudrate = int(PARAMETERS['serial_baudrate'])
-    serial_target.timeout = float(PARAMETERS['serial_timeout'])
-    serial_target.port = str(PARAMETERS['serial_com_port'])
-    serial_target.open()
-    serial_target.reset_input_buffer()
-    serial_target.reset_output_buffer()
-    util.add_to_cleanup(serial_target.close)
-
-    try:
-        glitcher = Chronology(spider_core1)
-    except IndexError as e:
-        raise Exception(str(e) +
-                        "\n\nDid you select the right COM port for Spider? Is it powered on?")
-
-
-    glitcher.forget_events()  # Forget any previous added events
-        
+    serial_target = open_target(util, PARAMETERS['serial_com_port'],
+                                PARAMETERS['serial_baudrate'], PARAMETERS['serial_timeout'])
+
     normal_vcc = float(PARAMETERS['normal_voltage'])
 
     glitcher.set_vcc_now(GLITCH_OUT, normal_vcc)
     glitcher.set_gpio_now(RESET_OUT, 1)
-    counter = 0
     do_reset = True
-    
-    for p in PARAMETERS:
-        if not polygon.contains(Point(p["glitch_length"], p["glitch_voltage"])):
-            continue
-        t = time()
-        if not util.process_commands():
-            break
-            
-        serial_target.reset_input_buffer()
-        serial_target.reset_output_buffer()
-        glitcher.forget_events()  
 
+    def arm(glitcher, p):
         if do_reset:
-            # Perform reset "Now", instead of in the state machine
-            # sleeps might require manual tuning, based on device
-            glitcher.set_gpio(RESET_OUT, 0)
-            glitcher.set_vcc(GLITCH_OUT, 0)
-            
-            glitcher.wait_time(0.1e-3)
-            glitcher.set_gpio(RESET_OUT, 1)
-
-            #glitcher.wait_time(10e-3)
+            # Reset the target from the state machine, at the start of every attempt
+            arm_reset(glitcher, GLITCH_OUT, RESET_OUT, normal_vcc)
 
-            glitcher.set_vcc(GLITCH_OUT, normal_vcc)
-
-
-            #do_reset = False
-            
-
-        # Clear states from previous iteration
-
-        #glitcher.set_gpio(TRIGGER_OUT, 1)
         glitcher.wait_trigger(TRIGGER_IN, TRIGGER_EDGE, count=1)
         glitcher.glitch(
             GLITCH_OUT,
             p['glitch_voltage'],
             p['glitch_delay'] / 1e9,
             p['glitch_length'] / 1e9)
-            
-        #glitcher.set_gpio(TRIGGER_OUT, 0)
-
-        glitcher.start()  
-
-        pin_response = serial_target.read(6)
-        if b'\x00' in pin_response:# this was added after minimal test case because it happened pretty frequently and i wanted to get rid before running the first campaign
-            pin_response = pin_response+serial_target.read(1)
-        print(pin_response)
-        print(len(pin_response))
-        # Block for 1 second or until Spider reaches final state.
-        spider_timeout = glitcher.wait_until_finish(2000)
-
-        if spider_timeout:
-            color = ResultColor.PINK  # no trigger, check setup
-        elif len(pin_response)==0 or pin_response==b'\x00': 
-            color = ResultColor.YELLOW
-        elif b',12,\r\n' in pin_response:
-            color = ResultColor.GREEN
-        elif b',13,\r\n' in pin_response:
-            color = ResultColor.RED
-        else:
-            color = ResultColor.MAGENTA
-
-      
-        result = Parameters(
-            ("id", counter),
-            ("timestamp", int(t)),
-            ("iter_t (ms)", int((time() - t) * 1000)),
+
+    def record(attempt):
+        p = attempt.parameters
+        return [
+            ("id", attempt.id),
+            ("timestamp", int(attempt.t)),
+            ("iter_t (ms)", attempt.elapsed_ms()),
             ("glitch_voltage", p['glitch_voltage']),
             ("glitch_delay", p['glitch_delay']),
             ("glitch_length", p['glitch_length']),
             ("normal_voltage", p['normal_voltage']),
-            ("spider_timeout", spider_timeout),
+            ("spider_timeout", attempt.spider_timeout),
             ("do_reset", do_reset),
-            ("Data", pin_response),
-            ("Color", int(color))
-        )
-
-        util.monitor(result)
-
-        counter += 1
-        db.add(result)
+            ("Data", attempt.response),
+            ("Color", int(attempt.color))
+        ]
+
+    campaign = Campaign(
+        util, glitcher, serial_target,
+        transport=spider_com_port,
+        arm=arm,
+        read=lambda target, p: read_response(target, 6),
+        classify=CLASSIFIER,
+        record=record,
+        accept=None if SAMPLE_FROM_REGION else search_region.accepts('glitch_length', 'glitch_voltage'),
+        sample=search_region.sampler('glitch_length', 'glitch_voltage', x_type=int) if SAMPLE_FROM_REGION else None,
+        finish_timeout=2000)
+    campaign.run(PARAMETERS, db)